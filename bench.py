@@ -0,0 +1,574 @@
+"""
+Micro-benchmarks de piezas internas de svr.py y del cliente (sin red).
+
+    python bench.py dispatch            # parseo y despacho de comandos de texto
+    python bench.py admission           # coste por datagrama del control de admisión
+    python bench.py mix                 # mezcla de conferencias, 3 a 50 participantes
+    python bench.py egress              # señalización y audio con el enlace saturado
+    python bench.py dsp                 # ganancia/puerta/limitador del cliente por trama
+    python bench.py codec               # CPU de codificar/decodificar y ancho de banda por códec
+    python bench.py jitter              # retardo de reproducción: Queue(40) frente al anti-jitter
+    python bench.py plc                 # calidad con pérdida: silencio, PLC y PLC + paridad
+    python bench.py dispatch -n 200000 --out dispatch.json
+
+Cada subcomando imprime una tabla y, con --out, guarda el resultado en JSON
+para comparar entre commits. loadgen.py mide el servidor completo por UDP.
+"""
+import argparse
+import array
+import base64
+import itertools
+import json
+import math
+import random
+import struct
+import sys
+import time
+from collections import deque
+
+import codec
+import svr
+
+
+class NullSock:
+    """Socket de mentira: cuenta lo que se enviaría."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, data, addr):
+        self.sent += 1
+        return len(data)
+
+    def send_media(self, data, addr, born=None):
+        self.sent += 1
+
+
+def _timeit(fn, n, repeat=5):
+    # ns por llamada; el mínimo de varias rondas es lo menos ruidoso
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        best = min(best, time.perf_counter() - t0)
+    return best / n * 1e9
+
+
+def _legacy_parse(data):
+    # Lo que hacía handle_text antes de la tabla de despacho.
+    msg = data.decode(errors="ignore").strip()
+    parts = msg.split(":")
+    cmd = parts[0]
+    if cmd in ("OFFER_B64", "ANSWER_B64", "ICE_B64", "AUDIO_B64") and len(parts) >= 4:
+        return cmd, parts[1], parts[2], ":".join(parts[3:]).encode()
+    return cmd, parts[1:]
+
+
+def _messages():
+    audio = base64.b64encode(bytes(640)).decode()
+    sdp = base64.b64encode(b"v=0\r\no=- 0 0 IN IP4 0.0.0.0\r\n" * 40).decode()
+    return {
+        "PING": b"PING:1001",
+        "CALL": b"CALL:1002:1001",
+        "REGISTER": b"REGISTER:1001:5000:Ana",
+        "AUDIO_B64": f"AUDIO_B64:1002:1001:{audio}".encode(),
+        "OFFER_B64": f"OFFER_B64:1002:1001:{sdp}".encode(),
+    }
+
+
+def bench_dispatch(args):
+    sock = NullSock()
+    addr = ("127.0.0.1", 40000)
+    svr.log.configure("REC=OFF")
+    with svr.lock:
+        svr.clients["1001"] = ("127.0.0.1", 40000, time.time(), "Ana")
+        svr.clients["1002"] = ("127.0.0.1", 40001, time.time(), "Bea")
+    svr.REDUNDANCY_DEFAULT = (1, 0.0)
+    svr.recent.seen = lambda addr, data: False  # cada iteración repite el datagrama
+
+    rows = []
+    for name, data in _messages().items():
+        legacy = _timeit(lambda: _legacy_parse(data), args.n)
+        parse = _timeit(lambda: svr.parse_request(data, addr, sock), args.n)
+        full = _timeit(lambda: svr.handle_text(data, addr, sock), args.n // 4 or 1)
+        rows.append({"cmd": name, "bytes": len(data), "legacy_parse_ns": round(legacy),
+                     "parse_ns": round(parse), "handle_ns": round(full)})
+
+    print(f"{'cmd':<10} {'bytes':>6} {'split ns':>9} {'tabla ns':>9} {'handle ns':>10}")
+    for r in rows:
+        print(f"{r['cmd']:<10} {r['bytes']:>6} {r['legacy_parse_ns']:>9} "
+              f"{r['parse_ns']:>9} {r['handle_ns']:>10}")
+    return {"bench": "dispatch", "n": args.n, "rows": rows}
+
+
+def bench_admission(args):
+    adm = svr.Admission()
+    for cls in adm.limits:
+        adm.configure(f"{cls}=1e9@1e9")  # que todo pase: medimos el camino normal
+    frame = bytes([0x81]) + bytes(651)
+    ping = b"PING:1001"
+    addrs = [("10.0.%d.%d" % (i >> 8, i & 255), 40000 + i) for i in range(1000)]
+    rows = []
+    for name, data, keys in (("media", frame, addrs[:1]), ("signal", ping, addrs[:1]),
+                             ("signal-1000src", ping, addrs)):
+        it = itertools.cycle(keys)
+        ns = _timeit(lambda: adm.admit(data, next(it)), args.n)
+        rows.append({"case": name, "admit_ns": round(ns)})
+    off = svr.Admission()
+    off.configure("off")
+    rows.append({"case": "off", "admit_ns": round(_timeit(lambda: off.admit(frame, addrs[0]), args.n))})
+    print(f"{'caso':<16} {'ns':>6}")
+    for r in rows:
+        print(f"{r['case']:<16} {r['admit_ns']:>6}")
+    return {"bench": "admission", "n": args.n, "rows": rows}
+
+
+def bench_mix(args):
+    rnd = random.Random(1)
+    sock = NullSock()
+    rows = []
+    for n in (3, 5, 10, 20, 50):
+        frames = [bytes(rnd.getrandbits(8) for _ in range(svr.CONF_FRAME)) for _ in range(n)]
+        row = {"participants": n}
+        for name, fn in svr.MIXERS.items():
+            if (name == "numpy" and svr.np is None) or (name == "audioop" and svr.audioop is None):
+                continue
+            reps = max(1, args.n // (50 * n)) if name == "python" else max(1, args.n // n)
+            row[f"{name}_us"] = round(_timeit(lambda: fn(frames), reps, repeat=3) / 1000, 1)
+        # un tick completo de una sala (mezcla + envío de una trama a cada uno)
+        room = svr.ConfRoom("bench", 1)
+        addrs = [("127.0.0.1", 41000 + i) for i in range(n)]
+        for a in addrs:
+            room.members[a] = (str(a[1]), False, svr.deque())
+
+        def tick():
+            for a, f in zip(addrs, frames):
+                room.members[a][2].append(f)
+            room.tick(sock)
+
+        row["tick_us"] = round(_timeit(tick, max(1, args.n // n), repeat=3) / 1000, 1)
+        row["budget_pct"] = round(row["tick_us"] / (svr.MIX_TICK * 1e6) * 100, 2)
+        # bajada por participante: una trama mezclada frente a N-1 reenviadas
+        row["down_kbps_mixed"] = round((svr.CONF_FRAME + svr.MEDIA_HDR.size) * 8 / svr.MIX_TICK / 1000)
+        row["down_kbps_forward"] = row["down_kbps_mixed"] * (n - 1)
+        rows.append(row)
+    cols = [k for k in rows[0] if k != "participants"]
+    print(f"{'N':>3} " + " ".join(f"{c:>17}" for c in cols))
+    for r in rows:
+        print(f"{r['participants']:>3} " + " ".join(f"{r.get(c, '-'):>17}" for c in cols))
+    return {"bench": "mix", "n": args.n, "mixer": svr.MIXER, "rows": rows}
+
+
+class SlowLink:
+    """sendto de mentira que admite `pps` datagramas/s y si no da EAGAIN."""
+
+    def __init__(self, pps):
+        self.pps = pps
+        self.tokens = 0.0
+        self.t = time.monotonic()
+        self.delivered = []  # (instante, datagrama)
+
+    def __call__(self, data, addr):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.t) * self.pps, 8.0)
+        self.t = now
+        if self.tokens < 1.0:
+            raise BlockingIOError
+        self.tokens -= 1.0
+        self.delivered.append((now, data))
+
+
+def _egress_run(prioritized, seconds, link_pps, media_pps, dests):
+    # Cada datagrama lleva su instante de creación para medir con qué edad llega.
+    q = svr.EgressQueue(deadline=None if prioritized else 1e9)
+    link = SlowLink(link_pps)
+    addrs = [("10.0.0.%d" % i, 5000) for i in range(dests)]
+    t0 = time.monotonic()
+    next_media = next_sig = t0
+    i = 0
+    while time.monotonic() - t0 < seconds:
+        now = time.monotonic()
+        while next_media <= now:
+            data = b"M" + struct.pack("!d", next_media) + bytes(640)
+            q.send(link, addrs[i % dests], data, media=True)
+            i += 1
+            next_media += 1.0 / media_pps
+        while next_sig <= now:
+            data = b"S" + struct.pack("!d", next_sig) + b"BYE_FROM:1001"
+            # sin prioridades la señalización va a la misma cola FIFO que el audio
+            q.send(link, addrs[i % dests], data, media=not prioritized)
+            next_sig += 0.02
+        q.drain(link)
+        time.sleep(0.0005)
+    ages = {b"S": [], b"M": []}
+    for t, data in link.delivered:
+        ages[data[:1]].append(t - struct.unpack_from("!d", data, 1)[0])
+
+    def ms(v, p):
+        v = sorted(v)
+        return round(v[min(len(v) - 1, int(p * len(v)))] * 1000, 1) if v else None
+
+    return {"mode": "prioridad+plazo" if prioritized else "fifo",
+            "signal_p50_ms": ms(ages[b"S"], 0.5), "signal_p99_ms": ms(ages[b"S"], 0.99),
+            "media_p99_ms": ms(ages[b"M"], 0.99), "media_max_ms": ms(ages[b"M"], 1.0),
+            "media_sent": len(ages[b"M"]), "stale_dropped": q.dropped["stale"],
+            "overflow_dropped": q.dropped["overflow_media"]}
+
+
+def bench_egress(args):
+    # enlace a 2000 datagramas/s con 3000 tramas/s de audio: un 50 % de sobra
+    rows = [_egress_run(p, args.seconds, 2000, 3000, 20) for p in (False, True)]
+    cols = list(rows[0])
+    print(" ".join(f"{c:>16}" for c in cols))
+    for r in rows:
+        print(" ".join(f"{str(r[c]):>16}" for c in cols))
+    return {"bench": "egress", "deadline_ms": svr.MEDIA_DEADLINE * 1000, "rows": rows}
+
+
+def _legacy_dsp(in_data, gain, gate):
+    # Lo que hacía VoIPClient._audio_input_callback antes de process_input.
+    data_array = array.array('h', in_data)
+    if gate:
+        volume = sum(abs(x) for x in data_array) / len(data_array)
+        if volume < gate:
+            return None
+    if gain != 1.0:
+        for i in range(len(data_array)):
+            val = int(data_array[i] * gain)
+            if val > 32767: val = 32767
+            if val < -32768: val = -32768
+            data_array[i] = val
+    return data_array.tobytes()
+
+
+def bench_dsp(args):
+    import win_client  # importa tkinter; solo hace falta aquí
+
+    rnd = random.Random(1)
+    # voz fuerte: parte de las muestras pasan del codo del limitador
+    frame = array.array('h', [int(20000 * math.sin(i / 7) + rnd.gauss(0, 3000)) for i in range(320)])
+    frame = array.array('h', [max(-32768, min(32767, v)) for v in frame]).tobytes()
+    cases = [("gain", 1.5, 0, False, False), ("gate", 1.0, 500, False, False),
+             ("gate_rms", 1.0, 500, True, False), ("gain+gate", 1.5, 500, False, False),
+             ("gain+limit", 1.5, 0, False, True), ("all", 1.5, 500, True, True)]
+    backends = {k: fn for k, fn in win_client.DSP_BACKENDS.items()
+                if (k != "numpy" or win_client.NUMPY_AVAILABLE)
+                and (k != "audioop" or win_client.AUDIOOP_AVAILABLE)}
+    rows = []
+    for name, gain, gate, rms, limit in cases:
+        row = {"case": name}
+        if not rms and not limit:
+            row["legacy_us"] = round(_timeit(lambda: _legacy_dsp(frame, gain, gate),
+                                             max(1, args.n // 100), repeat=3) / 1000, 1)
+        outs = set()
+        for k, fn in backends.items():
+            reps = max(1, args.n // 100) if k == "python" else max(1, args.n // 10)
+            row[f"{k}_us"] = round(_timeit(lambda: fn(frame, gain, gate, rms, limit), reps,
+                                           repeat=3) / 1000, 1)
+            outs.add(fn(frame, gain, gate, rms, limit))
+        row["identical"] = len(outs) == 1
+        rows.append(row)
+    cols = ["legacy_us"] + [f"{k}_us" for k in backends] + ["identical"]
+    print(f"{'caso':<11} " + " ".join(f"{c:>12}" for c in cols) + "   (µs por trama de 320)")
+    for r in rows:
+        print(f"{r['case']:<11} " + " ".join(f"{str(r.get(c, '-')):>12}" for c in cols))
+    return {"bench": "dsp", "n": args.n, "backend": win_client.DSP_BACKEND,
+            "frame_ms": 20, "rows": rows}
+
+
+def bench_codec(args):
+    rnd = random.Random(1)
+    # 2 s de "voz": tono con vibrato y ruido, en tramas de 20 ms
+    t = [i / codec.RATE for i in range(codec.RATE * 2)]
+    pcm = array.array('h', [int(8000 * math.sin(2 * math.pi * (180 + 40 * math.sin(6 * x)) * x)
+                                + rnd.gauss(0, 300)) for x in t]).tobytes()
+    frames = [pcm[i:i + codec.FRAME_BYTES] for i in range(0, len(pcm), codec.FRAME_BYTES)]
+    fps = codec.RATE / codec.FRAME_SAMPLES
+    udp = 28  # cabeceras IPv4 + UDP
+    rows = []
+    for name, cls in codec.CODECS.items():
+        row = {"codec": name, "pt": cls.pt, "frame_ms": cls.frame_samples * 1000 // codec.RATE,
+               "declared_kbps": cls.bitrate / 1000}
+        try:
+            c = cls()
+        except RuntimeError as e:
+            row["error"] = str(e)
+            rows.append(row)
+            continue
+        payloads = [c.encode(f) for f in frames]
+        enc = itertools.cycle(frames)
+        dec = itertools.cycle(payloads)
+        row["encode_us"] = round(_timeit(lambda: c.encode(next(enc)), max(1, args.n // 20), repeat=3) / 1000, 2)
+        row["decode_us"] = round(_timeit(lambda: c.decode(next(dec)), max(1, args.n // 20), repeat=3) / 1000, 2)
+        size = sum(map(len, payloads)) / len(payloads)
+        row["payload_bytes"] = round(size, 1)
+        row["binary_kbps"] = round((size + svr.MEDIA_HDR.size + udp) * 8 * fps / 1000, 1)
+        b64 = len(base64.b64encode(bytes(round(size))))
+        row["b64_kbps"] = round((len("AUDIO_B64:1002:1001:") + b64 + udp) * 8 * fps / 1000, 1)
+        rows.append(row)
+    base = next(r for r in rows if r["codec"] == codec.PCM16.name)["b64_kbps"]
+    for r in rows:
+        if "binary_kbps" in r:
+            r["saving_vs_pcm_b64"] = round(base / r["binary_kbps"], 1)
+    cols = ["declared_kbps", "payload_bytes", "binary_kbps", "b64_kbps", "saving_vs_pcm_b64",
+            "encode_us", "decode_us"]
+    print(f"{'códec':<6} " + " ".join(f"{c:>17}" for c in cols))
+    for r in rows:
+        line = f"{r['codec']:<6} " + " ".join(f"{str(r.get(c, '-')):>17}" for c in cols)
+        print(line + (f"   ({r['error']})" if "error" in r else ""))
+    return {"bench": "codec", "n": args.n, "rows": rows}
+
+
+class _LegacyQueue:
+    # Lo que hacía el cliente antes: FIFO de 40 tramas que tira la más vieja.
+    def __init__(self):
+        self.q = deque()
+        self.stats = {"overflow": 0}
+
+    def put(self, seq, ts, pt, data, now=None):
+        if len(self.q) >= 40:
+            self.q.popleft()
+            self.stats["overflow"] += 1
+        self.q.append((pt, data))
+
+    def get(self):
+        return self.q.popleft() if self.q else None
+
+
+def _jitter_run(buf, seconds, phases, seed):
+    # Emisor cada 20 ms; la red suma un retardo por trama según la fase; el
+    # receptor saca una trama cada 20 ms. El "dato" es el instante de envío.
+    rnd = random.Random(seed)
+    frame = 0.02
+    arrivals = []
+    for i in range(int(seconds / frame)):
+        sent = i * frame
+        base, jitter, loss = next(p[1:] for p in phases if sent < p[0])
+        if rnd.random() < loss:
+            continue
+        delay = base + (rnd.expovariate(1 / jitter) if jitter else 0) + rnd.uniform(0, 0.002)
+        arrivals.append((sent + min(delay, 0.5), i & 0xFFFF, (i * 320) & 0xFFFFFFFF, sent))
+    arrivals.sort()
+    played = {p[0]: [] for p in phases}
+    silent = 0
+    k = 0
+    tick = 0.007
+    while tick < seconds + 1:
+        while k < len(arrivals) and arrivals[k][0] <= tick:
+            t, seq, ts, sent = arrivals[k]
+            buf.put(seq, ts, 0, sent, now=t)
+            k += 1
+        item = buf.get()
+        if not isinstance(item, tuple):
+            silent += 1  # silencio o hueco
+        else:
+            sent = item[1]
+            phase = next(p[0] for p in phases if sent < p[0])
+            played[phase].append(tick - sent)
+        tick += frame
+    n = int(seconds / frame)
+    total = sum(len(v) for v in played.values())
+    row = {"played_pct": round(total / n * 100, 2)}
+    for end, v in played.items():
+        v.sort()
+        if v:
+            row[f"<{end:g}s_p50_ms"] = round(v[len(v) // 2] * 1000, 1)
+            row[f"<{end:g}s_p95_ms"] = round(v[int(len(v) * 0.95)] * 1000, 1)
+    row.update({k: v for k, v in buf.stats.items() if v and k != "received"})
+    return row
+
+
+def bench_jitter(args):
+    import win_client  # importa tkinter; solo hace falta aquí
+
+    # (hasta segundo, retardo base, jitter medio exponencial, pérdida)
+    phases = [(10, 0.02, 0.0, 0.0), (20, 0.02, 0.025, 0.01), (40, 0.02, 0.0, 0.0)]
+    rows = []
+    for name, buf in (("Queue(40)", _LegacyQueue()), ("JitterBuffer", win_client.JitterBuffer())):
+        row = {"buffer": name}
+        row.update(_jitter_run(buf, phases[-1][0], phases, seed=3))
+        rows.append(row)
+    print("red: 20 ms fijos; de 10 a 20 s, +exp(25 ms) por trama y 1 % de pérdida")
+    for r in rows:
+        print(f"{r['buffer']:<13} " + " ".join(f"{k}={v}" for k, v in r.items() if k != "buffer"))
+    return {"bench": "jitter", "phases": phases, "rows": rows}
+
+
+def _speech(seconds, rnd):
+    # "voz": sílabas de ~200 ms con tono que sube y baja (100-220 Hz), tres
+    # armónicos, algo de ruido y pausas
+    out = array.array('h')
+    while len(out) < seconds * codec.RATE:
+        dur = rnd.uniform(0.12, 0.3)
+        f0 = rnd.uniform(100, 220)
+        n = int(dur * codec.RATE)
+        phase = 0.0
+        for i in range(n):
+            env = math.sin(math.pi * i / n)
+            phase += 2 * math.pi * f0 * (1 + 0.1 * math.sin(math.pi * i / n)) / codec.RATE
+            v = 6000 * math.sin(phase) + 3000 * math.sin(2 * phase + 0.5) + 1500 * math.sin(3 * phase + 1)
+            out.append(int(env * v + rnd.gauss(0, 200)))
+        gap = int(rnd.uniform(0, 0.1) * codec.RATE)
+        out.extend(int(rnd.gauss(0, 200)) for _ in range(gap))
+    usable = len(out) - len(out) % codec.FRAME_SAMPLES
+    return out[:usable]
+
+
+def _losses(n, pct, burst, rnd):
+    # Gilbert-Elliott: pérdida media pct, ráfagas de `burst` tramas de media
+    p_bad = 1 / burst
+    p_good = pct / 100 * p_bad / (1 - pct / 100)
+    lost, bad = [], False
+    for _ in range(n):
+        bad = rnd.random() < (1 - p_bad if bad else p_good)
+        lost.append(bad)
+    return lost
+
+
+class _Mute(codec.Concealer):
+    # lo que hacía el cliente antes: silencio en cada hueco
+    def conceal(self, pcm=None):
+        self.concealed += 1
+        return bytes(2 * self.frame_samples)
+
+
+def _seg_snr(ref, out):
+    # SNR segmental por trama, acotada a [-10, 35] dB como es costumbre
+    num = sum(v * v for v in ref)
+    if num < 1e4 * len(ref):
+        return None  # trama en silencio: no cuenta
+    err = sum((a - b) ** 2 for a, b in zip(ref, out))
+    return 35.0 if not err else max(-10.0, min(35.0, 10 * math.log10(num / err)))
+
+
+def _plc_run(frames, lost, plc, group, pct):
+    # Red sin jitter: cada trama llega 5 ms después de enviarse; la paridad, con
+    # la última de su grupo, y se pierde aparte con la misma probabilidad. Se
+    # reproduce cada 20 ms con playout() del cliente, anotando qué seq ocupa
+    # cada tick: un hueco oculto mientras se esperaba cuenta como su trama.
+    import win_client
+
+    rnd = random.Random(7)
+    jb = win_client.JitterBuffer()
+    pcm = codec.PCM16()
+    fs = codec.FRAME_SAMPLES
+    played = {}      # {seq: PCM que sonó en su lugar}
+    waiting = []     # ticks ocultados sin avanzar
+    pending = []
+    extra = 0
+    delay = []
+
+    def tick(i):
+        before = jb.next_seq
+        out = win_client.playout(jb, lambda pt: pcm, plc, pcm.pt)
+        after = jb.next_seq
+        if before is None or after == before:
+            if out is not None:
+                waiting.append(out)
+            return
+        for seq in range(before, after - 1):  # huecos que tapó la espera
+            played[seq] = waiting.pop(0) if waiting else None
+        played[after - 1] = out
+        delay.append(i - (after - 1))
+
+    for i, f in enumerate(frames):
+        if not lost[i]:
+            jb.put(i, i * fs, pcm.pt, f, now=i * 0.02 + 0.005)
+        if group:
+            pending.append(f)
+            if len(pending) == group:
+                par = codec.parity(pending)
+                extra += len(par) + svr.MEDIA_HDR.size
+                if rnd.random() >= pct / 100:
+                    jb.put_parity(i - group + 1, (i - group + 1) * fs, par)
+                pending = []
+        tick(i)
+    for i in range(len(frames), len(frames) + jb.max_frames + 1):
+        tick(i)
+    snr, gaps = [], 0
+    for i, f in enumerate(frames):
+        if not lost[i]:
+            continue
+        ref = array.array('h', f)
+        got = array.array('h', played.get(i) or bytes(len(f)))
+        v = _seg_snr(ref, got)
+        if v is None:
+            continue
+        snr.append(v)
+        if sum(x * x for x in got) * 100 < sum(x * x for x in ref):
+            gaps += 1  # a -20 dB o menos: se oye un corte
+    st = jb.stats
+    return {"lost_snr_db": round(sum(snr) / len(snr), 2) if snr else None,
+            "gaps_ms": gaps * 20, "recovered": st["recovered"], "concealed": plc.concealed,
+            "delay_ms": round(sum(delay) / len(delay) * 20, 1),
+            "overhead_pct": round(100 * extra / sum(len(f) + svr.MEDIA_HDR.size for f in frames), 1)}
+
+
+def bench_plc(args):
+    import win_client  # importa tkinter; solo hace falta aquí
+
+    rnd = random.Random(5)
+    sig = _speech(60, rnd).tobytes()
+    frames = [sig[i:i + codec.FRAME_BYTES] for i in range(0, len(sig), codec.FRAME_BYTES)]
+    cases = [(2, 1), (5, 1), (10, 1), (5, 3)]   # (% pérdida, ráfaga media)
+    rows = []
+    for pct, burst in cases:
+        lost = _losses(len(frames), pct, burst, random.Random(pct * 10 + burst))
+        group = win_client.fec_group(pct)
+        for mode, plc, g in (("silencio", _Mute(), 0), ("PLC", codec.Concealer(), 0),
+                             (f"PLC+paridad/{group}", codec.Concealer(), group)):
+            row = {"loss_pct": pct, "burst": burst, "mode": mode,
+                   "real_loss_pct": round(100 * sum(lost) / len(lost), 1)}
+            row.update(_plc_run(frames, lost, plc, g, pct))
+            rows.append(row)
+    hist = sig[:2 * codec.PLC_HISTORY]
+    cost = {}
+    for name, fn in codec.PITCH_BACKENDS.items():
+        if (name == "numpy" and codec.np is None) or (name == "audioop" and codec.audioop is None):
+            continue
+        c = codec.Concealer(backend=name)
+        c.good(hist)
+        cost[name] = round(_timeit(lambda: (c.reset(), c.good(hist), c.conceal()),
+                                   max(1, args.n // 100), repeat=3) / 1000, 1)
+    print(f"{len(frames) * 20 / 1000:.0f} s de voz sintética, pérdida Gilbert-Elliott; "
+          f"PCM, sin jitter")
+    cols = ["real_loss_pct", "lost_snr_db", "gaps_ms", "recovered",
+            "concealed", "delay_ms", "overhead_pct"]
+    print(f"{'pérdida':<12} {'modo':<16} " + " ".join(f"{c:>13}" for c in cols))
+    for r in rows:
+        print(f"{str(r['loss_pct']) + '% r' + str(r['burst']):<12} {r['mode']:<16} "
+              + " ".join(f"{str(r[c]):>13}" for c in cols))
+    print("µs por trama ocultada (búsqueda de tono + síntesis): "
+          + ", ".join(f"{k} {v}" for k, v in cost.items()))
+    return {"bench": "plc", "seconds": len(frames) * 0.02, "rows": rows, "conceal_us": cost}
+
+
+BENCHES = {
+    "dispatch": bench_dispatch,
+    "admission": bench_admission,
+    "mix": bench_mix,
+    "egress": bench_egress,
+    "dsp": bench_dsp,
+    "codec": bench_codec,
+    "jitter": bench_jitter,
+    "plc": bench_plc,
+}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Micro-benchmarks de svr.py")
+    ap.add_argument("bench", choices=sorted(BENCHES))
+    ap.add_argument("-n", type=int, default=20000, help="iteraciones por caso")
+    ap.add_argument("--seconds", type=float, default=2.0, help="duración de egress")
+    ap.add_argument("--out", help="guardar el resultado en JSON")
+    args = ap.parse_args(argv)
+    res = BENCHES[args.bench](args)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
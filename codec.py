@@ -0,0 +1,287 @@
+"""
+Códecs de audio de VoIP-PY (win_client.py, svr.py y bench.py).
+
+Todos trabajan con tramas de 20 ms de PCM int16 mono a 16 kHz (640 bytes) y
+declaran su tipo de payload (el byte "tipo" de la cabecera binaria), tamaño de
+trama y bitrate. Se negocian en la llamada:
+
+    CALL:<llamado>:<llamante>:opus,pcm     el llamante ofrece, por preferencia
+    ACCEPT:<llamante>:<llamado>:opus       el llamado elige uno de la oferta
+    ACCEPT_FROM:<llamado>:<sid>:opus       el servidor se lo pasa al llamante
+
+Sin oferta, o sin códec en ACCEPT, la llamada va en PCM como siempre. Opus
+necesita `opuslib` y la librería libopus; si no están, available() no lo
+ofrece y todo sigue funcionando en PCM.
+
+Para las pérdidas hay tres piezas, todas opcionales para el códec:
+
+    conceal()       trama sintetizada por el propio códec para un hueco (PLC)
+    recover(sig)    la trama perdida a partir de la siguiente (FEC en banda)
+    set_loss(pct)   avisa al codificador de la pérdida que ve el otro extremo
+
+PCM no tiene ninguna: sus huecos los tapa Concealer y su redundancia es la
+paridad XOR (parity/from_parity), que sirve para cualquier payload.
+"""
+import array
+import struct
+import warnings
+
+try:
+    import opuslib
+except Exception:  # ImportError, o la librería nativa no está instalada
+    opuslib = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop  # desaparece en Python 3.13
+except ImportError:
+    audioop = None
+
+RATE = 16000
+FRAME_SAMPLES = 320   # 20 ms
+FRAME_BYTES = FRAME_SAMPLES * 2
+
+
+class PCM16:
+    """Sin compresión: el payload es el PCM tal cual."""
+    name = "pcm"
+    pt = 0
+    frame_samples = FRAME_SAMPLES
+    bitrate = RATE * 16
+
+    def encode(self, pcm):
+        return pcm
+
+    def decode(self, payload):
+        return payload
+
+    def conceal(self):
+        return None
+
+    def recover(self, next_payload):
+        return None
+
+    def set_loss(self, pct):
+        return False  # sin FEC en banda: el emisor manda paridad
+
+
+class Opus:
+    """Opus en modo VoIP, banda ancha. Un objeto por llamada: guarda estado."""
+    name = "opus"
+    pt = 1
+    frame_samples = FRAME_SAMPLES
+    bitrate = 20000
+
+    def __init__(self, bitrate=None):
+        if opuslib is None:
+            raise RuntimeError("opus no disponible (falta opuslib o libopus)")
+        if bitrate:
+            self.bitrate = bitrate
+        self._enc = opuslib.Encoder(RATE, 1, opuslib.APPLICATION_VOIP)
+        self._enc.bitrate = self.bitrate
+        self._dec = opuslib.Decoder(RATE, 1)
+
+    def encode(self, pcm):
+        return self._enc.encode(pcm, self.frame_samples)
+
+    def decode(self, payload):
+        return self._dec.decode(bytes(payload), self.frame_samples)
+
+    def conceal(self):
+        # payload vacío = trama perdida: libopus extrapola desde su estado
+        return self._dec.decode(b"", self.frame_samples)
+
+    def recover(self, next_payload):
+        return self._dec.decode(bytes(next_payload), self.frame_samples, decode_fec=True)
+
+    def set_loss(self, pct):
+        # con pérdida, cada paquete lleva además la trama anterior a bitrate bajo (LBRR)
+        self._enc.inband_fec = 1 if pct > 0 else 0
+        self._enc.packet_loss_perc = min(int(pct + 0.5), 100)
+        return True
+
+
+CODECS = {c.name: c for c in (Opus, PCM16)}   # por preferencia
+BY_PT = {c.pt: c for c in CODECS.values()}
+
+
+def available():
+    """Nombres de los códecs usables aquí, del preferido al último."""
+    return [name for name, c in CODECS.items() if c is not Opus or opuslib is not None]
+
+
+def negotiate(offer, local=None):
+    """Primer códec de la oferta (texto "opus,pcm" o lista) que también hay aquí."""
+    if isinstance(offer, str):
+        offer = [c for c in offer.split(",") if c]
+    local = available() if local is None else local
+    for name in offer:
+        if name in local:
+            return name
+    return PCM16.name
+
+
+def create(name):
+    """Códec listo para una llamada; PCM si el nombre no se conoce."""
+    return CODECS.get(name, PCM16)()
+
+
+def for_pt(pt):
+    """Clase del códec de un tipo de payload, o None si no se conoce."""
+    return BY_PT.get(pt)
+
+
+# --- Paridad XOR (FEC para cualquier códec) ---
+# Cada N tramas el emisor manda una más con tipo PARITY_PT: el XOR de las N
+# (rellenas con ceros hasta la más larga) y el XOR de sus longitudes. Lleva
+# el seq y el timestamp de la primera del grupo. Si se pierde una sola de las
+# N, sale de la paridad y las otras N-1. Cuesta 1/N más de ancho de banda.
+
+PARITY_PT = 127   # no es un códec
+_PARITY_HDR = struct.Struct("!BH")  # tramas del grupo, XOR de longitudes
+
+
+def _xor_into(acc, payload, size):
+    return acc ^ (int.from_bytes(payload, "big") << (8 * (size - len(payload))))
+
+
+def parity(payloads):
+    """Payload de paridad de un grupo de tramas (payloads ya codificados)."""
+    size = max(map(len, payloads))
+    acc = lens = 0
+    for p in payloads:
+        acc = _xor_into(acc, p, size)
+        lens ^= len(p)
+    return _PARITY_HDR.pack(len(payloads), lens) + acc.to_bytes(size, "big")
+
+
+def parity_count(par):
+    """Cuántas tramas cubre una paridad."""
+    return par[0]
+
+
+def from_parity(par, others):
+    """La trama que falta de un grupo, dada su paridad y las otras N-1."""
+    _, lens = _PARITY_HDR.unpack_from(par)
+    body = par[_PARITY_HDR.size:]
+    size = len(body)
+    acc = int.from_bytes(body, "big")
+    for p in others:
+        if len(p) > size:
+            return None
+        acc = _xor_into(acc, p, size)
+        lens ^= len(p)
+    if lens > size:
+        return None
+    return acc.to_bytes(size, "big")[:lens]
+
+
+# --- Ocultación de pérdidas (PLC) ---
+# Sustitución de forma de onda: para un hueco se repite el último periodo de
+# tono de lo ya reproducido, con la fase continua si se pierden varias
+# seguidas y bajando el volumen trama a trama según PLC_FADE; después,
+# silencio. La primera trama buena tras un hueco entra con un fundido cruzado
+# de PLC_OVERLAP muestras, sin chasquido. El periodo es el desplazamiento
+# entre PITCH_MIN y PITCH_MAX que mejor encaja los últimos PITCH_WINDOW
+# (correlación normalizada: NumPy, o audioop.findfit, que hace lo mismo en C);
+# sin ninguno de los dos se repite la última trama entera. Solo corre cuando
+# falta una trama, en el hilo de reproducción.
+
+PLC_FADE = (1.0, 0.7, 0.4, 0.15, 0.0)   # ganancia al final de cada trama seguida
+PLC_OVERLAP = 40      # 2,5 ms
+PITCH_MIN = 40        # 2,5 ms: 400 Hz
+PITCH_MAX = 320       # 20 ms: 50 Hz
+PITCH_WINDOW = 160    # 10 ms
+PLC_HISTORY = PITCH_MAX + PITCH_WINDOW
+
+
+def _pitch_numpy(hist):
+    x = np.frombuffer(hist, dtype=np.int16).astype(np.float64)
+    ref = x[-PITCH_WINDOW:]
+    frag = x[-(PITCH_WINDOW + PITCH_MAX):-PITCH_MIN]
+    dots = np.correlate(frag, ref, "valid")
+    sq = np.concatenate(([0.0], np.cumsum(frag * frag)))
+    energy = sq[PITCH_WINDOW:] - sq[:-PITCH_WINDOW]
+    score = np.where((dots > 0) & (energy > 0), dots * dots / np.maximum(energy, 1.0), -1.0)
+    best = int(np.argmax(score))
+    return PITCH_MAX - best if score[best] > 0 else FRAME_SAMPLES
+
+
+def _pitch_audioop(hist):
+    ref = hist[-2 * PITCH_WINDOW:]
+    frag = hist[-2 * (PITCH_WINDOW + PITCH_MAX):-2 * PITCH_MIN]
+    best, factor = audioop.findfit(frag, ref)
+    return PITCH_MAX - best if factor > 0 else FRAME_SAMPLES
+
+
+def _pitch_python(hist):
+    return FRAME_SAMPLES
+
+
+PITCH_BACKENDS = {"numpy": _pitch_numpy, "audioop": _pitch_audioop, "python": _pitch_python}
+PITCH_BACKEND = "numpy" if np is not None else "audioop" if audioop is not None else "python"
+
+
+class Concealer:
+    """Tapa los huecos de una secuencia de tramas PCM de 20 ms."""
+
+    def __init__(self, frame_samples=FRAME_SAMPLES, backend=None):
+        self.frame_samples = frame_samples
+        self._pitch = PITCH_BACKENDS[backend or PITCH_BACKEND]
+        self.reset()
+
+    def reset(self):
+        self._hist = bytes(2 * PLC_HISTORY)  # lo último reproducido
+        self._lost = 0     # tramas ocultadas seguidas
+        self._period = FRAME_SAMPLES
+        self._phase = 0
+        self.concealed = 0
+
+    def good(self, pcm):
+        """Trama de verdad: se guarda y, si viene tras un hueco, se funde con él."""
+        if self._lost:
+            if self._lost < len(PLC_FADE):
+                gain = PLC_FADE[self._lost - 1]
+                tail = self._synth(PLC_OVERLAP, gain, gain)
+                x = array.array('h', pcm)
+                n = min(PLC_OVERLAP, len(x))
+                for i in range(n):
+                    w = (i + 1) / (n + 1)
+                    x[i] = int(x[i] * w + tail[i] * (1 - w))
+                pcm = x.tobytes()
+            self._lost = 0
+        self._hist = (self._hist + pcm)[-2 * PLC_HISTORY:]
+        return pcm
+
+    def conceal(self, pcm=None):
+        """Trama para un hueco: la del PLC del códec si la hay (pcm), o sintetizada."""
+        self.concealed += 1
+        if pcm is not None:
+            self._lost = 0
+            return self.good(pcm)
+        k = self._lost
+        self._lost += 1
+        if k >= len(PLC_FADE):
+            return bytes(2 * self.frame_samples)
+        if k == 0:
+            self._period = self._pitch(self._hist)
+            self._phase = 0
+        return self._synth(self.frame_samples, PLC_FADE[k - 1] if k else 1.0,
+                           PLC_FADE[k]).tobytes()
+
+    def _synth(self, count, g0, g1):
+        hist = array.array('h', self._hist)
+        period = self._period
+        base = len(hist) - period
+        phase = self._phase
+        step = (g1 - g0) / count
+        out = array.array('h', [int(hist[base + (phase + i) % period] * (g0 + step * i))
+                                for i in range(count)])
+        self._phase = (phase + count) % period
+        return out
@@ -0,0 +1,668 @@
+# loadgen.py - Generador de carga y benchmarks locales para svr.py
+#
+# Dos modos:
+#
+#   calls  (por defecto) N clientes virtuales que hablan el protocolo real:
+#          REGISTER, PING cada 10 s, LIST, CALL/ACCEPT, audio cada 20 ms
+#          (AUDIO_B64 o tramas binarias) y BYE. Las llamadas llegan con una
+#          tasa configurable (Poisson) y duran --call-duration segundos.
+#          Mide latencia de reenvío (p50/p99/p999), pérdida, paquetes por
+#          segundo reenviados y CPU/RSS del servidor.
+#
+#   flood  inunda el relay binario con parejas ya establecidas desde varios
+#          procesos, para ver el techo de paquetes por segundo (--workers).
+#          El servidor debe ir con --admit off (--spawn lo añade solo).
+#
+# Con --nodes N (y --spawn) arranca N nodos svr.py en clúster en puertos
+# consecutivos y reparte los clientes entre ellos: la mayoría de llamadas
+# cruzan de nodo. Además de la latencia total da la de reenvío entre nodos
+# (latency_cross_ms) y el tiempo de establecimiento (CALL -> ACCEPT_FROM).
+#
+# Con --noise-rate, un proceso aparte inunda el servidor con basura (PING de
+# números al azar, comandos desconocidos) desde otra IP de loopback mientras
+# corre calls: la latencia de los clientes buenos debe seguir plana.
+#
+# Todo corre en una sola máquina sobre loopback. Con --spawn arranca él mismo
+# svr.py (y mide su CPU/RSS); con --suite ejecuta un conjunto fijo de escenarios
+# y escribe un único JSON para comparar entre versiones.
+#
+#   python loadgen.py --spawn --clients 200 --call-rate 5 --duration 20 --out res.json
+#   python loadgen.py --suite --out bench.json
+#   python svr.py --workers 4 --admit off &  python loadgen.py --mode flood --pairs 200 --procs 4
+#   python loadgen.py --spawn --noise-rate 20000 --noise-sources 50 --duration 20
+#   python loadgen.py --spawn --nodes 3 --audio b64 --clients 300 --call-rate 10
+
+import argparse
+import base64
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+MEDIA_HDR = struct.Struct("!BBHII")
+MEDIA_VERSION = 1
+PROBE = struct.Struct("!QI")  # instante de envío (ns), seq: al principio del PCM
+FRAME_BYTES = 640             # 20 ms de PCM 16 kHz mono int16
+FRAME_S = 0.02
+
+SVR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "svr.py")
+
+
+# --- Medidas del proceso servidor ---
+
+def _proc_tree(pid):
+    pids = [pid]
+    try:
+        for d in os.listdir("/proc"):
+            if d.isdigit():
+                try:
+                    with open(f"/proc/{d}/stat") as f:
+                        if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                            pids.append(int(d))
+                except (OSError, IndexError, ValueError):
+                    pass
+    except OSError:
+        pass
+    return pids
+
+
+def _server_pids(server_pid):
+    # server_pid: pid, lista de pids (uno por nodo) o None
+    roots = server_pid if isinstance(server_pid, list) else [server_pid] if server_pid else []
+    return [p for root in roots for p in _proc_tree(root)]
+
+
+def _cpu_seconds(pids):
+    tick = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / tick
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def _rss_mb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024.0
+
+
+def spawn_server(port, extra_args=()):
+    proc = subprocess.Popen([sys.executable, SVR, "--host", "127.0.0.1", "--port", str(port), *extra_args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0.2)
+    for _ in range(50):
+        s.sendto(b"PING:__loadgen__", ("127.0.0.1", port))
+        try:
+            if s.recvfrom(64)[0] == b"PONG":
+                break
+        except socket.timeout:
+            pass
+    s.sendto(b"UNREGISTER:__loadgen__", ("127.0.0.1", port))
+    s.close()
+    return proc
+
+
+def spawn_cluster(port, n, extra_args=()):
+    """n nodos en port..port+n-1 que se conocen entre sí. Devuelve los procesos."""
+    nodes = ",".join(f"127.0.0.1:{port + i}" for i in range(n))
+    procs = [spawn_server(port + i, ["--cluster", nodes, *extra_args]) for i in range(n)]
+    time.sleep(1.5)  # un latido para que todos se vean y se pidan el estado
+    return procs
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    samples.sort()
+    n = len(samples)
+
+    def pct(p):
+        return round(samples[min(n - 1, int(p * n))] * 1000, 3)
+
+    return {"p50": pct(0.50), "p99": pct(0.99), "p999": pct(0.999),
+            "max": round(samples[-1] * 1000, 3), "samples": n}
+
+
+# --- Modo calls: clientes virtuales ---
+
+class VClient:
+    __slots__ = ("number", "server", "sock", "state", "peer", "sid", "call", "seq", "t_call")
+
+    def __init__(self, number, server):
+        self.number = number
+        self.server = server  # nodo en el que se registra
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.setblocking(False)
+        self.state = "idle"
+        self.peer = None
+        self.sid = 0
+        self.call = None
+        self.seq = 0
+        self.t_call = 0.0
+
+
+class Call:
+    __slots__ = ("caller", "callee", "end_at", "sent", "rx")
+
+    def __init__(self, caller, callee, end_at):
+        self.caller = caller
+        self.callee = callee
+        self.end_at = end_at
+        self.sent = 0
+        self.rx = set()  # (dirección, seq) únicos recibidos
+
+
+class CallsBench:
+    def __init__(self, server, clients=100, call_rate=2.0, call_duration=10.0,
+                 audio="binary", list_interval=20.0, base=8000000):
+        # server: (host, puerto) o una lista de nodos, que se reparten los clientes
+        servers = server if isinstance(server, list) else [server]
+        self.servers = servers
+        self.call_rate = call_rate
+        self.call_duration = call_duration
+        self.audio = audio
+        self.list_interval = list_interval
+        self.sel = selectors.DefaultSelector()
+        self.clients = [VClient(str(base + i), servers[i % len(servers)]) for i in range(clients)]
+        self.by_number = {c.number: c for c in self.clients}
+        for c in self.clients:
+            self.sel.register(c.sock, selectors.EVENT_READ, c)
+        self.timers = []
+        self._tseq = 0
+        self.calls = []
+        self.latency = []
+        self.latency_cross = []  # las de llamadas entre clientes de nodos distintos
+        self.setup = []
+        self.stats = {"calls_attempted": 0, "calls_connected": 0, "calls_offline": 0,
+                      "calls_completed": 0, "signaling_sent": 0, "signaling_recv": 0,
+                      "frames_sent": 0, "datagrams_recv": 0, "calls_cross_node": 0}
+        self._pcm_pad = b"\0" * (FRAME_BYTES - PROBE.size)
+
+    def _at(self, when, fn, *args):
+        self._tseq += 1
+        heapq.heappush(self.timers, (when, self._tseq, fn, args))
+
+    def _send(self, c, text):
+        self.stats["signaling_sent"] += 1
+        try:
+            c.sock.sendto(text.encode(), c.server)
+        except OSError:
+            pass
+
+    # --- ciclo de vida ---
+
+    def _ping(self, c, now):
+        self._send(c, f"PING:{c.number}")
+        self._at(now + 10.0, self._ping, c)
+
+    def _list(self, c, now):
+        self._send(c, "LIST")
+        self._at(now + self.list_interval, self._list, c)
+
+    def _new_call(self, now):
+        idle = [c for c in random.sample(self.clients, min(8, len(self.clients))) if c.state == "idle"]
+        if len(idle) >= 2:
+            a, b = idle[0], idle[1]
+            a.state, b.state = "calling", "ringing"
+            a.peer, b.peer = b.number, a.number
+            self.stats["calls_attempted"] += 1
+            a.t_call = now
+            self._send(a, f"CALL:{b.number}:{a.number}")
+        self._at(now + random.expovariate(self.call_rate), self._new_call)
+
+    def _connect(self, caller, sid, now):
+        callee = self.by_number.get(caller.peer)
+        if callee is None:
+            return
+        call = Call(caller, callee, now + self.call_duration)
+        caller.call = callee.call = call
+        caller.state = callee.state = "in_call"
+        caller.sid = sid
+        self.calls.append(call)
+        self.stats["calls_connected"] += 1
+        self.setup.append(now - caller.t_call)
+        if caller.server != callee.server:
+            self.stats["calls_cross_node"] += 1
+
+    def _hangup(self, c):
+        call = c.call
+        if call is None:
+            return
+        self._send(c, f"BYE:{c.peer}:{c.number}")
+        for x in (call.caller, call.callee):
+            x.state, x.peer, x.sid, x.call = "idle", None, 0, None
+        self.stats["calls_completed"] += 1
+
+    def _audio_tick(self, now):
+        ns = time.perf_counter_ns()
+        for c in self.clients:
+            call = c.call
+            if call is None or c.state != "in_call":
+                continue
+            if c is call.caller and now >= call.end_at:
+                self._hangup(c)
+                continue
+            c.seq += 1
+            pcm = PROBE.pack(ns, c.seq) + self._pcm_pad
+            if self.audio == "binary" and c.sid:
+                data = MEDIA_HDR.pack(0x80 | MEDIA_VERSION, 0, c.seq & 0xFFFF,
+                                      (c.seq * 320) & 0xFFFFFFFF, c.sid) + pcm
+            else:
+                data = f"AUDIO_B64:{c.peer}:{c.number}:".encode() + base64.b64encode(pcm)
+            try:
+                c.sock.sendto(data, c.server)
+                call.sent += 1
+                self.stats["frames_sent"] += 1
+            except OSError:
+                pass
+        self._at(now + FRAME_S, self._audio_tick)
+
+    def _on_audio(self, c, pcm, now_ns):
+        call = c.call
+        if call is None or len(pcm) < PROBE.size:
+            return
+        sent_ns, seq = PROBE.unpack_from(pcm)
+        key = (c is call.caller, seq)
+        if key in call.rx:
+            return  # copia redundante
+        call.rx.add(key)
+        self.latency.append((now_ns - sent_ns) / 1e9)
+        if call.caller.server != call.callee.server:
+            self.latency_cross.append((now_ns - sent_ns) / 1e9)
+
+    def _on_datagram(self, c, data, now):
+        self.stats["datagrams_recv"] += 1
+        if data[0] >= 0x80:
+            self._on_audio(c, data[MEDIA_HDR.size:], time.perf_counter_ns())
+            return
+        self.stats["signaling_recv"] += 1
+        if data.startswith(b"AUDIO_FROM_B64:"):
+            try:
+                pcm = base64.b64decode(data.rsplit(b":", 1)[-1])
+            except Exception:
+                return
+            self._on_audio(c, pcm, time.perf_counter_ns())
+        elif data.startswith(b"CALL_FROM:"):
+            if c.state == "ringing":
+                self._send(c, f"ACCEPT:{c.peer}:{c.number}")
+                c.state = "accepted"
+        elif data.startswith(b"SESSION:"):
+            try:
+                c.sid = int(data.split(b":")[1])
+            except ValueError:
+                pass
+        elif data.startswith(b"ACCEPT_FROM:"):
+            if c.state == "calling":
+                parts = data.split(b":")
+                sid = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else 0
+                self._connect(c, sid, now)
+        elif data.startswith(b"OFFLINE:"):
+            if c.state in ("calling", "ringing"):
+                self.stats["calls_offline"] += 1
+                peer = self.by_number.get(c.peer)
+                for x in (c, peer):
+                    if x is not None and x.state != "in_call":
+                        x.state, x.peer = "idle", None
+        elif data.startswith(b"BYE_FROM:"):
+            pass
+
+    # --- ejecución ---
+
+    def run(self, duration, server_pid=None):
+        now = time.monotonic()
+        for i, c in enumerate(self.clients):
+            self._send(c, f"REGISTER:{c.number}:{c.sock.getsockname()[1]}:vc{i}")
+            self._at(now + random.uniform(0, 10), self._ping, c)
+            if self.list_interval > 0:
+                self._at(now + random.uniform(0, self.list_interval), self._list, c)
+        self._at(now + 0.5, self._new_call)
+        self._at(now + 0.5, self._audio_tick)
+
+        pids = _server_pids(server_pid)
+        cpu0 = _cpu_seconds(pids)
+        rss_max = _rss_mb(pids)
+        t0 = time.monotonic()
+        end = t0 + duration
+        next_sample = t0 + 1.0
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            while self.timers and self.timers[0][0] <= now:
+                _, _, fn, args = heapq.heappop(self.timers)
+                fn(*args, now)
+            timeout = max(0.0, min(end, self.timers[0][0] if self.timers else end) - time.monotonic())
+            for key, _ in self.sel.select(timeout):
+                c = key.data
+                while True:
+                    try:
+                        data = c.sock.recv(65535)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        break
+                    if data:
+                        self._on_datagram(c, data, now)
+            if pids and now >= next_sample:
+                rss_max = max(rss_max, _rss_mb(pids))
+                next_sample = now + 1.0
+        elapsed = time.monotonic() - t0
+        cpu = _cpu_seconds(pids) - cpu0 if pids else None
+
+        for c in self.clients:
+            self._send(c, f"UNREGISTER:{c.number}")
+            self.sel.unregister(c.sock)
+            c.sock.close()
+
+        sent = sum(call.sent for call in self.calls)
+        got = sum(len(call.rx) for call in self.calls)
+        res = dict(self.stats)
+        res.update({
+            "clients": len(self.clients),
+            "nodes": len(self.servers),
+            "audio": self.audio,
+            "duration_s": round(elapsed, 3),
+            "frames_delivered": got,
+            "relay_pps": round(got / elapsed, 1),
+            "loss": round(1 - got / sent, 4) if sent else 0.0,
+            "latency_ms": _percentiles(self.latency),
+            "setup_ms": _percentiles(self.setup),
+        })
+        if len(self.servers) > 1:
+            res["latency_cross_ms"] = _percentiles(self.latency_cross)
+        if pids:
+            res["server_cpu_pct"] = round(100 * cpu / elapsed, 1)
+            res["server_rss_mb"] = round(rss_max, 1)
+        return res
+
+
+# --- Modo flood: relay binario a tope ---
+
+def _drain(sock, timeout=0.3):
+    out = []
+    sock.settimeout(timeout)
+    try:
+        while True:
+            out.append(sock.recvfrom(65535)[0])
+    except (socket.timeout, BlockingIOError):
+        pass
+    return out
+
+
+def _udp():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    return s
+
+
+def setup_pairs(server, n, base=7000000):
+    """Registra 2*n clientes y establece n llamadas. Devuelve [(a, b, sid)]."""
+    pairs = []
+    for i in range(n):
+        na, nb = str(base + 2 * i), str(base + 2 * i + 1)
+        a, b = _udp(), _udp()
+        a.sendto(f"REGISTER:{na}:{a.getsockname()[1]}:lg".encode(), server)
+        b.sendto(f"REGISTER:{nb}:{b.getsockname()[1]}:lg".encode(), server)
+        _drain(a, 0.05)
+        _drain(b, 0.05)
+        a.sendto(f"CALL:{nb}:{na}".encode(), server)
+        _drain(b, 0.05)
+        b.sendto(f"ACCEPT:{na}:{nb}".encode(), server)
+        sid = 0
+        for m in _drain(a, 0.1):
+            if m.startswith(b"ACCEPT_FROM:"):
+                sid = int(m.split(b":")[2])
+        if sid:
+            pairs.append((a, b, sid))
+    return pairs
+
+
+def _flood_worker(server, socks, duration, payload_len, q):
+    # socks: [(fd_a, fd_b, sid)] heredados por fork
+    pairs = [(socket.socket(fileno=fa), socket.socket(fileno=fb), sid) for fa, fb, sid in socks]
+    for _, b, _ in pairs:
+        b.setblocking(False)
+    payload = b"\0" * payload_len
+    sent = recv = 0
+    seq = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for a, b, sid in pairs:
+            a.sendto(MEDIA_HDR.pack(0x80 | MEDIA_VERSION, 0, seq & 0xFFFF, seq * 320 & 0xFFFFFFFF, sid) + payload, server)
+            sent += 1
+        seq += 1
+        for _, b, _ in pairs:
+            try:
+                while True:
+                    b.recv(65535)
+                    recv += 1
+            except BlockingIOError:
+                pass
+    time.sleep(0.2)
+    for _, b, _ in pairs:
+        try:
+            while True:
+                b.recv(65535)
+                recv += 1
+        except BlockingIOError:
+            pass
+    q.put((sent, recv))
+
+
+def flood(server, pairs, duration=5.0, procs=1, payload_len=640, server_pid=None):
+    ctx = multiprocessing.get_context("fork")
+    q = ctx.Queue()
+    chunks = [pairs[i::procs] for i in range(procs)]
+    pids = _server_pids(server_pid)
+    cpu0 = _cpu_seconds(pids)
+    ps = []
+    for chunk in chunks:
+        fds = [(a.fileno(), b.fileno(), sid) for a, b, sid in chunk]
+        p = ctx.Process(target=_flood_worker, args=(server, fds, duration, payload_len, q))
+        p.start()
+        ps.append(p)
+    sent = recv = 0
+    for _ in ps:
+        s, r = q.get()
+        sent += s
+        recv += r
+    for p in ps:
+        p.join()
+    res = {
+        "pairs": len(pairs),
+        "procs": procs,
+        "duration_s": duration,
+        "sent": sent,
+        "relayed": recv,
+        "relay_pps": round(recv / duration, 1),
+        "loss": round(1 - recv / sent, 4) if sent else 0.0,
+    }
+    if pids:
+        res["server_cpu_pct"] = round(100 * (_cpu_seconds(pids) - cpu0) / duration, 1)
+        res["server_rss_mb"] = round(_rss_mb(pids), 1)
+    return res
+
+
+# --- Ruido: inundación de señalización basura ---
+
+def _noise_worker(server, rate, sources, ip, duration):
+    socks = []
+    for _ in range(sources):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind((ip, 0))
+        s.setblocking(False)
+        socks.append(s)
+    rnd = random.Random()
+    msgs = [b"PING:%d" % rnd.randrange(10 ** 9) for _ in range(256)]
+    msgs += [b"GARBAGE:%d" % i for i in range(64)]
+    msgs += [b"CALL:%d:%d" % (rnd.randrange(10 ** 9), rnd.randrange(10 ** 9)) for _ in range(64)]
+    tick = 0.01
+    per_tick = max(1, int(rate * tick))
+    end = time.monotonic() + duration
+    nxt = time.monotonic()
+    i = 0
+    while nxt < end:
+        for _ in range(per_tick):
+            try:
+                socks[i % sources].sendto(msgs[i % len(msgs)], server)
+            except OSError:
+                pass
+            i += 1
+        nxt += tick
+        time.sleep(max(0.0, nxt - time.monotonic()))
+
+
+def start_noise(server, rate, sources=20, ip="127.0.0.2", duration=10.0):
+    if rate <= 0:
+        return None
+    p = multiprocessing.get_context("fork").Process(
+        target=_noise_worker, args=(server, rate, sources, ip, duration), daemon=True)
+    p.start()
+    return p
+
+
+# --- Suite ---
+
+SUITE = [
+    # (nombre, argumentos de svr.py, audio, datagramas/s de ruido, nodos)
+    ("threads-b64", [], "b64", 0, 1),
+    ("threads-binary", [], "binary", 0, 1),
+    ("threads-binary-record", ["--record", os.path.join(tempfile.gettempdir(), "loadgen-record")],
+     "binary", 0, 1),
+    ("asyncio-b64", ["--asyncio"], "b64", 0, 1),
+    ("asyncio-binary", ["--asyncio"], "binary", 0, 1),
+    ("threads-binary-noise", [], "binary", 20000, 1),
+    ("threads-binary-noise-noadmit", ["--admit", "off"], "binary", 20000, 1),
+    ("asyncio-binary-noise", ["--asyncio"], "binary", 20000, 1),
+    ("asyncio-b64-cluster3", ["--asyncio"], "b64", 0, 3),
+]
+
+
+def run_suite(args):
+    results = {"meta": {"time": int(time.time()), "python": sys.version.split()[0],
+                        "clients": args.clients, "call_rate": args.call_rate,
+                        "duration_s": args.duration}, "scenarios": {}}
+    port = args.port
+    for name, svr_args, audio, noise, nodes in SUITE:
+        port += 1
+        if nodes > 1:
+            procs = spawn_cluster(port, nodes, svr_args + args.server_arg)
+        else:
+            procs = [spawn_server(port, svr_args + args.server_arg)]
+        servers = [("127.0.0.1", port + i) for i in range(nodes)]
+        port += nodes - 1
+        try:
+            bench = CallsBench(servers, args.clients, args.call_rate,
+                               args.call_duration, audio, args.list_interval)
+            start_noise(servers[0], noise, args.noise_sources, args.noise_ip,
+                        args.duration)
+            res = bench.run(args.duration, [p.pid for p in procs])
+            res["server_args"] = svr_args + args.server_arg
+            res["noise_rate"] = noise
+            results["scenarios"][name] = res
+            print(f"[{name}] relay_pps={res['relay_pps']} loss={res['loss']} "
+                  f"p99={res['latency_ms'].get('p99')}ms cpu={res.get('server_cpu_pct')}%")
+        finally:
+            for p in procs:
+                p.terminate()
+                p.wait()
+    return results
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Generador de carga para svr.py")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=24646)
+    ap.add_argument("--mode", choices=("calls", "flood"), default="calls")
+    ap.add_argument("--duration", type=float, default=10.0)
+    ap.add_argument("--out", help="fichero JSON de resultados")
+    ap.add_argument("--spawn", action="store_true", help="arrancar svr.py y medir su CPU/RSS")
+    ap.add_argument("--server-arg", action="append", default=[],
+                    help="argumento extra para svr.py con --spawn/--suite (repetible)")
+    ap.add_argument("--server-pid", type=int, help="pid de un svr.py ya arrancado (CPU/RSS)")
+    ap.add_argument("--suite", action="store_true", help="ejecutar todos los escenarios de SUITE")
+    # calls
+    ap.add_argument("--clients", type=int, default=100)
+    ap.add_argument("--call-rate", type=float, default=2.0, help="llamadas nuevas por segundo")
+    ap.add_argument("--call-duration", type=float, default=10.0)
+    ap.add_argument("--audio", choices=("binary", "b64"), default="binary")
+    ap.add_argument("--list-interval", type=float, default=20.0, help="0 = no enviar LIST")
+    ap.add_argument("--nodes", type=int, default=1,
+                    help="nodos en clúster (puertos consecutivos desde --port)")
+    # flood
+    ap.add_argument("--pairs", type=int, default=50)
+    ap.add_argument("--procs", type=int, default=1)
+    # ruido
+    ap.add_argument("--noise-rate", type=float, default=0,
+                    help="datagramas/s de basura durante calls (0 = sin ruido)")
+    ap.add_argument("--noise-sources", type=int, default=20, help="sockets emisores de ruido")
+    ap.add_argument("--noise-ip", default="127.0.0.2", help="IP local desde la que sale el ruido")
+    args = ap.parse_args(argv)
+
+    if args.suite:
+        res = run_suite(args)
+    else:
+        svr_args = list(args.server_arg)
+        if args.mode == "flood" and "--admit" not in svr_args:
+            svr_args += ["--admit", "off"]  # el flood es un solo origen a tope
+        if not args.spawn:
+            procs = []
+        elif args.nodes > 1:
+            procs = spawn_cluster(args.port, args.nodes, svr_args)
+        else:
+            procs = [spawn_server(args.port, svr_args)]
+        pid = [p.pid for p in procs] if procs else args.server_pid
+        host = "127.0.0.1" if procs else args.host
+        servers = [(host, args.port + i) for i in range(args.nodes)]
+        server = servers[0]
+        try:
+            if args.mode == "flood":
+                pairs = setup_pairs(server, args.pairs)
+                if not pairs:
+                    raise SystemExit("no se pudo establecer ninguna llamada")
+                res = flood(server, pairs, args.duration, args.procs, server_pid=pid)
+            else:
+                bench = CallsBench(servers, args.clients, args.call_rate, args.call_duration,
+                                   args.audio, args.list_interval)
+                start_noise(server, args.noise_rate, args.noise_sources, args.noise_ip,
+                            args.duration)
+                res = bench.run(args.duration, pid)
+                res["noise_rate"] = args.noise_rate
+        finally:
+            for p in procs:
+                p.terminate()
+                p.wait()
+
+    text = json.dumps(res, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
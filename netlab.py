@@ -0,0 +1,267 @@
+# netlab.py - Laboratorio de red con namespaces de Linux para el camino directo
+#
+# Monta cuatro namespaces unidos por veth y hace una llamada entre dos
+# clientes win_client.VoIPClient sin interfaz ni tarjeta de sonido:
+#
+#   a  10.77.1.2 ─┐                    ┌─ s  10.77.3.2  svr.py
+#                 r  (router) ─ delay ─┘
+#   b  10.77.2.2 ─┘
+#
+# El servidor está "lejos" (--server-delay-ms en cada sentido del enlace r-s),
+# así que por el relay el audio cruza ese enlace dos veces y directo ninguna.
+# No hay NAT (sin iptables); lo que haría un NAT simétrico, que no quede
+# camino entre a y b, se simula con rutas blackhole entre sus redes.
+#
+#   sudo python netlab.py                   # hole punching: el audio va directo
+#   sudo python netlab.py --no-direct       # sin camino a-b: todo por el relay
+#   sudo python netlab.py --cut-after 4     # el camino directo se cae a mitad
+#
+# Cada trama lleva en el payload (PCM) el instante de envío: se imprime por
+# segundo el retardo de boca a oreja de red (hasta el anti-jitter) y por dónde
+# iba, y al final cuántas tramas reenvió el servidor. Necesita root e iproute2.
+
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+NS = ("voiplab-a", "voiplab-b", "voiplab-r", "voiplab-s")
+NETS = {"a": 1, "b": 2, "s": 3}
+SERVER_IP = "10.77.3.2"
+PORT = 24646
+METRICS = "/tmp/netlab-metrics.txt"
+
+
+def _ip(*args, check=True):
+    subprocess.run(["ip", *args], check=check, stderr=subprocess.DEVNULL if not check else None)
+
+
+def _in(ns, *cmd):
+    return ["ip", "netns", "exec", ns, *cmd]
+
+
+def teardown():
+    for ns in NS:
+        _ip("netns", "del", ns, check=False)
+
+
+def setup(delay_ms):
+    teardown()
+    for ns in NS:
+        _ip("netns", "add", ns)
+        _ip("-n", ns, "link", "set", "lo", "up")
+    for side, net in NETS.items():
+        ns = f"voiplab-{side}"
+        _ip("-n", "voiplab-r", "link", "add", f"r-{side}", "type", "veth",
+            "peer", "name", "eth0", "netns", ns)
+        _ip("-n", "voiplab-r", "addr", "add", f"10.77.{net}.1/24", "dev", f"r-{side}")
+        _ip("-n", "voiplab-r", "link", "set", f"r-{side}", "up")
+        _ip("-n", ns, "addr", "add", f"10.77.{net}.2/24", "dev", "eth0")
+        _ip("-n", ns, "link", "set", "eth0", "up")
+        _ip("-n", ns, "route", "add", "default", "via", f"10.77.{net}.1")
+    subprocess.run(_in("voiplab-r", "sysctl", "-qw", "net.ipv4.ip_forward=1"), check=True)
+    if delay_ms:
+        for ns, dev in (("voiplab-r", "r-s"), ("voiplab-s", "eth0")):
+            r = subprocess.run(_in(ns, "tc", "qdisc", "add", "dev", dev, "root", "netem",
+                                   "delay", f"{delay_ms}ms"), stderr=subprocess.DEVNULL)
+            if r.returncode:
+                print("aviso: sin sch_netem en el kernel, el servidor no está más lejos",
+                      file=sys.stderr)
+                return 0
+    return delay_ms
+
+
+def cut_direct():
+    # lo que no atraviesa un NAT simétrico: a y b no se ven, el servidor sí
+    _ip("-n", "voiplab-a", "route", "add", "blackhole", "10.77.2.0/24")
+    _ip("-n", "voiplab-b", "route", "add", "blackhole", "10.77.1.0/24")
+
+
+# --- Un extremo de la llamada (dentro de su namespace) ---
+
+class HeadlessUI:
+    speaker_on = True
+    muted = False
+
+    def __init__(self):
+        self.client = None
+
+    def on_incoming_call(self, caller, name):
+        # desde el hilo de escucha: aceptar en otro para no bloquearlo
+        threading.Timer(0.1, self.client.accept, args=(caller,)).start()
+
+    def __getattr__(self, name):
+        return lambda *a, **k: None
+
+
+def run_peer(args):
+    import win_client
+
+    win_client.PYAUDIO_AVAILABLE = False  # sin tarjeta: los hilos de audio se arrancan aquí
+    ui = HeadlessUI()
+    c = ui.client = win_client.VoIPClient(args.server, args.port, args.me, args.me, ui)
+    c._register()
+    deadline = time.time() + 10
+    while not c.connected and time.time() < deadline:
+        time.sleep(0.05)
+    if args.role == "caller":
+        time.sleep(0.5)
+        c.call(args.peer)
+    while not c.in_call and time.time() < deadline:
+        time.sleep(0.05)
+    if not c.in_call:
+        print(json.dumps({"me": args.me, "error": "sin llamada"}), flush=True)
+        return 1
+
+    lat = []
+    put = c.jitter.put
+
+    def timed_put(seq, ts, pt, data, now=None):
+        if len(data) >= 8:
+            t = time.time()
+            lat.append((t - t0, (t - struct.unpack_from("!d", data)[0]) * 1000))
+        return put(seq, ts, pt, data, now)
+
+    c.jitter.put = timed_put
+    threading.Thread(target=c._audio_encode_worker, daemon=True).start()
+    threading.Thread(target=c._audio_playback_worker, daemon=True).start()
+    print("READY", flush=True)
+    t0 = time.time()
+    paths = []
+    n = int(args.seconds * 50)
+    for i in range(n):
+        if i % 50 == 0:
+            paths.append("directo" if c.p2p_addr else "relay")
+        frame = struct.pack("!d", time.time()).ljust(640, b"\x01")
+        c.encode_queue.put((frame, 320), timeout=1)
+        wait = t0 + (i + 1) * 0.02 - time.time()
+        if wait > 0:
+            time.sleep(wait)
+    time.sleep(1.0)
+    res = {"me": args.me, "sent": n, "received": len(lat), "paths": paths,
+           "p2p_rtt_ms": round(c.p2p_rtt * 1000, 2) if c.p2p_rtt else None,
+           "latency_ms": {}}
+    for t, ms in lat:
+        res["latency_ms"].setdefault(int(t), []).append(ms)
+    res["latency_ms"] = {k: round(sorted(v)[len(v) // 2], 1) for k, v in res["latency_ms"].items()}
+    if args.role == "caller":
+        c.hangup()
+    print(json.dumps(res), flush=True)
+    return 0
+
+
+# --- Orquestación ---
+
+def _metric(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[-1])
+    return 0.0
+
+
+def run_lab(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    me = os.path.abspath(__file__)
+    procs = []
+    try:
+        delay = setup(args.server_delay_ms)
+        if args.no_direct:
+            cut_direct()
+        if os.path.exists(METRICS):
+            os.remove(METRICS)
+        srv = subprocess.Popen(_in("voiplab-s", sys.executable, os.path.join(here, "svr.py"),
+                                   "--port", str(PORT), "--metrics-file", METRICS,
+                                   "--metrics-interval", "0.5"),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(srv)
+        time.sleep(1.0)
+        peers = {}
+        for side, role, num, other in (("b", "callee", "1002", "1001"), ("a", "caller", "1001", "1002")):
+            peers[side] = subprocess.Popen(
+                _in(f"voiplab-{side}", sys.executable, me, "--role", role, "--server", SERVER_IP,
+                    "--port", str(PORT), "--me", num, "--peer", other, "--seconds", str(args.seconds)),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if not args.verbose else None,
+                text=True)
+            procs.append(peers[side])
+            time.sleep(0.3)
+        if peers["a"].stdout.readline().strip() != "READY":
+            raise SystemExit("la llamada no llegó a establecerse")
+        if args.cut_after:
+            time.sleep(args.cut_after)
+            cut_direct()
+        res = {}
+        for side, p in peers.items():
+            out = [line for line in p.communicate()[0].splitlines() if line.startswith("{")]
+            res[side] = json.loads(out[-1]) if out else {"error": "sin resultado"}
+        time.sleep(1.0)
+        with open(METRICS) as f:
+            metrics = f.read()
+    finally:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+                p.wait()
+        teardown()
+
+    a, b = res["a"], res["b"]
+    if "error" in a or "error" in b:
+        raise SystemExit(f"fallo: {a.get('error') or b.get('error')}")
+    print(f"servidor a +{delay:g} ms por sentido"
+          + (", sin camino directo" if args.no_direct else "")
+          + (f", camino directo cortado a los {args.cut_after} s" if args.cut_after else ""))
+    print(f"{'s':>3} {'a->b ms':>9} {'camino a':>9} {'b->a ms':>9} {'camino b':>9}")
+    for k in range(int(args.seconds)):
+        ab = b["latency_ms"].get(str(k), "-")
+        ba = a["latency_ms"].get(str(k), "-")
+        pa = a["paths"][k] if k < len(a["paths"]) else "-"
+        pb = b["paths"][k] if k < len(b["paths"]) else "-"
+        print(f"{k:>3} {ab:>9} {pa:>9} {ba:>9} {pb:>9}")
+    sent = a["sent"] + b["sent"]
+    relayed = _metric(metrics, "voip_media_relayed_total")
+    summary = {
+        "frames_sent": sent,
+        "frames_received": a["received"] + b["received"],
+        "server_relayed": int(relayed),
+        "relayed_pct": round(100 * relayed / sent, 1),
+        "p2p_rtt_ms": {"a": a["p2p_rtt_ms"], "b": b["p2p_rtt_ms"]},
+        "switches_direct": int(_metric(metrics, 'voip_p2p_switches_total{to="direct"}')),
+        "switches_relay": int(_metric(metrics, 'voip_p2p_switches_total{to="relay"}')),
+    }
+    print(json.dumps(summary))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"args": vars(args), "summary": summary, "a": a, "b": b}, f, indent=2)
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Llamada P2P en namespaces de red")
+    ap.add_argument("--seconds", type=float, default=10)
+    ap.add_argument("--server-delay-ms", type=float, default=20,
+                    help="retardo en cada sentido del enlace hasta el servidor")
+    ap.add_argument("--no-direct", action="store_true",
+                    help="sin ruta entre a y b (como dos NAT simétricos)")
+    ap.add_argument("--cut-after", type=float, default=0,
+                    help="cortar el camino directo a los N s de audio")
+    ap.add_argument("--out", help="guardar el resultado en JSON")
+    ap.add_argument("-v", "--verbose", action="store_true", help="logs de los clientes")
+    # uso interno: un extremo de la llamada, lanzado dentro de su namespace
+    ap.add_argument("--role", choices=("caller", "callee"), help=argparse.SUPPRESS)
+    ap.add_argument("--server", help=argparse.SUPPRESS)
+    ap.add_argument("--port", type=int, default=PORT, help=argparse.SUPPRESS)
+    ap.add_argument("--me", help=argparse.SUPPRESS)
+    ap.add_argument("--peer", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.role:
+        return run_peer(args)
+    if os.geteuid() != 0:
+        raise SystemExit("netlab necesita root (ip netns, tc)")
+    return run_lab(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
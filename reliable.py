@@ -0,0 +1,175 @@
+"""
+Entrega fiable de mensajes de señalización sobre UDP (svr.py y win_client.py).
+
+    ~<tid>:<mensaje>              mensaje que hay que confirmar
+    ACK:<tid>                     confirmación vacía
+    ACK:<tid>:<r1>\\n<r2>...       confirmación con las respuestas al mensaje
+
+El emisor reenvía con backoff exponencial hasta recibir el ACK o agotar los
+intentos. El receptor recuerda la respuesta de cada (dirección, tid) un rato:
+si le llega un reenvío repite esa respuesta sin volver a ejecutar el comando.
+Las tramas de audio nunca pasan por aquí.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict
+
+RTO = 0.25          # primer reenvío (s)
+RTO_MAX = 2.0
+MAX_TRIES = 6       # envío + 5 reenvíos: ~6 s antes de dar el mensaje por perdido
+RESPONSE_TTL = 32.0
+
+
+def wrap(tid, data):
+    return b"~%d:" % tid + data
+
+
+def unwrap(data):
+    """(tid, mensaje) de un datagrama fiable; (None, data) si no lo es."""
+    if data[:1] != b"~":
+        return None, data
+    i = data.find(b":", 1, 14)
+    if i < 0:
+        return None, data
+    try:
+        return int(data[1:i]), data[i + 1:]
+    except ValueError:
+        return None, data
+
+
+def ack(tid, replies=()):
+    if not replies:
+        return b"ACK:%d" % tid
+    return b"ACK:%d:" % tid + b"\n".join(replies)
+
+
+def parse_ack(data):
+    """(tid, [respuestas]) de un ACK; (None, []) si está mal formado."""
+    _, _, rest = data.partition(b":")
+    tid, sep, body = rest.partition(b":")
+    try:
+        tid = int(tid)
+    except ValueError:
+        return None, []
+    return tid, (body.split(b"\n") if sep and body else [])
+
+
+class Sender:
+    """Mensajes pendientes de ACK y su calendario de reenvíos.
+
+    No tiene hilo propio: quien lo usa llama a due() cada pocos ms y envía lo
+    que devuelve. ctx es opaco (p.ej. el socket por el que reenviar).
+    """
+
+    def __init__(self, rto=RTO, rto_max=RTO_MAX, tries=MAX_TRIES):
+        self.rto = rto
+        self.rto_max = rto_max
+        self.tries = tries
+        self._ids = itertools.count(random.randrange(1, 1 << 30))
+        self._pending = {}  # {tid: [due, rto, intentos_restantes, addr, wire, ctx, on_fail]}
+        self._heap = []     # [(due, tid)]; las entradas obsoletas se saltan al sacarlas
+        self._lock = threading.Lock()
+        self.retransmits = 0
+        self.failures = 0
+
+    def send(self, addr, data, ctx=None, on_fail=None):
+        """Registra el mensaje y devuelve el datagrama a enviar ya."""
+        tid = next(self._ids) & 0x7FFFFFFF
+        wire = wrap(tid, data)
+        due = time.monotonic() + self.rto
+        with self._lock:
+            self._pending[tid] = [due, self.rto, self.tries - 1, addr, wire, ctx, on_fail]
+            heapq.heappush(self._heap, (due, tid))
+        return wire
+
+    def ack(self, tid, addr=None):
+        with self._lock:
+            p = self._pending.get(tid)
+            if p is None or (addr is not None and p[3] != addr):
+                return False
+            del self._pending[tid]
+        return True
+
+    def forget(self, addr):
+        """Descarta lo pendiente hacia addr (el destino se ha ido)."""
+        with self._lock:
+            for tid in [t for t, p in self._pending.items() if p[3] == addr]:
+                del self._pending[tid]
+
+    def due(self, now=None):
+        """[(addr, datagrama, ctx)] que toca reenviar ahora."""
+        now = time.monotonic() if now is None else now
+        out = []
+        failed = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                due, tid = heapq.heappop(heap)
+                p = self._pending.get(tid)
+                if p is None or p[0] != due:
+                    continue
+                if p[2] <= 0:
+                    del self._pending[tid]
+                    failed.append(p)
+                    continue
+                p[1] = min(p[1] * 2, self.rto_max)
+                p[0] = now + p[1]
+                p[2] -= 1
+                heapq.heappush(heap, (p[0], tid))
+                out.append((p[3], p[4], p[5]))
+        self.retransmits += len(out)
+        self.failures += len(failed)
+        for p in failed:
+            if p[6] is not None:
+                p[6](p[3], unwrap(p[4])[1])
+        return out
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class Receiver:
+    """Detecta reenvíos por (dirección, tid) y guarda la respuesta dada."""
+
+    def __init__(self, ttl=RESPONSE_TTL, maxsize=65536):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict()  # {(addr, tid): (t, respuesta o None si en curso)}
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def begin(self, addr, tid):
+        """None si el mensaje es nuevo; si no, la respuesta a repetir (b"" si aún no hay)."""
+        key = (addr, tid)
+        with self._lock:
+            hit = self._seen.get(key)
+            if hit is None:
+                self._seen[key] = (time.monotonic(), None)
+                if len(self._seen) > self.maxsize:
+                    self._seen.popitem(last=False)
+                return None
+            self.duplicates += 1
+            return hit[1] or b""
+
+    def finish(self, addr, tid, response):
+        with self._lock:
+            key = (addr, tid)
+            if key in self._seen:
+                self._seen[key] = (self._seen[key][0], response)
+
+    def expire(self, budget=256):
+        limit = time.monotonic() - self.ttl
+        with self._lock:
+            seen = self._seen
+            while seen and budget:
+                key = next(iter(seen))
+                if seen[key][0] > limit:
+                    break
+                del seen[key]
+                budget -= 1
+
+    def __len__(self):
+        return len(self._seen)
@@ -0,0 +1,259 @@
+# replay.py - Reproduce contra un servidor local una traza de svr.py --capture
+#
+# Cada origen de la traza (ip:puerto) pasa a ser un socket local propio, así
+# el servidor ve los mismos clientes que en producción. Los datagramas salen
+# en el mismo orden y, con --speed 1, con los mismos intervalos; --speed 0 los
+# manda tan rápido como puede. Las tramas binarias llevan el sid que dio el
+# servidor original: se reescriben con el que el servidor local ha dado a ese
+# socket (SESSION, ACCEPT_FROM o CONF_JOINED).
+#
+# Mide:
+#   reply_latency_ms  de cada comando de texto a la primera respuesta en ese socket
+#   media_latency_ms  de cada trama de audio a su llegada al otro extremo
+#                     (se reconoce por su contenido, binaria o AUDIO_B64)
+#   send_slip_ms      cuánto se retrasó el propio replay respecto a la traza
+#
+#   python svr.py --capture prod.vcap                       # grabar
+#   python replay.py prod.vcap --spawn --out a.json         # reproducir
+#   python replay.py prod.vcap --spawn --speed 0 --server-arg=--asyncio --out b.json
+#   python replay.py --compare a.json b.json                # A/B
+
+import argparse
+import json
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+
+from loadgen import _cpu_seconds, _percentiles, _rss_mb, _server_pids, spawn_server
+from svr import MEDIA_HDR, Capture
+
+SID_OFF = MEDIA_HDR.size - 4  # el sid son los 4 últimos bytes de la cabecera
+
+
+class Source:
+    __slots__ = ("sock", "sid", "pending", "last")
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.setblocking(False)
+        self.sid = 0
+        self.pending = deque()  # instantes de envío de comandos sin respuesta aún
+        self.last = None        # último datagrama recibido (para no contar copias)
+
+
+def _media_key(data):
+    """Clave de contenido de una trama de audio, igual a la ida y a la vuelta."""
+    if data[0] >= 0x80:
+        return hash((bytes(data[2:SID_OFF]), bytes(data[MEDIA_HDR.size:])))
+    if data.startswith(b"AUDIO_B64:") or data.startswith(b"AUDIO_FROM_B64:"):
+        return hash(data.rsplit(b":", 1)[-1])
+    return None
+
+
+class Replay:
+    def __init__(self, records, server, speed=1.0):
+        self.records = records
+        self.server = server
+        self.speed = speed
+        self.sel = selectors.DefaultSelector()
+        self.sources = {}  # {(ip, puerto) original: Source}
+        self.media = {}    # {clave de contenido: deque de instantes de envío}
+        self.reply_lat = []
+        self.media_lat = []
+        self.slip = []
+        self.stats = {"sent": 0, "recv": 0, "media_sent": 0, "media_delivered": 0,
+                      "sid_rewritten": 0, "send_errors": 0}
+
+    def _source(self, addr):
+        src = self.sources.get(addr)
+        if src is None:
+            src = self.sources[addr] = Source()
+            self.sel.register(src.sock, selectors.EVENT_READ, src)
+        return src
+
+    def _send(self, src, data, now):
+        if data[0] >= 0x80 and len(data) >= MEDIA_HDR.size and src.sid:
+            data = data[:SID_OFF] + src.sid.to_bytes(4, "big") + data[MEDIA_HDR.size:]
+            self.stats["sid_rewritten"] += 1
+        try:
+            src.sock.sendto(data, self.server)
+        except OSError:
+            self.stats["send_errors"] += 1
+            return
+        self.stats["sent"] += 1
+        key = _media_key(data)
+        if key is not None:
+            # las dos patas de una llamada pueden mandar el mismo contenido
+            self.media.setdefault(key, deque()).append(now)
+            self.stats["media_sent"] += 1
+        elif data[0] < 0x80 and not data.startswith(b"ACK:"):
+            src.pending.append(now)
+
+    def _on_datagram(self, src, data, now):
+        self.stats["recv"] += 1
+        key = _media_key(data)
+        if key is not None:
+            sent = self.media.get(key)
+            if sent:
+                self.media_lat.append(now - sent.popleft())
+                self.stats["media_delivered"] += 1
+                if not sent:
+                    del self.media[key]
+            return
+        if data == src.last:
+            return  # copia redundante
+        src.last = data
+        if src.pending:
+            self.reply_lat.append(now - src.pending.popleft())
+        if data.startswith(b"~"):
+            data = data.split(b":", 1)[-1]
+        for msg in data.split(b"\n"):
+            parts = msg.split(b":")
+            try:
+                if parts[0] == b"SESSION" and len(parts) >= 2:
+                    src.sid = int(parts[1])
+                elif parts[0] in (b"ACCEPT_FROM", b"CONF_JOINED") and len(parts) >= 3:
+                    src.sid = int(parts[2])
+            except ValueError:
+                pass
+
+    def _poll(self, timeout):
+        for key, _ in self.sel.select(timeout):
+            src = key.data
+            while True:
+                try:
+                    data = src.sock.recv(65535)
+                except (BlockingIOError, InterruptedError, OSError):
+                    break
+                if data:
+                    self._on_datagram(src, data, time.perf_counter())
+
+    def run(self, linger=1.0, server_pid=None):
+        pids = _server_pids(server_pid)
+        cpu0 = _cpu_seconds(pids)
+        rss = _rss_mb(pids)
+        t0 = time.perf_counter()
+        for i, (t, addr, data) in enumerate(self.records):
+            if self.speed > 0:
+                due = t0 + t / self.speed
+                while True:
+                    wait = due - time.perf_counter()
+                    if wait <= 0:
+                        break
+                    self._poll(min(wait, 0.05))
+                self.slip.append(time.perf_counter() - due)
+            elif i % 64 == 0:
+                self._poll(0)
+            src = self._source(addr)
+            self._send(src, data, time.perf_counter())
+        sent_s = time.perf_counter() - t0
+        end = time.perf_counter() + linger
+        while time.perf_counter() < end:
+            self._poll(0.05)
+        elapsed = time.perf_counter() - t0
+        if pids:
+            rss = max(rss, _rss_mb(pids))
+        res = dict(self.stats)
+        res.update({
+            "records": len(self.records),
+            "sources": len(self.sources),
+            "speed": self.speed,
+            "trace_s": round(self.records[-1][0], 3) if self.records else 0.0,
+            "send_s": round(sent_s, 3),
+            "send_pps": round(self.stats["sent"] / sent_s, 1) if sent_s else 0.0,
+            "recv_pps": round(self.stats["recv"] / elapsed, 1),
+            "media_loss": round(1 - self.stats["media_delivered"] / self.stats["media_sent"], 4)
+            if self.stats["media_sent"] else 0.0,
+            "reply_latency_ms": _percentiles(self.reply_lat),
+            "media_latency_ms": _percentiles(self.media_lat),
+        })
+        if self.slip:
+            res["send_slip_ms"] = _percentiles(self.slip)
+        if pids:
+            res["server_cpu_s"] = round(_cpu_seconds(pids) - cpu0, 3)
+            res["server_rss_mb"] = round(rss, 1)
+        for src in self.sources.values():
+            src.sock.close()
+        return res
+
+
+def _flatten(res, prefix=""):
+    out = {}
+    for k, v in res.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[prefix + k] = v
+    return out
+
+
+def compare(path_a, path_b):
+    with open(path_a) as f:
+        a = _flatten(json.load(f))
+    with open(path_b) as f:
+        b = _flatten(json.load(f))
+    print(f"{'métrica':<28} {'A':>12} {'B':>12} {'B/A':>8}")
+    for k in a:
+        if k not in b:
+            continue
+        ratio = f"{b[k] / a[k]:.2f}" if a[k] else "-"
+        print(f"{k:<28} {a[k]:>12} {b[k]:>12} {ratio:>8}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Reproduce una traza de svr.py --capture")
+    ap.add_argument("trace", nargs="?", help="fichero de svr.py --capture")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=24646)
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="1 = tiempo real, 2 = el doble de rápido, 0 = sin esperas")
+    ap.add_argument("--linger", type=float, default=1.0,
+                    help="segundos esperando respuestas tras el último envío")
+    ap.add_argument("--limit", type=int, default=0, help="reproducir solo los N primeros")
+    ap.add_argument("--spawn", action="store_true", help="arrancar svr.py y medir su CPU/RSS")
+    ap.add_argument("--server-arg", action="append", default=[],
+                    help="argumento extra para svr.py con --spawn (repetible)")
+    ap.add_argument("--server-pid", type=int, help="pid de un svr.py ya arrancado (CPU/RSS)")
+    ap.add_argument("--out", help="fichero JSON de resultados")
+    ap.add_argument("--compare", nargs=2, metavar=("A.json", "B.json"),
+                    help="comparar dos resultados en vez de reproducir")
+    args = ap.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    if not args.trace:
+        ap.error("falta la traza")
+    records = []
+    for rec in Capture.read(args.trace):
+        records.append(rec)
+        if args.limit and len(records) >= args.limit:
+            break
+    if not records:
+        raise SystemExit(f"{args.trace}: traza vacía")
+
+    proc = spawn_server(args.port, args.server_arg) if args.spawn else None
+    server = ("127.0.0.1", args.port) if proc else (args.host, args.port)
+    try:
+        res = Replay(records, server, args.speed).run(args.linger,
+                                                      proc.pid if proc else args.server_pid)
+        res["server_args"] = args.server_arg
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    text = json.dumps(res, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,304 +3,3557 @@
 import socket
 import threading
 import time
-import hashlib
+import argparse
+import array
+import asyncio
+import base64
+import errno
+import heapq
+import bisect
+import itertools
+import struct
+import mmap
+import os
+import select
+import zlib
+import multiprocessing
+import json
+import signal
+import sys
+import wave
+from collections import deque
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import codec
+import reliable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop  # desaparece en Python 3.13
+except ImportError:
+    audioop = None
 
 HOST = "0.0.0.0"
 PORT = 24646
 
-clients = {}  # {number: (ip, port, last_seen, name)}
-recent = {}   # {(addr, hash): last_time}
-claimed = {}  # {number: claimed_port}
+clients = {}  # {number: (ip, port, last_seen, name)}
+claimed = {}  # {number: claimed_port}
+sessions = {}    # {session_id: (caller, callee, last_active)}
+session_of = {}  # {number: session_id}
+
+# Trama binaria de audio: | 0x80|ver | tipo | seq u16 | ts u32 | sesión u32 | payload
+# El primer byte >= 0x80 la distingue de la señalización de texto (ASCII).
+MEDIA_HDR = struct.Struct("!BBHII")
+MEDIA_VERSION = 1
+_session_ids = itertools.count(1)
+WORKER_ID = 0  # en modo --workers, índice del proceso (va en los 8 bits altos del sid)
+WORKERS = 0    # en cada worker, cuántos hay; 0 con un solo proceso (y en el padre)
+
+# --- Logs ---
+#
+# Registro estructurado (líneas JSON) con una cola acotada que vacía un hilo
+# escritor. Cada categoría (REC, AUDIO, CALL, ICE, ONLINE, SESSION, ERR, SYS...)
+# tiene su nivel y un límite de eventos por segundo. Las llamadas pasan campos,
+# no strings ya formateados: si la categoría está apagada no se formatea nada.
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40, "OFF": 100}
+
+
+class Log:
+    def __init__(self, level="INFO", maxsize=10000, payload=80):
+        self.default = LOG_LEVELS[level]
+        self.levels = {"AUDIO": LOG_LEVELS["OFF"]}  # {categoría: nivel}
+        self.rates = {"REC": 50.0, "AUDIO": 5.0}     # {categoría: eventos/s}
+        self.maxsize = maxsize
+        self.payload = payload
+        self.dropped = 0     # cola llena
+        self.suppressed = 0  # límite de tasa
+        self.stream = sys.stdout
+        self._q = deque()
+        self._buckets = {}   # {categoría: [tokens, último]}
+        self._thread = None
+
+    def configure(self, spec):
+        """CAT=NIVEL[@eventos_por_segundo], p.ej. AUDIO=DEBUG@5 o REC=OFF."""
+        cat, _, val = spec.partition("=")
+        lvl, _, rate = val.partition("@")
+        self.levels[cat.upper()] = LOG_LEVELS[lvl.upper()]
+        if rate:
+            self.rates[cat.upper()] = float(rate)
+
+    def on(self, cat, level=20):
+        return level >= self.levels.get(cat, self.default)
+
+    def _emit(self, level, cat, event, fields):
+        if level < self.levels.get(cat, self.default):
+            return
+        rate = self.rates.get(cat)
+        if rate:
+            now = time.monotonic()
+            b = self._buckets.get(cat)
+            if b is None:
+                b = self._buckets[cat] = [rate, now]
+            b[0] = min(rate, b[0] + (now - b[1]) * rate)
+            b[1] = now
+            if b[0] < 1.0:
+                self.suppressed += 1
+                return
+            b[0] -= 1.0
+        if len(self._q) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._q.append((time.time(), level, cat, event, fields))
+
+    def debug(self, cat, event, **fields):
+        self._emit(10, cat, event, fields)
+
+    def info(self, cat, event, **fields):
+        self._emit(20, cat, event, fields)
+
+    def warn(self, cat, event, **fields):
+        self._emit(30, cat, event, fields)
+
+    def error(self, cat, event, **fields):
+        self._emit(40, cat, event, fields)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+
+    def _value(self, v):
+        if isinstance(v, tuple) and len(v) == 2 and isinstance(v[1], int):
+            return f"{v[0]}:{v[1]}"
+        if isinstance(v, (bytes, bytearray, memoryview)):
+            head = bytes(v[:self.payload]).decode(errors="replace").strip()
+            return head if len(v) <= self.payload else f"{head}...(+{len(v) - self.payload})"
+        if isinstance(v, (int, float, bool)) or v is None:
+            return v
+        v = str(v)
+        if len(v) > self.payload:
+            return f"{v[:self.payload]}...(+{len(v) - self.payload})"
+        return v
+
+    def _format(self, rec):
+        ts, level, cat, event, fields = rec
+        out = {"ts": round(ts, 3), "lvl": _LEVEL_NAMES[level], "cat": cat, "event": event}
+        for k, v in fields.items():
+            out[k] = self._value(v)
+        if WORKERS:
+            out["worker"] = WORKER_ID
+        return json.dumps(out, ensure_ascii=False)
+
+    def _writer(self):
+        q = self._q
+        reported = (0, 0)
+        while True:
+            time.sleep(0.1)
+            lines = []
+            while q:
+                lines.append(self._format(q.popleft()))
+            if (self.dropped, self.suppressed) != reported:
+                reported = (self.dropped, self.suppressed)
+                lines.append(self._format((time.time(), 30, "SYS", "log_loss",
+                                           {"dropped": self.dropped, "suppressed": self.suppressed})))
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass
+
+
+_LEVEL_NAMES = {v: k for k, v in LOG_LEVELS.items()}
+log = Log()
+
+
+# --- Métricas ---
+#
+# Contadores e histogramas en memoria del proceso; se exponen en formato texto
+# de Prometheus por HTTP (--metrics-port) y/o se vuelcan a un fichero cada
+# --metrics-interval segundos. En la ruta de audio solo se suman enteros.
+
+KNOWN_COMMANDS = {
+    "REGISTER", "PING", "CALL", "ACCEPT", "REJECT", "BUSY", "OFFER_B64",
+    "WEBRTC_OFFER_B64", "ANSWER_B64", "WEBRTC_ANSWER_B64", "ICE_B64",
+    "WEBRTC_ICE_B64", "AUDIO_B64", "BYE", "HANGUP", "LIST", "LIST_PAGE",
+    "SUBSCRIBE", "UNSUBSCRIBE", "UNREGISTER",
+}
+
+
+class Histogram:
+    BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+               5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.BUCKETS, v)] += 1
+        self.sum += v
+
+    def render(self, name, out):
+        out.append(f"# TYPE {name} histogram")
+        acc = 0
+        for le, c in zip(self.BUCKETS, self.counts):
+            acc += c
+            out.append(f'{name}_bucket{{le="{le:g}"}} {acc}')
+        acc += self.counts[-1]
+        out.append(f'{name}_bucket{{le="+Inf"}} {acc}')
+        out.append(f"{name}_sum {self.sum:.6f}")
+        out.append(f"{name}_count {acc}")
+
+
+class Metrics:
+    def __init__(self):
+        self.packets_in = 0
+        self.bytes_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.media_relayed = 0
+        self.media_dropped = 0
+        self.forward_failures = 0
+        self.commands = {}  # {cmd: n}
+        self.sent = {}      # {tipo de respuesta: n}
+        self.handle_seconds = Histogram()
+        self.lock_wait_seconds = Histogram()
+        self.relay_seconds = Histogram()  # muestreado 1 de cada RELAY_SAMPLE tramas
+        self.conf_frames = 0
+        self.mix_seconds = Histogram()    # un tick del mezclador de conferencias
+        self.p2p_switches = {"direct": 0, "relay": 0}
+
+    def command(self, cmd):
+        if cmd not in KNOWN_COMMANDS:
+            cmd = "OTHER"
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+
+    def reply(self, kind, copies, nbytes):
+        self.sent[kind] = self.sent.get(kind, 0) + 1
+        self.packets_out += copies
+        self.bytes_out += nbytes * copies
+
+    def render(self):
+        out = []
+
+        def counter(name, value, labels=""):
+            out.append(f"# TYPE {name} counter")
+            out.append(f"{name}{labels} {value}")
+
+        def gauge(name, value):
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value}")
+
+        counter("voip_packets_in_total", self.packets_in)
+        counter("voip_bytes_in_total", self.bytes_in)
+        counter("voip_packets_out_total", self.packets_out)
+        counter("voip_bytes_out_total", self.bytes_out)
+        counter("voip_media_relayed_total", self.media_relayed)
+        counter("voip_media_dropped_total", self.media_dropped)
+        counter("voip_forward_failures_total", self.forward_failures)
+        counter("voip_conf_frames_total", self.conf_frames)
+        out.append("# TYPE voip_p2p_switches_total counter")
+        for path, n in sorted(self.p2p_switches.items()):
+            out.append(f'voip_p2p_switches_total{{to="{path}"}} {n}')
+        gauge("voip_p2p_direct_legs", sum(map(len, p2p_direct.values())))
+        counter("voip_signal_retransmits_total", outbound.retransmits)
+        counter("voip_signal_lost_total", outbound.failures)
+        counter("voip_signal_duplicates_total", inbound.duplicates)
+        out.append("# TYPE voip_admission_dropped_total counter")
+        for cls, n in sorted(admission.dropped.items()):
+            out.append(f'voip_admission_dropped_total{{class="{cls}"}} {n}')
+        counter("voip_offline_replies_total", self.sent.get("OFFLINE", 0))
+        if cluster is not None:
+            counter("voip_cluster_forwarded_total", cluster.relayed)
+            counter("voip_cluster_delivered_total", cluster.delivered)
+            counter("voip_cluster_gossip_items_total", cluster.gossip_items)
+            counter("voip_cluster_syncs_total", cluster.syncs)
+            gauge("voip_cluster_nodes_alive", len(cluster.alive))
+            gauge("voip_cluster_remote_registrations", len(cluster.dir))
+        counter("voip_log_dropped_total", log.dropped + log.suppressed)
+        if capture is not None:
+            counter("voip_capture_records_total", capture.records)
+            counter("voip_capture_dropped_total", capture.dropped)
+        if recorder is not None:
+            counter("voip_record_frames_total", recorder.frames)
+            counter("voip_record_bytes_total", recorder.bytes)
+            out.append("# TYPE voip_record_dropped_total counter")
+            for reason, n in sorted(recorder.dropped.items()):
+                out.append(f'voip_record_dropped_total{{reason="{reason}"}} {n}')
+            gauge("voip_record_legs_open", len(recorder.legs))
+        counter("voip_dedup_dropped_total", recent.dropped, '{kind="text"}')
+        out.append(f'voip_dedup_dropped_total{{kind="media"}} {media_window.dropped}')
+        out.append(f'voip_dedup_dropped_total{{kind="late"}} {media_window.late}')
+        out.append("# TYPE voip_commands_total counter")
+        for cmd, n in sorted(self.commands.items()):
+            out.append(f'voip_commands_total{{cmd="{cmd}"}} {n}')
+        out.append("# TYPE voip_sent_messages_total counter")
+        for kind, n in sorted(self.sent.items()):
+            out.append(f'voip_sent_messages_total{{type="{kind}"}} {n}')
+        gauge("voip_registrations", len(clients))
+        gauge("voip_active_calls", len(sessions))
+        gauge("voip_conf_rooms", len(rooms))
+        gauge("voip_conf_participants", len(conf_of))
+        gauge("voip_presence_subscribers", len(subscribers))
+        gauge("voip_egress_pending", egress.pending())
+        gauge("voip_egress_queued", sendq.pending())
+        gauge("voip_egress_backlogged_destinations", len(sendq))
+        out.append("# TYPE voip_egress_queued_total counter")
+        for cls, n in sorted(sendq.queued.items()):
+            out.append(f'voip_egress_queued_total{{class="{cls}"}} {n}')
+        out.append("# TYPE voip_egress_dropped_total counter")
+        for reason, n in sorted(sendq.dropped.items()):
+            out.append(f'voip_egress_dropped_total{{reason="{reason}"}} {n}')
+        gauge("voip_signal_pending_acks", len(outbound))
+        gauge("voip_admission_buckets", len(admission))
+        self.handle_seconds.render("voip_handle_seconds", out)
+        self.lock_wait_seconds.render("voip_lock_wait_seconds", out)
+        self.relay_seconds.render("voip_relay_seconds", out)
+        self.mix_seconds.render("voip_mix_seconds", out)
+        sendq.wait_seconds["signal"].render("voip_egress_wait_signal_seconds", out)
+        sendq.wait_seconds["media"].render("voip_egress_wait_media_seconds", out)
+        return "\n".join(out) + "\n"
+
+
+class TimedLock:
+    """threading.Lock que anota en un histograma cuánto se esperó para tomarlo."""
+
+    def __init__(self, hist):
+        self._lock = threading.Lock()
+        self._hist = hist
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        self._lock.acquire()
+        self._hist.observe(time.perf_counter() - t0)
+
+    def release(self):
+        self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+metrics = Metrics()
+RELAY_SAMPLE = 64
+
+lock = TimedLock(metrics.lock_wait_seconds)
+
+# Presencia: un cliente sin REGISTER/PING en PRESENCE_TIMEOUT segundos caduca.
+# La limpieza corre cada EXPIRY_TICK s y revisa como mucho EXPIRY_BUDGET entradas.
+PRESENCE_TIMEOUT = 60.0
+EXPIRY_TICK = 1.0
+EXPIRY_BUDGET = 256
+
+# Copias redundantes por tipo de mensaje: {tipo: (copias, separación_s)}.
+# El tipo es el texto antes del primer ':' ("OK", "PONG", "AUDIO_FROM_B64"...).
+REDUNDANCY_DEFAULT = (2, 0.02)
+REDUNDANCY = {
+    "LOSS_FROM": (1, 0.0),  # periódico: si se pierde, ya llegará el siguiente
+}
+
+# Señalización fiable (reliable.py) con los clientes que la usan: lo que el
+# servidor inicia espera ACK y se reenvía; las respuestas viajan en el ACK.
+# Los clientes antiguos siguen recibiendo copias redundantes.
+RTX_TICK = 0.05
+outbound = reliable.Sender()
+inbound = reliable.Receiver()
+reliable_peers = {}  # {addr: True} clientes que han hablado con ~tid
+
+
+class EgressScheduler:
+    """Envíos diferidos (copias redundantes) sobre un heap con un único hilo.
+
+    handle() nunca duerme: la primera copia sale al momento y el resto se
+    encola aquí con su instante de salida.
+    """
+
+    def __init__(self):
+        self._heap = []  # [(due, seq, sock, addr, data, born si es audio)]
+        self._seq = itertools.count()
+        self._cv = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def schedule(self, delay, sock, addr, data, media=False):
+        now = time.monotonic()
+        due = now + delay
+        with self._cv:
+            heapq.heappush(self._heap, (due, next(self._seq), sock, addr, data, now if media else None))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            elif self._heap[0][0] == due:
+                self._cv.notify()
+
+    def pending(self):
+        with self._cv:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._heap:
+                    self._cv.wait()
+                wait = self._heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self._cv.wait(wait)
+                    continue
+                _, _, sock, addr, data, born = heapq.heappop(self._heap)
+            try:
+                if born is None:
+                    sock.sendto(data, addr)
+                else:
+                    sock.send_media(data, addr, born)
+            except Exception as e:
+                log.error("ERR", "send", addr=addr, err=e)
+
+
+egress = EgressScheduler()
+
+
+# Colas de salida por destino. Mientras el kernel acepta, cada datagrama sale
+# al momento; si devuelve EAGAIN/ENOBUFS (o, en asyncio, el transporte ya tiene
+# algo encolado) espera aquí: la señalización de cada destino sale antes que
+# su audio, y el audio que lleva más de MEDIA_DEADLINE s esperando se tira:
+# quien lo escucha ya no puede usarlo.
+MEDIA_DEADLINE = 0.06
+EGRESS_POLL = 0.002
+_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+_BACKPRESSURE = (BlockingIOError, InterruptedError)
+
+
+def _is_backpressure(e):
+    return isinstance(e, _BACKPRESSURE) or getattr(e, "errno", None) == errno.ENOBUFS
+
+
+class EgressQueue:
+    SIG_MAX = 256    # datagramas de señalización por destino
+    MEDIA_MAX = 32   # tramas de audio por destino (~0.6 s)
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self._q = OrderedDict()  # {addr: (deque señalización, deque audio)} solo con algo pendiente
+        self._lock = threading.Lock()
+        self.queued = {"signal": 0, "media": 0}
+        self.dropped = {"stale": 0, "overflow_signal": 0, "overflow_media": 0}
+        self.wait_seconds = {"signal": Histogram(), "media": Histogram()}
+
+    def send(self, raw, addr, data, media=False, born=None):
+        """Envía ya o encola. Devuelve True si algo ha quedado encolado."""
+        if addr not in self._q:
+            try:
+                raw(data, addr)
+                return False
+            except OSError as e:
+                if not _is_backpressure(e):
+                    raise
+        now = time.monotonic()
+        with self._lock:
+            q = self._q.get(addr)
+            if q is None:
+                q = self._q[addr] = (deque(), deque())
+            elif not media and not q[0]:
+                try:  # la señalización no espera detrás del audio
+                    raw(data, addr)
+                    return bool(self._q)
+                except OSError as e:
+                    if not _is_backpressure(e):
+                        raise
+            if media:
+                if len(q[1]) >= self.MEDIA_MAX:
+                    q[1].popleft()
+                    self.dropped["overflow_media"] += 1
+                q[1].append((born or now, now, data))
+                self.queued["media"] += 1
+            else:
+                if len(q[0]) >= self.SIG_MAX:
+                    self.dropped["overflow_signal"] += 1
+                    return True
+                q[0].append((now, data))
+                self.queued["signal"] += 1
+        return True
+
+    def drain(self, raw):
+        """Vacía lo que admita el kernel. True si aún queda algo."""
+        deadline = MEDIA_DEADLINE if self.deadline is None else self.deadline
+        with self._lock:
+            if not self._q:
+                return False
+            now = time.monotonic()
+
+            def put(data, addr):
+                # False si el kernel sigue sin admitir; otros errores tiran el datagrama
+                try:
+                    raw(data, addr)
+                except OSError as e:
+                    if _is_backpressure(e):
+                        return False
+                    log.error("ERR", "send", addr=addr, err=e)
+                return True
+
+            blocked = False
+            # primero la señalización de todos los destinos, luego el audio por turnos
+            for addr, (sig, _) in self._q.items():
+                while sig and not blocked:
+                    blocked = not put(sig[0][1], addr)
+                    if not blocked:
+                        self.wait_seconds["signal"].observe(now - sig.popleft()[0])
+                if blocked:
+                    break
+            busy = not blocked
+            while busy:
+                busy = False
+                for addr, (_, media) in self._q.items():
+                    while media and now - media[0][0] > deadline:
+                        media.popleft()
+                        self.dropped["stale"] += 1
+                    if not media:
+                        continue
+                    if not put(media[0][2], addr):
+                        busy = False
+                        break
+                    self.wait_seconds["media"].observe(now - media.popleft()[1])
+                    busy = True
+            for addr in [a for a, (sig, media) in self._q.items() if not sig and not media]:
+                del self._q[addr]
+            return bool(self._q)
+
+    def pending(self):
+        return sum(len(s) + len(m) for s, m in list(self._q.values()))
+
+    def __len__(self):
+        return len(self._q)
+
+
+sendq = EgressQueue()
+
+
+class _QueuedSock:
+    """Envoltorio de salida del socket en modo hilos: sendto() nunca bloquea.
+
+    Los manejadores solo envían; recvfrom sigue sobre el socket original.
+    Un hilo espera a que el socket admita escritura y vacía sendq.
+    """
+
+    def __init__(self, sock, queue=None):
+        self.sock = sock
+        self.queue = sendq if queue is None else queue
+        self._cv = threading.Condition(threading.Lock())
+        threading.Thread(target=self._drainer, daemon=True).start()
+
+    def _raw(self, data, addr):
+        return self.sock.sendto(data, _DONTWAIT, addr)
+
+    def sendto(self, data, addr):
+        if self.queue.send(self._raw, addr, data):
+            self._wake()
+
+    def send_media(self, data, addr, born=None):
+        if self.queue.send(self._raw, addr, data, True, born):
+            self._wake()
+
+    def _wake(self):
+        with self._cv:
+            self._cv.notify()
+
+    def _drainer(self):
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: len(self.queue), timeout=1.0)
+            try:
+                select.select([], [self.sock], [], EGRESS_POLL * 5)
+            except (OSError, ValueError):
+                pass
+            if self.queue.drain(self._raw):
+                time.sleep(EGRESS_POLL)
+
+
+class DedupCache:
+    """Supresión de duplicados de señalización: TTL + LRU con tamaño máximo.
+
+    Las claves son (addr, hash(datagrama)); las entradas caducadas o más viejas
+    que el límite se expulsan por el frente, así la memoria queda acotada.
+    """
+
+    def __init__(self, ttl=0.3, max_entries=65536):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.dropped = 0
+        self._d = OrderedDict()  # {(addr, hash): last_time}
+        self._lock = threading.Lock()
+
+    def seen(self, addr, data, now=None):
+        now = time.monotonic() if now is None else now
+        key = (addr, hash(data))
+        with self._lock:
+            last = self._d.get(key)
+            if last is not None and now - last < self.ttl:
+                self.dropped += 1
+                return True
+            self._d[key] = now
+            self._d.move_to_end(key)
+            d = self._d
+            while d:
+                k, t = next(iter(d.items()))
+                if len(d) <= self.max_entries and now - t < self.ttl:
+                    break
+                del d[k]
+        return False
+
+    def expire(self, budget, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            d = self._d
+            while d and budget > 0:
+                k, t = next(iter(d.items()))
+                if now - t < self.ttl:
+                    break
+                del d[k]
+                budget -= 1
+
+    def __len__(self):
+        return len(self._d)
+
+
+class ReplayWindow:
+    """Ventana deslizante de bits por emisor (estilo anti-replay de SRTP).
+
+    Para cada clave guarda el mayor seq visto (u16, con vuelta) y un bitmap de
+    los `size` anteriores. Rechaza repetidos y los que quedan fuera de ventana.
+    """
+
+    def __init__(self, size=64, max_senders=4096):
+        self.size = size
+        self.max_senders = max_senders
+        self.dropped = 0
+        self.late = 0
+        self._mask = (1 << size) - 1
+        self._st = OrderedDict()  # {key: [top_seq, bitmap]}
+        # check() corre en el hilo de recepción sin el lock global y forget()
+        # en los handlers: sin este lock, forget() iteraría un dict que cambia
+        self._lock = threading.Lock()
+
+    def check(self, key, seq):
+        with self._lock:
+            return self._check(key, seq)
+
+    def _check(self, key, seq):
+        st = self._st.get(key)
+        if st is None:
+            self._st[key] = [seq, 1]
+            if len(self._st) > self.max_senders:
+                self._st.popitem(last=False)
+            return True
+        self._st.move_to_end(key)
+        top, mask = st
+        ahead = (seq - top) & 0xFFFF
+        if ahead and ahead < 0x8000:
+            st[0] = seq
+            st[1] = ((mask << ahead) | 1) & self._mask if ahead < self.size else 1
+            return True
+        back = (top - seq) & 0xFFFF
+        if back >= self.size:
+            self.late += 1
+            return False
+        bit = 1 << back
+        if mask & bit:
+            self.dropped += 1
+            return False
+        st[1] = mask | bit
+        return True
+
+    def forget(self, match):
+        with self._lock:
+            for k in [k for k in self._st if match(k)]:
+                del self._st[k]
+
+    def __len__(self):
+        return len(self._st)
+
+
+class Admission:
+    """Control de admisión antes de parsear: token buckets por IP y por origen.
+
+    El origen (ip, puerto) es el cliente, y con él su número; no se usa el
+    número del mensaje porque cualquiera podría gastar el cupo de otro. Audio
+    (tramas binarias y AUDIO_B64) y señalización tienen cupos separados.
+    Lo que no cabe se descarta sin responder.
+    """
+
+    # {clase: (tokens/s, ráfaga)}; 0 tokens/s = sin límite
+    DEFAULTS = {
+        "SIG_SRC": (20.0, 40.0),
+        "SIG_IP": (500.0, 1000.0),
+        "MEDIA_SRC": (150.0, 150.0),
+        "MEDIA_IP": (20000.0, 20000.0),
+        "ERR_SRC": (1.0, 5.0),   # respuestas ERR a comandos desconocidos
+    }
+    MAX_KEYS = 200000
+    SWEEP_EVERY = 10.0
+
+    def __init__(self):
+        self.enabled = True
+        self.trusted = set()  # direcciones sin cupo (los otros nodos del clúster)
+        self.limits = dict(self.DEFAULTS)
+        self.dropped = dict.fromkeys(list(self.DEFAULTS) + ["INFLIGHT"], 0)
+        self._b = {}  # {(clase, clave): [tokens, t]}
+        self._next_sweep = time.monotonic() + self.SWEEP_EVERY
+
+    def configure(self, spec):
+        """off, o CLASE=tokens_por_segundo[@ráfaga], p.ej. SIG_SRC=10@20 o MEDIA_SRC=0."""
+        if spec.lower() == "off":
+            self.enabled = False
+            return
+        cls, _, val = spec.partition("=")
+        cls = cls.upper()
+        if cls not in self.limits:
+            raise ValueError(f"clase desconocida: {cls}")
+        rate, _, burst = val.partition("@")
+        rate = float(rate)
+        self.limits[cls] = (rate, float(burst) if burst else max(rate, 1.0))
+
+    def _take(self, cls, key, now):
+        rate, burst = self.limits[cls]
+        if not rate:
+            return True
+        b = self._b.get((cls, key))
+        if b is None:
+            if len(self._b) >= self.MAX_KEYS:
+                key = None  # tabla llena: los orígenes nuevos comparten cubo
+                b = self._b.get((cls, None))
+            if b is None:
+                b = self._b[(cls, key)] = [burst, now]
+        tokens = b[0] + (now - b[1]) * rate
+        b[1] = now
+        if tokens < 1.0:
+            b[0] = tokens
+            self.dropped[cls] += 1
+            return False
+        b[0] = min(tokens, burst) - 1.0
+        return True
+
+    def admit(self, data, addr):
+        """True si el datagrama puede pasar. Solo mira el primer byte/prefijo."""
+        if not self.enabled or addr in self.trusted:
+            return True
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        if data[:1] >= b"\x80" or data[:10] == b"AUDIO_B64:" or data[:15] == b"CONF_AUDIO_B64:":
+            return self._take("MEDIA_SRC", addr, now) and self._take("MEDIA_IP", addr[0], now)
+        return self._take("SIG_SRC", addr, now) and self._take("SIG_IP", addr[0], now)
+
+    def allow_error(self, addr):
+        return not self.enabled or self._take("ERR_SRC", addr, time.monotonic())
+
+    def _sweep(self, now):
+        # Los cubos que ya se habrían rellenado del todo no guardan nada útil.
+        self._next_sweep = now + self.SWEEP_EVERY
+        limits = self.limits
+        for k, b in list(self._b.items()):
+            rate, burst = limits[k[0]]
+            if b[0] + (now - b[1]) * rate >= burst:
+                del self._b[k]
+
+    def __len__(self):
+        return len(self._b)
+
+
+class SharedTable:
+    """Tabla hash de registros fijos en memoria compartida (mmap anónimo).
+
+    Se crea antes de hacer fork de los workers, así todos ven las mismas páginas.
+    Direccionamiento abierto con sondeo lineal; las escrituras se serializan con
+    un lock entre procesos y las lecturas van sin lock, validadas con un contador
+    por slot y otro global (seqlock). Expone la parte de la interfaz de dict que
+    usa el resto del servidor, así clients/claimed/sessions se sustituyen tal cual.
+
+    Al borrar no quedan lápidas: los siguientes de la cadena se desplazan hacia
+    atrás (solo esa cadena, con el contador global impar mientras tanto). Un
+    índice denso de slots ocupados hace que items() recorra solo los vivos.
+    """
+
+    _HDR = struct.Struct("!III")     # generación, usados, versión del índice
+    _SLOT = struct.Struct("!IBB32s")  # versión, estado, len clave, clave
+    _U32 = struct.Struct("!I")
+    EMPTY, USED = 0, 1
+    ITEMS_TRIES = 3  # recorridos validados antes de dar uno por bueno
+
+    def __init__(self, capacity, value_fmt, pack=None, unpack=None,
+                 int_keys=False, mp_lock=None):
+        self.capacity = capacity
+        self._val = struct.Struct("!" + value_fmt)
+        self._pack = pack or (lambda v: (v,))
+        self._unpack = unpack or (lambda t: t[0])
+        self._int_keys = int_keys
+        self._slot_size = self._SLOT.size + self._val.size
+        slots = self._HDR.size + self._slot_size * capacity
+        self._mm = mmap.mmap(-1, slots + 8 * capacity)
+        # índice denso (slots ocupados, los `usados` primeros) y, por slot,
+        # su posición en él; enteros nativos, nunca salen de esta máquina
+        mv = memoryview(self._mm)
+        self._dense = mv[slots:slots + 4 * capacity].cast("I")
+        self._pos = mv[slots + 4 * capacity:].cast("I")
+        self._lock = mp_lock if mp_lock is not None else multiprocessing.Lock()
+
+    # --- codificación ---
+
+    def _key(self, key):
+        return str(key).encode()[:32]
+
+    def _off(self, idx):
+        return self._HDR.size + idx * self._slot_size
+
+    def _read_slot(self, idx):
+        mm, off = self._mm, self._off(idx)
+        while True:
+            v1 = self._U32.unpack_from(mm, off)[0]
+            if v1 & 1:
+                continue
+            _, state, klen, kb = self._SLOT.unpack_from(mm, off)
+            val = self._val.unpack_from(mm, off + self._SLOT.size) if state == self.USED else None
+            if self._U32.unpack_from(mm, off)[0] == v1:
+                return state, kb[:klen], val
+
+    def _write_slot(self, idx, state, kb=b"", val=None):
+        mm, off = self._mm, self._off(idx)
+        ver = self._U32.unpack_from(mm, off)[0]
+        self._U32.pack_into(mm, off, (ver + 1) & 0xFFFFFFFF)
+        self._SLOT.pack_into(mm, off, (ver + 1) & 0xFFFFFFFF, state, len(kb), kb)
+        if val is not None:
+            self._val.pack_into(mm, off + self._SLOT.size, *val)
+        self._U32.pack_into(mm, off, (ver + 2) & 0xFFFFFFFF)
+
+    def _find(self, kb):
+        """Devuelve (idx, valor) del slot con la clave, o (None, None)."""
+        while True:
+            gen = self._U32.unpack_from(self._mm, 0)[0]
+            if gen & 1:
+                continue
+            found = (None, None)
+            h = zlib.crc32(kb) % self.capacity
+            for i in range(self.capacity):
+                idx = (h + i) % self.capacity
+                state, k, val = self._read_slot(idx)
+                if state == self.EMPTY:
+                    break
+                if state == self.USED and k == kb:
+                    found = (idx, val)
+                    break
+            if self._U32.unpack_from(self._mm, 0)[0] == gen:
+                return found
+
+    def _hdr(self):
+        return self._HDR.unpack_from(self._mm, 0)
+
+    def _bump(self, field):
+        # field 0: generación (sondeo), 2: versión del índice denso
+        off = 4 * field
+        v = self._U32.unpack_from(self._mm, off)[0]
+        self._U32.pack_into(self._mm, off, (v + 1) & 0xFFFFFFFF)
+
+    def _set_used(self, used):
+        self._U32.pack_into(self._mm, 4, used)
+
+    # Con el lock tomado y la versión del índice impar:
+
+    def _dense_add(self, idx, used):
+        self._dense[used] = idx
+        self._pos[idx] = used
+
+    def _dense_del(self, idx, used):
+        p = self._pos[idx]
+        last = self._dense[used - 1]
+        self._dense[p] = last
+        self._pos[last] = p
+
+    def _dense_move(self, src, dst):
+        p = self._pos[src]
+        self._dense[p] = dst
+        self._pos[dst] = p
+
+    def _remove(self, idx):
+        # Borrado por desplazamiento hacia atrás: cada siguiente de la cadena
+        # cuyo hueco natural no esté entre el hueco libre y él pasa al hueco.
+        cap = self.capacity
+        self._bump(0)
+        try:
+            hole = j = idx
+            for _ in range(cap - 1):
+                j = (j + 1) % cap
+                state, k, val = self._read_slot(j)
+                if state == self.EMPTY:
+                    break
+                home = zlib.crc32(k) % cap
+                if (hole < home <= j) if hole <= j else (home > hole or home <= j):
+                    continue
+                self._write_slot(hole, self.USED, k, val)
+                self._dense_move(j, hole)
+                hole = j
+            self._write_slot(hole, self.EMPTY)
+        finally:
+            self._bump(0)
+
+    # --- interfaz tipo dict ---
+
+    def get(self, key, default=None):
+        _, val = self._find(self._key(key))
+        return default if val is None else self._unpack(val)
+
+    def __getitem__(self, key):
+        _, val = self._find(self._key(key))
+        if val is None:
+            raise KeyError(key)
+        return self._unpack(val)
+
+    def __contains__(self, key):
+        return self._find(self._key(key))[0] is not None
+
+    def __setitem__(self, key, value):
+        kb = self._key(key)
+        val = self._pack(value)
+        self._val.pack(*val)  # valida antes de tocar la tabla
+        with self._lock:
+            used = self._hdr()[1]
+            h = zlib.crc32(kb) % self.capacity
+            for i in range(self.capacity):
+                idx = (h + i) % self.capacity
+                state, k, _ = self._read_slot(idx)
+                if state == self.USED and k == kb:
+                    self._write_slot(idx, self.USED, kb, val)
+                    return
+                if state == self.EMPTY:
+                    break
+            else:
+                raise MemoryError("tabla compartida llena")
+            self._bump(2)
+            try:
+                self._write_slot(idx, self.USED, kb, val)
+                self._dense_add(idx, used)
+                self._set_used(used + 1)
+            finally:
+                self._bump(2)
+
+    def pop(self, key, *default):
+        kb = self._key(key)
+        with self._lock:
+            idx, val = self._find(kb)
+            if idx is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            used = self._hdr()[1]
+            self._bump(2)
+            try:
+                self._dense_del(idx, used)
+                self._set_used(used - 1)
+                self._remove(idx)
+            finally:
+                self._bump(2)
+        return self._unpack(val)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def items(self):
+        # Sin lock: se copia el índice denso y se leen esos slots; si entre
+        # medias cambió el índice, otra vez (como mucho ITEMS_TRIES, y si no
+        # vale el último recorrido sin repetidos).
+        for _ in range(self.ITEMS_TRIES):
+            while True:
+                gen, used, ver = self._hdr()
+                if not (ver & 1 or gen & 1):
+                    break
+            out = {}
+            for idx in self._dense[:used].tolist():
+                state, k, val = self._read_slot(idx)
+                if state == self.USED:
+                    out[k] = val
+            if self._hdr()[::2] == (gen, ver):
+                break
+        decode = (lambda k: int(k)) if self._int_keys else (lambda k: k.decode(errors="ignore"))
+        return [(decode(k), self._unpack(v)) for k, v in out.items()]
+
+    def keys(self):
+        return [k for k, _ in self.items()]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._hdr()[1]
+
+
+def _pack_client(v):
+    ip, port, t, name = v
+    return (socket.inet_aton(ip), port, t, (name or "").encode()[:96])
+
+
+def _unpack_client(t):
+    ip, port, last, name = t
+    return (socket.inet_ntoa(ip), port, last, name.rstrip(b"\0").decode(errors="ignore"))
+
+
+def _pack_session(v):
+    return (v[0].encode()[:32], v[1].encode()[:32], v[2])
+
+
+def _unpack_session(t):
+    return (t[0].rstrip(b"\0").decode(errors="ignore"),
+            t[1].rstrip(b"\0").decode(errors="ignore"), t[2])
+
+
+def share_tables(capacity=65536):
+    """Sustituye los dicts del registro por tablas en memoria compartida."""
+    global clients, claimed, sessions, session_of
+    mp_lock = multiprocessing.get_context("fork").Lock()
+    global presence_log
+    clients = SharedTable(capacity, "4sHd96s", _pack_client, _unpack_client, mp_lock=mp_lock)
+    presence_log = PresenceLog(mp_lock=mp_lock)
+    claimed = SharedTable(capacity, "i", mp_lock=mp_lock)
+    sessions = SharedTable(capacity, "32s32sd", _pack_session, _unpack_session,
+                           int_keys=True, mp_lock=mp_lock)
+    session_of = SharedTable(capacity, "I", mp_lock=mp_lock)
+
+
+class ExpiryHeap:
+    """Caducidad de presencia incremental: min-heap de (vencimiento, número).
+
+    Cada número tiene como mucho una entrada. touch() es O(log n) la primera vez
+    y O(1) después; al vencer, si el cliente se ha refrescado, se reprograma con
+    su nuevo last_seen en lugar de borrarlo.
+    """
+
+    def __init__(self):
+        self._heap = []  # [(due, number)]
+        self._due = {}   # {number: due}
+
+    def touch(self, number, last_seen):
+        if number not in self._due:
+            due = last_seen + PRESENCE_TIMEOUT
+            self._due[number] = due
+            heapq.heappush(self._heap, (due, number))
+
+    def discard(self, number):
+        self._due.pop(number, None)
+
+    def pop_expired(self, now, budget, last_seen_of):
+        """Devuelve los números caducados, revisando como mucho `budget` entradas."""
+        out = []
+        heap = self._heap
+        while heap and heap[0][0] <= now and budget > 0:
+            budget -= 1
+            due, number = heapq.heappop(heap)
+            if self._due.get(number) != due:
+                continue
+            del self._due[number]
+            t = last_seen_of(number)
+            if t is None:
+                continue
+            if now - t > PRESENCE_TIMEOUT:
+                out.append(number)
+            else:
+                self.touch(number, t)
+        return out
+
+    def __len__(self):
+        return len(self._due)
+
+
+class PresenceLog:
+    """Anillo de cambios de presencia (ON/OFF) con contador de versión.
+
+    Vive en un mmap anónimo para que, en modo --workers, todos los procesos
+    lean el mismo anillo: cada uno empuja a sus suscriptores los cambios que
+    aún no les ha mandado. Un suscriptor que se queda más atrás que el tamaño
+    del anillo tiene que pedir un snapshot paginado (LIST_PAGE).
+    """
+
+    _HDR = struct.Struct("!Q")
+    _REC = struct.Struct("!QB32s96s")  # versión, op, número, nombre
+    ON, OFF = 1, 2
+
+    def __init__(self, size=4096, mp_lock=None):
+        self.size = size
+        self._mm = mmap.mmap(-1, self._HDR.size + self._REC.size * size)
+        self._lock = mp_lock if mp_lock is not None else threading.Lock()
+
+    def version(self):
+        return self._HDR.unpack_from(self._mm, 0)[0]
+
+    def append(self, op, number, name=""):
+        with self._lock:
+            ver = self.version() + 1
+            off = self._HDR.size + (ver % self.size) * self._REC.size
+            self._REC.pack_into(self._mm, off, ver, op, number.encode()[:32],
+                                (name or "").encode()[:96])
+            self._HDR.pack_into(self._mm, 0, ver)
+        return ver
+
+    def restore(self, version):
+        """Continúa la numeración tras un reinicio; el anillo empieza vacío."""
+        with self._lock:
+            self._HDR.pack_into(self._mm, 0, version)
+
+    def read(self, after, upto):
+        """Eventos con versión en (after, upto], o None si el anillo ya los pisó."""
+        if upto - after > self.size - 1:
+            return None
+        out = []
+        for ver in range(after + 1, upto + 1):
+            off = self._HDR.size + (ver % self.size) * self._REC.size
+            rv, op, num, nm = self._REC.unpack_from(self._mm, off)
+            if rv != ver:
+                return None
+            out.append((op, num.rstrip(b"\0").decode(errors="ignore"),
+                        nm.rstrip(b"\0").decode(errors="ignore")))
+        return out
+
+
+recent = DedupCache()
+media_window = ReplayWindow()
+admission = Admission()
+MAX_INFLIGHT = 256  # hilos de señalización a la vez (modo hilos)
+inflight = threading.BoundedSemaphore(MAX_INFLIGHT)
+presence = ExpiryHeap()
+presence_log = PresenceLog()
+subscribers = {}  # {number: [addr, next_ver]} (por proceso)
+
+
+def _redundancy_for(data):
+    kind = bytes(data[:32]).split(b":", 1)[0].decode(errors="ignore")
+    return REDUNDANCY.get(kind, REDUNDANCY_DEFAULT)
+
+
+def configure_redundancy(spec):
+    """TIPO=N[@SEG], p.ej. AUDIO_FROM_B64=1 u OK=3@0.03."""
+    kind, eq, val = spec.partition("=")
+    n, _, d = val.partition("@")
+    if not kind or not eq:
+        raise ValueError("se espera TIPO=N[@SEG]")
+    try:
+        copies = int(n)
+    except ValueError:
+        raise ValueError(f"copias no es un entero: {n!r}") from None
+    if not 1 <= copies <= 10:
+        raise ValueError(f"copias fuera de 1..10: {copies}")
+    try:
+        delay = float(d) if d else REDUNDANCY_DEFAULT[1]
+    except ValueError:
+        raise ValueError(f"separación no es un número: {d!r}") from None
+    if not 0 <= delay <= 1:
+        raise ValueError(f"separación fuera de 0..1 s: {d}")
+    REDUNDANCY[kind] = (copies, delay)
+
+
+def _send_redundant_bytes(sock, addr, data, copies=None, delay=None, kind=None, media=False):
+    if copies is None or delay is None:
+        c, d = _redundancy_for(data)
+        copies = c if copies is None else copies
+        delay = d if delay is None else delay
+    if kind is None:
+        kind = bytes(data[:24]).split(b":", 1)[0].decode(errors="ignore")
+    metrics.reply(kind, max(1, copies), len(data))
+    if isinstance(sock, _LoopSock):
+        return sock.send_redundant(addr, data, copies, delay, media)
+    try:
+        if media:
+            sock.send_media(data, addr)
+        else:
+            sock.sendto(data, addr)
+    except Exception as e:
+        log.error("ERR", "send", addr=addr, err=e)
+        return False
+    for i in range(1, max(1, copies)):
+        egress.schedule(delay * i, sock, addr, data, media)
+    return True
+
+def _send_signal(sock, addr, data):
+    """Mensaje iniciado por el servidor: con ACK y reenvíos si el cliente los
+    entiende (ya nos habló con ~tid), con copias redundantes si no."""
+    if addr not in reliable_peers:
+        return _send_redundant_bytes(sock, addr, data)
+    kind = bytes(data[:24]).split(b":", 1)[0].decode(errors="ignore")
+    wire = outbound.send(addr, bytes(data), sock, _signal_lost)
+    return _send_redundant_bytes(sock, addr, wire, copies=1, kind=kind)
+
+
+def _signal_lost(addr, data):
+    log.warn("ERR", "signal_lost", addr=addr, msg=data)
+
+
+def _forget_peer(addr):
+    if reliable_peers.pop(addr, None):
+        outbound.forget(addr)
+
+
+def retransmit(now=None):
+    for addr, wire, sock in outbound.due(now):
+        try:
+            sock.sendto(wire, addr)
+        except Exception as e:
+            log.error("ERR", "send", addr=addr, err=e)
+            continue
+        metrics.reply("RETRANSMIT", 1, len(wire))
+
+
+def _retransmitter():
+    while True:
+        time.sleep(RTX_TICK)
+        retransmit()
+
+
+def forward(to_number, payload, sock, reliable=True):
+    info = clients.get(to_number)
+    if info:
+        ip, port, _, _ = info
+        data = payload.encode() if isinstance(payload, str) else payload
+        try:
+            if reliable and (ip, port) in reliable_peers:
+                # el cliente confirma por esta dirección: no hace falta el puerto declarado
+                _send_signal(sock, (ip, port), data)
+                return True
+            _send_redundant_bytes(sock, (ip, port), data, media=not reliable)
+            cport = claimed.get(to_number, 0)
+            if isinstance(cport, int) and cport > 0 and cport != port:
+                _send_redundant_bytes(sock, (ip, cport), data, media=not reliable)
+            return True
+        except Exception as e:
+            log.error("ERR", "forward", to=to_number, err=e)
+    elif cluster is not None:
+        data = payload.encode() if isinstance(payload, str) else payload
+        if cluster.relay(to_number, data, sock, reliable):
+            return True
+    metrics.forward_failures += 1
+    return False
+
+
+# --- Sesiones de media ---
+#
+# ACCEPT crea una sesión con id numérico ligada a las direcciones observadas de
+# ambos extremos. Cada proceso mantiene un índice directo
+# (sid, addr_origen) -> destinos, así una trama se enruta con un solo lookup,
+# sin tocar números ni el registro. Con sid 0 se enruta solo por dirección.
+
+MEDIA_IDLE = 30.0  # segundos sin tramas antes de cerrar la sesión
+
+
+class MediaSession:
+    __slots__ = ("sid", "caller", "callee", "frames", "seen_frames", "srcs", "speakers")
+
+    def __init__(self, sid, caller, callee):
+        self.sid = sid
+        self.caller = caller
+        self.callee = callee
+        self.frames = 0
+        self.seen_frames = 0
+        self.srcs = []
+        self.speakers = {}  # {addr_origen: número}, para grabar
+
+
+local_sessions = {}  # {sid: MediaSession} (por proceso)
+session_codecs = {}  # {sid: tipo de payload negociado}, solo si no es PCM (por proceso)
+p2p_direct = {}      # {sid: {número}} que mandan su audio directo al otro (por proceso)
+routes = {}          # {(sid, addr): (MediaSession, [destinos])}
+addr_routes = {}     # {addr: (MediaSession, [destinos])}
+
+
+def _endpoint_addrs(number):
+    info = clients.get(number)
+    if not info:
+        return []
+    ip, port = info[0], info[1]
+    out = [(ip, port)]
+    cport = claimed.get(number, 0)
+    if isinstance(cport, int) and 0 < cport < 65536 and cport != port:
+        out.append((ip, cport))
+    return out
+
+
+def _bind_routes(sid, caller, callee):
+    sess = MediaSession(sid, caller, callee)
+    a, b = _endpoint_addrs(caller), _endpoint_addrs(callee)
+    if not a or not b:
+        return None
+    local_sessions[sid] = sess
+    sess.srcs = a + b
+    for src in a:
+        routes[(sid, src)] = addr_routes[src] = (sess, b)
+        sess.speakers[src] = caller
+    for src in b:
+        routes[(sid, src)] = addr_routes[src] = (sess, a)
+        sess.speakers[src] = callee
+    return sess
+
+
+def _unbind_routes(sid):
+    sess = local_sessions.pop(sid, None)
+    if sess is None:
+        return
+    for src in sess.srcs:
+        routes.pop((sid, src), None)
+        r = addr_routes.get(src)
+        if r is not None and r[0] is sess:
+            del addr_routes[src]
+    media_window.forget(lambda k: k[0] == sid)
+    if recorder is not None:
+        recorder.end(sid)
+
+
+def _resolve_route(sid, addr):
+    # Camino lento: la sesión la creó otro worker o cambió una dirección.
+    rec = sessions.get(sid)
+    if not rec:
+        return None
+    _unbind_routes(sid)
+    if _bind_routes(sid, rec[0], rec[1]) is None:
+        return None
+    return routes.get((sid, addr))
+
+
+def relay_media(data, addr, sock):
+    """Ruta rápida para tramas binarias: sin decode, sin hash y sin ACK."""
+    if len(data) < MEDIA_HDR.size or data[0] != 0x80 | MEDIA_VERSION:
+        return False
+    _, pt, seq, _, sid = MEDIA_HDR.unpack_from(data)
+    route = routes.get((sid, addr)) if sid else addr_routes.get(addr)
+    if route is None:
+        room = room_sids.get(sid) if sid else None
+        if room is not None:
+            if pt == codec.PARITY_PT or not media_window.check((sid, addr), seq):
+                metrics.media_dropped += 1
+                return False
+            return room.feed(addr, memoryview(data)[MEDIA_HDR.size:])
+        route = _resolve_route(sid, addr) if sid else None
+        if route is None:
+            metrics.media_dropped += 1
+            return False
+    sess, dsts = route
+    # la paridad (FEC) lleva el seq de la primera trama de su grupo: ventana aparte
+    if not media_window.check((sess.sid, addr) if pt != codec.PARITY_PT
+                              else (sess.sid, addr, pt), seq):
+        metrics.media_dropped += 1
+        return False
+    sess.frames += 1
+    try:
+        for dst in dsts:
+            sock.send_media(data, dst)
+    except Exception as e:
+        log.error("AUDIO", "relay", dst=dsts, err=e)
+        metrics.forward_failures += 1
+        return False
+    metrics.media_relayed += 1
+    metrics.packets_out += len(dsts)
+    if recorder is not None and pt != codec.PARITY_PT:
+        speaker = sess.speakers.get(addr, "?")
+        recorder.tap(sess.sid, speaker, sess.callee if speaker == sess.caller else sess.caller,
+                     data, MEDIA_HDR.size, pt)
+    metrics.bytes_out += len(data) * len(dsts)
+    return True
+
+
+def open_session(caller, callee):
+    close_session(caller)
+    close_session(callee)
+    sid = (WORKER_ID << 24) | (next(_session_ids) & 0xFFFFFF)
+    sessions[sid] = (caller, callee, time.time())
+    session_of[caller] = sid
+    session_of[callee] = sid
+    _bind_routes(sid, caller, callee)
+    return sid
+
+
+def close_session(number):
+    sid = session_of.pop(number, None)
+    rec = sessions.pop(sid, None) if sid is not None else None
+    session_codecs.pop(sid, None)
+    p2p_direct.pop(sid, None)
+    if rec:
+        for n in rec[:2]:
+            if session_of.get(n) == sid:
+                del session_of[n]
+    if sid is not None:
+        _unbind_routes(sid)
+    return sid
+
+
+def expire_media(now, sock):
+    """Tick de sesiones: publica actividad y cierra las inactivas."""
+    for sess in list(local_sessions.values()):
+        rec = sessions.get(sess.sid)
+        if rec is None:
+            _unbind_routes(sess.sid)  # la cerró otro worker
+            continue
+        if sess.frames != sess.seen_frames:
+            sess.seen_frames = sess.frames
+            sessions[sess.sid] = (rec[0], rec[1], now)
+        elif now - rec[2] > MEDIA_IDLE:
+            log.info("SESSION", "idle_close", sid=sess.sid)
+            with lock:
+                close_session(sess.caller)
+            msg = f"SESSION_CLOSED:{sess.sid}".encode()
+            for n in (sess.caller, sess.callee):
+                for dst in _endpoint_addrs(n)[:1]:
+                    _send_signal(sock, dst, msg)
+
+
+# --- Conferencias ---
+#
+# CONF_JOIN:<sala>:<num>[:b64]       -> CONF_JOINED:<sala>:<sid>
+# CONF_LEAVE:<sala>:<num>            -> OK
+# CONF_MEMBERS:<sala>:num,num,...    a todos los de la sala cuando cambia
+# CONF_AUDIO_B64:<sala>:<num>:<b64>  audio de entrada para quien no manda tramas binarias
+# CONF_AUDIO_FROM_B64:<sala>:<b64>   la mezcla, para quien se unió con b64
+#
+# Los participantes mandan su audio (PCM int16 16 kHz mono, 20 ms) en tramas
+# binarias con el sid de la sala. Cada MIX_TICK el mezclador toma una trama por
+# participante, suma todas y a cada uno le manda la suma menos la suya,
+# saturada a int16: una sola trama de bajada por participante tenga la sala
+# los que tenga, y O(N) en vez de O(N²). Quien no ha hablado en el tick recibe
+# la suma entera. Las salas son de cada proceso (con --workers o en clúster,
+# todos los participantes tienen que estar en el mismo).
+
+MIX_TICK = 0.02
+CONF_FRAME = 640  # bytes de PCM por trama
+CONF_MAX = 64     # participantes por sala
+CONF_QUEUE = 4    # tramas por participante esperando al mezclador
+MIXER = "numpy" if np is not None else "audioop" if audioop is not None else "python"
+
+
+def _mix_numpy(frames):
+    a = np.frombuffer(b"".join(frames), dtype=np.int16).reshape(len(frames), -1).astype(np.int32)
+    total = a.sum(axis=0)
+    outs = np.clip(total - a, -32768, 32767).astype(np.int16)
+    return np.clip(total, -32768, 32767).astype(np.int16).tobytes(), [o.tobytes() for o in outs]
+
+
+def _mix_audioop(frames):
+    # En 32 bits con 8 bits de margen (hasta 256 voces a fondo sin desbordar);
+    # mul(x, 4, 256) satura y lin2lin(…, 4, 2) se queda con los 16 bits altos.
+    wide = [audioop.mul(audioop.lin2lin(f, 2, 4), 4, 1 / 256) for f in frames]
+    total = wide[0]
+    for w in wide[1:]:
+        total = audioop.add(total, w, 4)
+
+    def narrow(x):
+        return audioop.lin2lin(audioop.mul(x, 4, 256), 4, 2)
+
+    return narrow(total), [narrow(audioop.add(total, audioop.mul(w, 4, -1), 4)) for w in wide]
+
+
+def _mix_python(frames):
+    cols = [array.array("h", f) for f in frames]
+    total = [sum(s) for s in zip(*cols)]
+
+    def clip(v):
+        return 32767 if v > 32767 else -32768 if v < -32768 else v
+
+    outs = [array.array("h", [clip(t - s) for t, s in zip(total, c)]).tobytes() for c in cols]
+    return array.array("h", [clip(t) for t in total]).tobytes(), outs
+
+
+MIXERS = {"numpy": _mix_numpy, "audioop": _mix_audioop, "python": _mix_python}
+
+
+def mix_frames(frames):
+    """(suma, [suma - trama_i]) de tramas int16 del mismo tamaño, saturado."""
+    return MIXERS[MIXER](frames)
+
+
+class ConfRoom:
+    __slots__ = ("name", "sid", "members", "seq")
+
+    def __init__(self, name, sid):
+        self.name = name
+        self.sid = sid
+        self.members = {}  # {addr: (número, b64, deque de tramas)}
+        self.seq = 0
+
+    def feed(self, addr, pcm):
+        m = self.members.get(addr)
+        if m is None or len(pcm) != CONF_FRAME:
+            metrics.media_dropped += 1
+            return False
+        m[2].append(bytes(pcm))
+        return True
+
+    def tick(self, sock):
+        speakers = []
+        frames = []
+        for addr, m in list(self.members.items()):
+            if m[2]:
+                speakers.append(addr)
+                frames.append(m[2].popleft())
+        if not frames:
+            return 0
+        total, outs = mix_frames(frames)
+        mine = dict(zip(speakers, outs))
+        self.seq += 1
+        hdr = MEDIA_HDR.pack(0x80 | MEDIA_VERSION, 0, self.seq & 0xFFFF,
+                             (self.seq * (CONF_FRAME // 2)) & 0xFFFFFFFF, self.sid)
+        head_b64 = f"CONF_AUDIO_FROM_B64:{self.name}:".encode()
+        sent = 0
+        for addr, (_, b64, _) in list(self.members.items()):
+            pcm = mine.get(addr, total)
+            data = head_b64 + base64.b64encode(pcm) if b64 else hdr + pcm
+            try:
+                sock.send_media(data, addr)
+                sent += 1
+            except Exception as e:
+                log.error("AUDIO", "conf_send", room=self.name, dst=addr, err=e)
+        metrics.conf_frames += sent
+        metrics.packets_out += sent
+        metrics.bytes_out += sent * (len(hdr) + CONF_FRAME)
+        return sent
+
+
+rooms = {}      # {nombre: ConfRoom}
+room_sids = {}  # {sid: ConfRoom}
+conf_of = {}    # {número: (sala, addr)}
+
+
+def _conf_notify(room, sock):
+    names = ",".join(m[0] for m in room.members.values())
+    msg = f"CONF_MEMBERS:{room.name}:{names}".encode()
+    for addr in room.members:
+        _send_signal(sock, addr, msg)
+
+
+def conf_join(name, number, addr, b64, sock):
+    conf_leave(number, sock)
+    room = rooms.get(name)
+    if room is None:
+        sid = (WORKER_ID << 24) | (next(_session_ids) & 0xFFFFFF)
+        room = rooms[name] = room_sids[sid] = ConfRoom(name, sid)
+        log.info("SESSION", "conf_open", room=name, sid=sid)
+    if len(room.members) >= CONF_MAX:
+        return None
+    room.members[addr] = (number, b64, deque(maxlen=CONF_QUEUE))
+    conf_of[number] = (name, addr)
+    _conf_notify(room, sock)
+    return room
+
+
+def conf_leave(number, sock=None):
+    name, addr = conf_of.pop(number, (None, None))
+    room = rooms.get(name)
+    if room is None:
+        return
+    room.members.pop(addr, None)
+    media_window.forget(lambda k: k == (room.sid, addr))
+    if not room.members:
+        del rooms[name]
+        room_sids.pop(room.sid, None)
+        log.info("SESSION", "conf_close", room=name, sid=room.sid)
+    elif sock is not None:
+        _conf_notify(room, sock)
+
+
+def conf_tick(sock):
+    if not rooms:
+        return
+    t0 = time.perf_counter()
+    for room in list(rooms.values()):
+        room.tick(sock)
+    metrics.mix_seconds.observe(time.perf_counter() - t0)
+
+
+def _conf_mixer(sock):
+    nxt = time.monotonic()
+    while True:
+        nxt += MIX_TICK
+        delay = nxt - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            nxt = time.monotonic()  # vamos tarde: no intentar recuperar ticks
+        conf_tick(sock)
+
+
+async def _conf_mixer_async(sock):
+    loop = asyncio.get_running_loop()
+    nxt = loop.time()
+    while True:
+        nxt += MIX_TICK
+        delay = nxt - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            nxt = loop.time()
+        conf_tick(sock)
+
+
+# --- Suscripciones de presencia ---
+#
+# SUBSCRIBE:<num>:<epoch>:<ver>  -> SUBSCRIBED:<epoch>:<ver_actual>
+# PRESENCE:<de>:<a>:+num|nombre,-num,...   deltas empujados por el servidor
+# PRESENCE_RESYNC:<epoch>:<ver>            el suscriptor debe pedir snapshot
+# LIST_PAGE:<cursor>  -> LIST_PAGE:<epoch>:<ver>:<siguiente_cursor>:num|nombre,...
+
+EPOCH = int(time.time())
+PRESENCE_FLUSH = 0.25
+PAGE_BYTES = 1200
+_sorted_dir = (-1, [])  # (versión, números ordenados) para paginar
+
+
+_NAME_JUNK = str.maketrans({c: " " for c in ",|" + "".join(map(chr, [*range(32), 127]))})
+
+
+def _clean_name(name):
+    # "," y "|" separan la lista; los de control (\n sobre todo) partirían
+    # las respuestas que viajan juntas dentro de un ACK
+    return (name or "").translate(_NAME_JUNK)
+
+
+def _presence_on(number, name):
+    presence_log.append(PresenceLog.ON, number, _clean_name(name))
+    if cluster is not None:
+        cluster.local_set(number, name)
+
+
+def _presence_off(number):
+    presence_log.append(PresenceLog.OFF, number)
+    subscribers.pop(number, None)
+    if cluster is not None:
+        cluster.local_del(number)
+
+
+def _encode_deltas(after, events):
+    """Agrupa eventos en datagramas PRESENCE de como mucho PAGE_BYTES."""
+    out = []
+    items = []
+    size = 0
+    start = after
+    for i, (op, num, nm) in enumerate(events):
+        item = f"+{num}|{nm}" if op == PresenceLog.ON else f"-{num}"
+        if items and size + len(item) + 1 > PAGE_BYTES:
+            end = after + i
+            out.append(f"PRESENCE:{start}:{end}:{','.join(items)}".encode())
+            start, items, size = end, [], 0
+        items.append(item)
+        size += len(item) + 1
+    if items:
+        out.append(f"PRESENCE:{start}:{after + len(events)}:{','.join(items)}".encode())
+    return out
+
+
+def subscribe(req, number, epoch, known_ver):
+    # SUBSCRIBED y PRESENCE_RESYNC son la respuesta (dentro del ACK si es
+    # fiable); los deltas atrasados van aparte, como los de presence_flush
+    cur = presence_log.version()
+    subscribers[number] = [req.addr, cur]
+    _dirty(number)
+    req.reply(f"SUBSCRIBED:{EPOCH}:{cur}".encode())
+    if epoch != EPOCH or known_ver <= 0 or known_ver > cur:
+        return
+    events = presence_log.read(known_ver, cur)
+    if events is None:
+        req.reply(f"PRESENCE_RESYNC:{EPOCH}:{cur}".encode())
+        return
+    for dgram in _encode_deltas(known_ver, events):
+        req.sock.sendto(dgram, req.addr)
+        metrics.reply("PRESENCE", 1, len(dgram))
+
+
+def list_page(cursor):
+    global _sorted_dir
+    ver = presence_log.version()
+    if _sorted_dir[0] != ver:
+        keys = clients.keys() | cluster.dir.keys() if cluster is not None else clients.keys()
+        _sorted_dir = (ver, sorted(keys))
+    keys = _sorted_dir[1]
+    i = bisect.bisect_right(keys, cursor) if cursor else 0
+    items = []
+    size = 0
+    nxt = ""
+    while i < len(keys):
+        n = keys[i]
+        info = clients.get(n)
+        i += 1
+        if info:
+            item = f"{n}|{_clean_name(info[3])}"
+        elif cluster is not None and n in cluster.dir:
+            item = f"{n}|{cluster.dir[n][2]}"
+        else:
+            continue
+        if items and size + len(item) + 1 > PAGE_BYTES:
+            nxt = items[-1].split("|", 1)[0]
+            break
+        items.append(item)
+        size += len(item) + 1
+    return f"LIST_PAGE:{EPOCH}:{ver}:{nxt}:{','.join(items)}".encode()
+
+
+def presence_flush(sock):
+    """Empuja a cada suscriptor los cambios posteriores a su versión."""
+    cur = presence_log.version()
+    with lock:
+        pending = [(n, sub[0], sub[1]) for n, sub in subscribers.items() if sub[1] < cur]
+        for n, _, _ in pending:
+            subscribers[n][1] = cur
+    if not pending:
+        return
+    cache = {}
+    for n, addr, after in pending:
+        if after not in cache:
+            events = presence_log.read(after, cur)
+            cache[after] = (None if events is None else _encode_deltas(after, events))
+        dgrams = cache[after]
+        try:
+            if dgrams is None:
+                sock.sendto(f"PRESENCE_RESYNC:{EPOCH}:{cur}".encode(), addr)
+                metrics.reply("PRESENCE_RESYNC", 1, 32)
+                continue
+            for d in dgrams:
+                sock.sendto(d, addr)
+                metrics.reply("PRESENCE", 1, len(d))
+        except Exception as e:
+            log.error("ERR", "presence", addr=addr, err=e)
+
+
+def _presence_pusher(sock):
+    while True:
+        time.sleep(PRESENCE_FLUSH)
+        presence_flush(sock)
+
+
+# --- Clúster ---
+#
+# Varios nodos arrancados con la misma lista --cluster h1:p1,h2:p2,... Cada
+# cliente se registra en el nodo que quiera; los nodos se cuentan sus altas y
+# bajas y así cualquiera sabe en qué nodo está cada número. El nodo de origen
+# de un mensaje es la dirección desde la que llega (solo se aceptan de la lista):
+#
+# GOSSIP:<inc>:+num|ts|nombre,-num|ts,...  cambios locales del emisor (con ACK)
+# GOSSIP_HELLO:<inc>:<seq>:<n>:<xor>       latido cada HELLO_EVERY s con el resumen
+#                                          de sus registros (cuántos y xor de crc32)
+# GOSSIP_SYNC                              pide al otro su estado completo
+# GOSSIP_END:<inc>                         fin del estado completo
+# XFWD:<num>:<fiable>:<saltos>:<mensaje>   mensaje para un cliente del receptor
+#
+# inc es la encarnación del nodo (cambia al reiniciar); ts la hora de alta,
+# si un número aparece en dos nodos gana el alta más reciente. Si el resumen
+# de un nodo no cuadra dos latidos seguidos, o cambia su encarnación, se le
+# pide el estado completo. Un nodo que no late en NODE_TIMEOUT s se da por
+# caído y se olvidan sus números.
+#
+# forward() a un número de otro nodo manda XFWD directamente a ese nodo: un
+# salto. Cada número tiene además un dueño en un anillo de hashing
+# consistente; mientras el directorio no está completo (arranque o
+# resincronización) los números desconocidos se mandan a su dueño, que los
+# reenvía una vez más si sabe dónde están.
+
+CLUSTER_NODES = []  # ["host:puerto", ...]
+NODE_ID = None
+cluster = None
+
+
+class HashRing:
+    """Anillo de hashing consistente con nodos virtuales."""
+
+    def __init__(self, nodes, vnodes=64):
+        points = sorted((zlib.crc32(f"{n}#{i}".encode()), n) for n in nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def owner(self, key, alive=None):
+        """Primer nodo (vivo, si se da alive) siguiendo el anillo desde key."""
+        if not self._nodes:
+            return None
+        i = bisect.bisect(self._hashes, zlib.crc32(key.encode()))
+        size = len(self._nodes)
+        for j in range(size):
+            n = self._nodes[(i + j) % size]
+            if alive is None or n in alive:
+                return n
+        return None
+
+
+def _entry_hash(number, name):
+    return zlib.crc32(f"{number}|{name}".encode())
+
+
+class Cluster:
+    HELLO_EVERY = 1.0
+    NODE_TIMEOUT = 5.0
+
+    def __init__(self, nodes, me, vnodes=64):
+        self.me = me
+        self.inc = int(time.time() * 1000) & 0x7FFFFFFF
+        self.addrs = {}
+        for n in nodes:
+            host, _, port = n.rpartition(":")
+            self.addrs[n] = (socket.gethostbyname(host), int(port))
+        self.by_addr = {a: n for n, a in self.addrs.items() if n != me}
+        self.ring = HashRing(self.addrs, vnodes)
+        self.alive = {me}
+        self.nodes = {}     # {nodo: [inc, último mensaje, latidos seguidos sin cuadrar]}
+        self.dir = {}       # {número: (nodo, ts, nombre, visto)} registros de otros nodos
+        self.local = {}     # {número: (ts, nombre)} registros propios ya anunciados
+        self._local_xor = 0
+        self._sums = {}     # {nodo: [n, xor]} resumen de lo que tenemos de cada nodo
+        self._pending = []  # cambios locales por anunciar
+        self._syncing = {}  # {nodo: monotonic en que se pidió su estado}
+        self._seq = itertools.count(1)
+        self._next_hello = 0.0
+        self.started = time.monotonic()
+        self.relayed = 0
+        self.delivered = 0
+        self.gossip_items = 0
+        self.syncs = 0
+
+    # Cambios locales (con el lock global tomado)
+
+    def local_set(self, number, name, ts=None):
+        if "," in number or "|" in number:
+            return
+        ts = time.time() if ts is None else ts
+        name = _clean_name(name)
+        old = self.local.get(number)
+        if old is not None:
+            self._local_xor ^= _entry_hash(number, old[1])
+        self.local[number] = (ts, name)
+        self._local_xor ^= _entry_hash(number, name)
+        if number in self.dir:
+            self._forget(number)
+        self._pending.append(f"+{number}|{ts:.3f}|{name}")
+
+    def local_del(self, number):
+        old = self.local.pop(number, None)
+        if old is None:
+            return
+        self._local_xor ^= _entry_hash(number, old[1])
+        self._pending.append(f"-{number}|{time.time():.3f}")
+
+    # Directorio de números remotos
+
+    def _put(self, number, entry):
+        old = self.dir.get(number)
+        if old is not None:
+            self._unsum(number, old)
+        self.dir[number] = entry
+        s = self._sums.setdefault(entry[0], [0, 0])
+        s[0] += 1
+        s[1] ^= _entry_hash(number, entry[2])
+        if old is None or old[2] != entry[2]:
+            presence_log.append(PresenceLog.ON, number, entry[2])
+
+    def _forget(self, number):
+        self._unsum(number, self.dir.pop(number))
+
+    def _unsum(self, number, entry):
+        s = self._sums[entry[0]]
+        s[0] -= 1
+        s[1] ^= _entry_hash(number, entry[2])
+
+    def _drop_origin(self, node, before=None):
+        """Olvida los números de node (solo los no confirmados desde before, si se da)."""
+        for number, e in list(self.dir.items()):
+            if e[0] == node and (before is None or e[3] < before):
+                self._forget(number)
+                presence_log.append(PresenceLog.OFF, number)
+
+    def apply(self, node, items):
+        now = time.monotonic()
+        for item in items.split(","):
+            number, _, rest = item[1:].partition("|")
+            ts, _, name = rest.partition("|")
+            try:
+                ts = float(ts)
+            except ValueError:
+                continue
+            if not number or len(number) > MAX_FIELD:
+                continue
+            self.gossip_items += 1
+            cur = self.dir.get(number)
+            if item[0] == "+":
+                if cur is not None and cur[1] > ts:
+                    continue
+                mine = self.local.get(number)
+                if mine is not None:
+                    if mine[0] > ts:
+                        continue
+                    # se ha registrado después en otro nodo: aquí sobra, sin anunciar la baja
+                    del self.local[number]
+                    self._local_xor ^= _entry_hash(number, mine[1])
+                    _drop_local(number)
+                self._put(number, (node, ts, name, now))
+            elif item[0] == "-" and cur is not None and cur[0] == node and cur[1] <= ts:
+                self._forget(number)
+                presence_log.append(PresenceLog.OFF, number)
+
+    def route(self, number, exclude=None):
+        """Nodo al que mandar un mensaje para number, o None si nadie lo tiene."""
+        e = self.dir.get(number)
+        if e is not None and e[0] in self.alive:
+            return e[0]
+        if self._syncing or time.monotonic() - self.started < self.NODE_TIMEOUT:
+            owner = self.ring.owner(number, self.alive)
+            if owner != self.me and owner != exclude:
+                return owner
+        return None
+
+    def relay(self, number, data, sock, reliable=True, hops=0, exclude=None):
+        node = self.route(number, exclude)
+        if node is None:
+            return False
+        msg = b"XFWD:%s:%d:%d:" % (number.encode(), reliable, hops) + data
+        if reliable:
+            _send_signal(sock, self.addrs[node], msg)
+        else:
+            _send_redundant_bytes(sock, self.addrs[node], msg, copies=1, kind="XFWD", media=True)
+        self.relayed += 1
+        return True
+
+    # Mensajes entre nodos
+
+    def current(self, node, inc, sock):
+        """Anota que node está vivo con encarnación inc. False si hay que resincronizar."""
+        now = time.monotonic()
+        st = self.nodes.get(node)
+        if st is not None and st[0] == inc and node in self.alive:
+            st[1] = now
+            return True
+        if st is not None and st[0] != inc:
+            self._drop_origin(node)  # se reinició: lo que sabíamos ya no vale
+            log.info("SYS", "cluster_restart", node=node)
+        else:
+            log.info("SYS", "cluster_up", node=node)
+        self.nodes[node] = [inc, now, 0]
+        self.alive.add(node)
+        self.request_sync(node, sock)
+        return False
+
+    def request_sync(self, node, sock):
+        self._syncing[node] = time.monotonic()
+        self.syncs += 1
+        _send_signal(sock, self.addrs[node], b"GOSSIP_SYNC")
+
+    def on_hello(self, node, inc, n, x, sock):
+        if not self.current(node, inc, sock) or node in self._syncing:
+            return
+        st = self.nodes[node]
+        if tuple(self._sums.get(node, (0, 0))) == (n, x):
+            st[2] = 0
+            return
+        st[2] += 1
+        if st[2] >= 2:  # uno solo puede ser un GOSSIP aún en camino
+            st[2] = 0
+            self.request_sync(node, sock)
+
+    def on_sync(self, node, sock):
+        """Manda a node todos los registros propios."""
+        items = [f"+{n}|{ts:.3f}|{nm}" for n, (ts, nm) in self.local.items()]
+        self._push(sock, [node], items)
+        _send_signal(sock, self.addrs[node], b"GOSSIP_END:%d" % self.inc)
+
+    def on_end(self, node, inc):
+        started = self._syncing.pop(node, None)
+        st = self.nodes.get(node)
+        if started is not None and st is not None and st[0] == inc:
+            self._drop_origin(node, before=started)
+
+    def _push(self, sock, nodes, items):
+        head = b"GOSSIP:%d:" % self.inc
+        batch = []
+        size = 0
+        for item in items + [None]:
+            if item is None or (batch and size + len(item) + 1 > PAGE_BYTES):
+                if not batch:
+                    break
+                dgram = head + ",".join(batch).encode()
+                for node in nodes:
+                    _send_signal(sock, self.addrs[node], dgram)
+                batch, size = [], 0
+            if item is not None:
+                batch.append(item)
+                size += len(item) + 1
+
+    def tick(self, sock, now=None):
+        """Anuncia los cambios locales, late y detecta nodos caídos."""
+        now = time.monotonic() if now is None else now
+        with lock:
+            pending, self._pending = self._pending, []
+            peers = [n for n in self.alive if n != self.me]
+            if pending and peers:
+                self._push(sock, peers, pending)
+            if now < self._next_hello:
+                return
+            self._next_hello = now + self.HELLO_EVERY
+            for node, st in self.nodes.items():
+                if node in self.alive and now - st[1] > self.NODE_TIMEOUT:
+                    self.alive.discard(node)
+                    self._syncing.pop(node, None)
+                    self._drop_origin(node)
+                    log.warn("SYS", "cluster_down", node=node)
+            for node, started in list(self._syncing.items()):
+                if now - started > self.NODE_TIMEOUT:
+                    del self._syncing[node]  # el GOSSIP_END no llegó: el resumen lo dirá
+            hello = b"GOSSIP_HELLO:%d:%d:%d:%d" % (self.inc, next(self._seq),
+                                                    len(self.local), self._local_xor)
+        for addr in self.by_addr:
+            _send_redundant_bytes(sock, addr, hello, copies=1)
+
+
+def _drop_local(number):
+    info = clients.pop(number, None)
+    if info is not None:
+        _forget_peer((info[0], info[1]))
+    claimed.pop(number, None)
+    presence.discard(number)
+    close_session(number)
+    conf_leave(number)
+    subscribers.pop(number, None)
+    _dirty(number)
+
+
+def open_cluster():
+    global cluster
+    if not CLUSTER_NODES:
+        return
+    cluster = Cluster(CLUSTER_NODES, NODE_ID)
+    for addr in cluster.by_addr:
+        reliable_peers[addr] = True
+        admission.trusted.add(addr)
+    with lock:
+        for number, info in clients.items():  # los que repuso --state-dir
+            cluster.local_set(number, info[3], ts=info[2])
+    log.info("SYS", "cluster", node=NODE_ID, nodes=len(CLUSTER_NODES), inc=cluster.inc)
+
+
+def _cluster_ticker(sock):
+    while True:
+        time.sleep(RTX_TICK)
+        cluster.tick(sock)
+
+
+# --- Registro persistente (arranque en caliente) ---
+#
+# Con --state-dir el registro sobrevive a un reinicio: los manejadores solo
+# apuntan qué números han cambiado; un hilo aparte escribe cada JOURNAL_FLUSH
+# segundos el estado actual de esos números al final de registry.journal y cada
+# SNAPSHOT_EVERY segundos (o al parar con SIGTERM) compacta todo en
+# registry.snap y vacía el journal. Al arrancar se leen ambos vía mmap y cada
+# cliente vuelve con su last_seen, así conserva el TTL que le quedaba; la época
+# y la versión de presencia también, y los suscriptores al día no notan nada.
+
+STATE_DIR = None
+JOURNAL_FLUSH = 0.5
+SNAPSHOT_EVERY = 60.0
+WORKER_SNAPSHOT = 5.0
+JOURNAL_MAX = 4 << 20
+
+
+class RegistryStore:
+    # op, crc32 del resto | número, ip, puerto, last_seen, puerto declarado,
+    # flags, versión del suscriptor, nombre. En los registros VER, sub_ver es
+    # la versión de presencia y last_seen la época.
+    _HEAD = struct.Struct("!BI")
+    _BODY = struct.Struct("!32s4sHdiBQ96s")
+    SIZE = _HEAD.size + _BODY.size
+    SET, DEL, VER = 1, 2, 3
+    RELIABLE, SUBSCRIBED = 1, 2
+    MAGIC = b"VREG\x00\x01"
+
+    def __init__(self, directory):
+        self.dir = directory
+        self.snap_path = os.path.join(directory, "registry.snap")
+        self.journal_path = os.path.join(directory, "registry.journal")
+        self._dirty = set()
+        self._journal = None
+        self._last_snapshot = time.monotonic()
+        self.records = 0
+
+    def mark(self, number):
+        self._dirty.add(number)
+
+    # --- codificación ---
+
+    def _record(self, op, number="", info=None, cport=0, flags=0, sub_ver=0):
+        if info is None:
+            ip, port, last, name = "0.0.0.0", 0, 0.0, ""
+        else:
+            ip, port, last, name = info
+        body = self._BODY.pack(number.encode()[:32], socket.inet_aton(ip), port, last,
+                               cport if isinstance(cport, int) else 0, flags, sub_ver,
+                               (name or "").encode()[:96])
+        return self._HEAD.pack(op, zlib.crc32(body)) + body
+
+    def _state(self, number, info):
+        if info is None:
+            return self._record(self.DEL, number)
+        flags = 0
+        if (info[0], info[1]) in reliable_peers:
+            flags |= self.RELIABLE
+        sub = subscribers.get(number)
+        if sub is not None:
+            flags |= self.SUBSCRIBED
+        return self._record(self.SET, number, info, claimed.get(number, 0), flags,
+                            sub[1] if sub is not None else 0)
+
+    def _version(self):
+        return self._record(self.VER, info=("0.0.0.0", 0, float(EPOCH), ""),
+                            sub_ver=presence_log.version())
+
+    # --- escritura (hilo propio) ---
+
+    # Bajo el lock solo se cambia el conjunto de sucios; el estado se lee
+    # después. Si algo cambia entre medias vuelve a quedar sucio y sale en la
+    # siguiente escritura, que se aplica encima de esta al cargar.
+
+    def flush(self):
+        with lock:
+            if not self._dirty:
+                return 0
+            dirty, self._dirty = self._dirty, set()
+        recs = [self._state(n, clients.get(n)) for n in dirty]
+        recs.append(self._version())
+        if self._journal is None:
+            self._journal = open(self.journal_path, "ab")
+        self._journal.write(b"".join(recs))
+        self._journal.flush()
+        return len(recs)
+
+    def snapshot(self):
+        with lock:
+            self._dirty.clear()
+        recs = [self._state(n, info) for n, info in list(clients.items())]
+        recs.append(self._version())
+        tmp = self.snap_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(b"".join(recs))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snap_path)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, "wb")
+        self._last_snapshot = time.monotonic()
+        log.info("SYS", "snapshot", clients=len(recs) - 1)
+
+    def run(self, flush=JOURNAL_FLUSH, every=SNAPSHOT_EVERY):
+        while True:
+            time.sleep(flush)
+            try:
+                self.flush()
+                if (time.monotonic() - self._last_snapshot >= every
+                        or self._journal is not None and self._journal.tell() > JOURNAL_MAX):
+                    self.snapshot()
+            except Exception as e:
+                log.error("ERR", "registry_write", err=e)
+
+    def start(self, flush=JOURNAL_FLUSH, every=SNAPSHOT_EVERY):
+        threading.Thread(target=self.run, args=(flush, every), daemon=True).start()
+
+    def close(self):
+        try:
+            self.flush()
+            self.snapshot()
+        except Exception as e:
+            log.error("ERR", "registry_write", err=e)
+
+    # --- lectura ---
+
+    def _read(self, path, skip=0):
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= skip:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if skip and mm[:skip] != self.MAGIC:
+                    log.warn("SYS", "snapshot_bad_magic", path=path)
+                    return
+                hs, n = self._HEAD.size, self.SIZE
+                for off in range(skip, size - n + 1, n):
+                    op, crc = self._HEAD.unpack_from(mm, off)
+                    if zlib.crc32(mm[off + hs:off + n]) != crc:
+                        log.warn("SYS", "journal_torn", path=path, offset=off)
+                        return  # cola a medio escribir: lo anterior vale
+                    yield (op,) + self._BODY.unpack_from(mm, off + hs)
+            finally:
+                mm.close()
+
+    def load(self):
+        """Lee snapshot + journal y repone el registro. Devuelve cuántos clientes."""
+        global EPOCH
+        os.makedirs(self.dir, exist_ok=True)
+        state = {}
+        ver = None
+        for path, skip in ((self.snap_path, len(self.MAGIC)), (self.journal_path, 0)):
+            for op, num, ip, port, last, cport, flags, sub_ver, name in self._read(path, skip):
+                if op == self.VER:
+                    ver = (int(last), sub_ver)
+                    continue
+                num = num.rstrip(b"\0").decode(errors="ignore")
+                if op == self.DEL:
+                    state.pop(num, None)
+                elif op == self.SET:
+                    state[num] = (socket.inet_ntoa(ip), port, last,
+                                  name.rstrip(b"\0").decode(errors="ignore"),
+                                  cport, flags, sub_ver)
+                self.records += 1
+        with lock:
+            if ver is not None:
+                EPOCH = ver[0]
+                presence_log.restore(ver[1])
+            for num, (ip, port, last, name, cport, flags, sub_ver) in state.items():
+                # los que caducaron durante la parada los quita cleanup() como siempre
+                clients[num] = (ip, port, last, name)
+                if cport:
+                    claimed[num] = cport
+                presence.touch(num, last)
+                if flags & self.RELIABLE:
+                    reliable_peers[(ip, port)] = True
+                if flags & self.SUBSCRIBED:
+                    subscribers[num] = [(ip, port), sub_ver]
+        log.info("SYS", "registry_loaded", clients=len(state), records=self.records,
+                 epoch=EPOCH, version=presence_log.version())
+        return len(state)
+
+
+registry_store = None
+
+
+def _dirty(number):
+    if registry_store is not None:
+        registry_store.mark(number)
+
+
+def _stop(signum, frame):
+    raise SystemExit(0)
+
+
+def _last_seen(number):
+    info = clients.get(number)
+    return info[2] if info else None
+
+
+def expire(now, sock):
+    """Una pasada de caducidad: presencia, cachés y sesiones de media."""
+    with lock:
+        for n in presence.pop_expired(now, EXPIRY_BUDGET, _last_seen):
+            log.info("ONLINE", "offline", number=n)
+            info = clients.pop(n, None)
+            if info is not None:
+                _presence_off(n)
+                _forget_peer((info[0], info[1]))
+            claimed.pop(n, None)
+            close_session(n)
+            conf_leave(n, sock)
+            _dirty(n)
+    recent.expire(EXPIRY_BUDGET)
+    inbound.expire(EXPIRY_BUDGET)
+    expire_media(now, sock)
+
+
+def _dedup_report():
+    log.info("SYS", "dedup", text=recent.dropped, media=media_window.dropped,
+             late=media_window.late, cache=len(recent), windows=len(media_window))
+
+
+def cleanup(sock):
+    # Modo hilos; en asyncio expire() corre en el propio loop (_serve_async)
+    last_report = time.time()
+    while True:
+        time.sleep(EXPIRY_TICK)
+        now = time.time()
+        expire(now, sock)
+        if now - last_report >= 30:
+            last_report = now
+            _dedup_report()
+
+
+def handle(data, addr, sock):
+    metrics.packets_in += 1
+    metrics.bytes_in += len(data)
+    if data and data[0] >= 0x80:
+        if metrics.packets_in % RELAY_SAMPLE:
+            relay_media(data, addr, sock)
+        else:
+            t0 = time.perf_counter()
+            relay_media(data, addr, sock)
+            metrics.relay_seconds.observe(time.perf_counter() - t0)
+        return
+    t0 = time.perf_counter()
+    try:
+        handle_text(data, addr, sock)
+    finally:
+        metrics.handle_seconds.observe(time.perf_counter() - t0)
+
+
+# --- Captura de tráfico ---
+#
+# Con --capture FICHERO se guarda cada datagrama recibido (también los que
+# luego tira el control de admisión) para reproducirlo con replay.py:
+#
+#   "VCAP\0\1" + hora de inicio (!d)
+#   por datagrama: µs desde el inicio (!Q), IPv4 (4s), puerto (!H), longitud (!H), bytes
+#
+# record() solo añade a una cola acotada; un hilo la vuelca en bloques cada
+# CAPTURE_FLUSH s. Si la cola se llena se pierden datagramas de la traza (se
+# cuentan), nunca se frena el servidor. Ojo: la traza lleva el audio tal cual.
+
+CAPTURE_PATH = None
+CAPTURE_FLUSH = 0.05
+
+
+class Capture:
+    MAGIC = b"VCAP\x00\x01"
+    HEAD = struct.Struct("!d")
+    REC = struct.Struct("!Q4sHH")
+
+    def __init__(self, path, maxsize=200000):
+        self.path = path
+        self.maxsize = maxsize
+        self.records = 0
+        self.dropped = 0
+        self._q = deque()
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        self._f = open(path, "wb")
+        self._f.write(self.MAGIC + self.HEAD.pack(time.time()))
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def record(self, data, addr):
+        if len(self._q) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._q.append((time.monotonic(), addr, data))
+
+    def _flush(self):
+        with self._lock:
+            if self._f is not None and self._q:
+                self._write(self._q)
+
+    def _write(self, q):
+        rec = self.REC.pack
+        t0 = self._t0
+        parts = []
+        while q:
+            t, addr, data = q.popleft()
+            try:
+                ip = socket.inet_aton(addr[0])
+            except OSError:
+                continue
+            parts.append(rec(int((t - t0) * 1e6), ip, addr[1], len(data)))
+            parts.append(data)
+        self.records += len(parts) // 2
+        self._f.write(b"".join(parts))
+        self._f.flush()
+
+    def _writer(self):
+        while self._f is not None:
+            time.sleep(CAPTURE_FLUSH)
+            try:
+                self._flush()
+            except (OSError, ValueError) as e:
+                log.error("ERR", "capture", err=e)
+
+    def close(self):
+        self._flush()
+        with self._lock:
+            f, self._f = self._f, None
+        if f is not None:
+            f.close()
+            log.info("SYS", "capture_closed", path=self.path, records=self.records,
+                     dropped=self.dropped)
+
+    @classmethod
+    def read(cls, path):
+        """Genera (segundos desde el inicio, (ip, puerto), bytes) de una traza."""
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(cls.MAGIC) + cls.HEAD.size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if m[:len(cls.MAGIC)] != cls.MAGIC:
+                    raise ValueError(f"{path}: no es una traza de svr.py")
+                off = len(cls.MAGIC) + cls.HEAD.size
+                rec = cls.REC
+                while off + rec.size <= size:
+                    us, ip, port, n = rec.unpack_from(m, off)
+                    off += rec.size
+                    if off + n > size:
+                        break  # último registro a medio escribir
+                    yield us / 1e6, (socket.inet_ntoa(ip), port), m[off:off + n]
+                    off += n
+
+
+capture = None
+
+
+def open_capture(suffix=""):
+    global capture
+    if CAPTURE_PATH:
+        path = CAPTURE_PATH + suffix
+        capture = Capture(path)
+        signal.signal(signal.SIGTERM, _stop)  # que al parar se vuelque lo pendiente
+        log.info("SYS", "capture", path=path)
+
+
+# --- Grabación de llamadas ---
+#
+# Con --record DIR se graba el audio de cada llamada reenviada: un WAV mono
+# (PCM int16 16 kHz) por cada lado de la llamada, DIR/<sid>-<num>.wav, y al
+# lado un .json con quién llamó a quién, inicio, fin, tramas y partes.
+#
+# El relay no toca el disco: tap() solo añade la trama a una cola acotada
+# (sin lock; deque.append es atómico). Un hilo la vacía cada RECORD_FLUSH s
+# con escrituras grandes. Los huecos de más de RECORD_GAP tramas se rellenan
+# con silencio para que los dos lados sigan alineados con el reloj. Cada
+# parte se cierra al pasar de --record-max-mb y sigue en <sid>-<num>.2.wav.
+# Si el disco no da abasto se pierden tramas de la grabación (se cuentan por
+# motivo), nunca tramas del relay. Con --workers cada proceso graba los lados
+# que recibe él; los nombres no chocan. Las llamadas en Opus (codec.py) se
+# decodifican en el hilo escritor; sin opuslib esas tramas no se graban
+# (reason="codec").
+
+RECORD_DIR = None
+RECORD_FLUSH = 0.2
+RECORD_GAP = 3        # tramas de retraso que se toleran antes de meter silencio
+RECORD_IDLE = 10.0    # segundos sin audio antes de cerrar un lado
+RECORD_PART_MB = 64
+RECORD_BUFFER = 1 << 20
+RECORD_YIELD = 256    # tramas entre pausas del escritor, para soltar el GIL
+
+
+class _Leg:
+    __slots__ = ("base", "meta", "wav", "f", "part", "parts", "t0", "frames", "silence",
+                 "bytes", "last", "buf", "dec")
+
+    def __init__(self, base, meta, t):
+        self.base = base
+        self.meta = meta
+        self.wav = self.f = None
+        self.part = 0
+        self.parts = []
+        self.t0 = t
+        self.frames = 0   # tramas grabadas, silencio incluido
+        self.silence = 0
+        self.bytes = 0    # de la parte actual
+        self.last = t
+        self.buf = []     # PCM pendiente de escribir en esta pasada
+        self.dec = None   # decodificador si el lado no manda PCM
 
-lock = threading.Lock()
 
-def _send_redundant_bytes(sock, addr, data, copies=2, delay=0.01):
-    ok = False
-    for i in range(max(1, copies)):
+class Recorder:
+    def __init__(self, path, part_mb=RECORD_PART_MB, maxsize=50000):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.part_bytes = int(part_mb * 1e6)
+        self.maxsize = maxsize
+        self.frames = 0
+        self.bytes = 0
+        self.calls = 0
+        self.dropped = {"queue": 0, "disk": 0, "codec": 0}
+        self.legs = {}  # {(sid, num): _Leg}, solo del hilo escritor
+        self._q = deque()
+        self._stop = False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def tap(self, sid, speaker, peer, data, off, pt=0):
+        """Encola una trama; off = inicio del payload, o -1 si data es base64."""
+        if len(self._q) >= self.maxsize:
+            self.dropped["queue"] += 1
+            return
+        self._q.append((time.monotonic(), sid, speaker, peer, data, off, pt))
+
+    def end(self, sid):
+        self._q.append((time.monotonic(), sid, None, None, None, 0, 0))
+
+    def _open(self, leg):
+        while True:
+            # un lado que vuelve tras RECORD_IDLE (o tras reiniciar) no pisa lo grabado
+            leg.part += 1
+            name = leg.base + (f".{leg.part}" if leg.part > 1 else "") + ".wav"
+            if not os.path.exists(os.path.join(self.path, name)):
+                break
+        leg.f = open(os.path.join(self.path, name), "wb", buffering=RECORD_BUFFER)
+        leg.wav = wave.open(leg.f, "wb")
+        leg.wav.setnchannels(1)
+        leg.wav.setsampwidth(2)
+        leg.wav.setframerate(16000)
+        leg.parts.append(name)
+        leg.bytes = 0
+
+    def _close_part(self, leg):
+        wav, f, leg.wav, leg.f = leg.wav, leg.f, None, None
+        if wav is not None:
+            wav.close()  # reescribe los tamaños de la cabecera
+            f.close()
+
+    def _close(self, key):
+        leg = self.legs.pop(key)
         try:
-            sock.sendto(data, addr)
-            ok = True
-        except Exception as e:
-            print(f"[ERR] send to {addr}: {e}")
-        if copies > 1 and i < copies - 1:
-            time.sleep(delay)
-    return ok
+            self._flush(leg)
+            self._close_part(leg)
+        except OSError as e:
+            self.dropped["disk"] += 1
+            log.error("ERR", "record_close", sid=key[0], err=e)
+        if not leg.parts:
+            return
+        meta = dict(leg.meta, start=round(time.time() - (time.monotonic() - leg.t0), 3),
+                    seconds=round(leg.frames * MIX_TICK, 2), frames=leg.frames,
+                    silence_frames=leg.silence, parts=leg.parts)
+        try:
+            with open(os.path.join(self.path, leg.parts[0][:-4] + ".json"), "w") as f:
+                json.dump(meta, f)
+        except OSError as e:
+            log.error("ERR", "record_meta", sid=key[0], err=e)
 
-def _send_ok(sock, addr):
-    return _send_redundant_bytes(sock, addr, b"OK", copies=2, delay=0.02)
+    def _leg(self, t, sid, speaker, peer):
+        base = f"{sid}-" + "".join(c if c.isalnum() else "_" for c in speaker)
+        leg = self.legs[(sid, speaker)] = _Leg(base, {"sid": sid, "speaker": speaker,
+                                                      "peer": peer}, t)
+        self.calls += 1
+        return leg
 
-def forward(to_number, payload, sock):
-    info = clients.get(to_number)
-    if info:
-        ip, port, _, _ = info
+    def _decode(self, leg, pt, payload):
+        if leg.dec is None or leg.dec.pt != pt:
+            cls = codec.for_pt(pt)
+            try:
+                leg.dec = cls() if cls is not None else None
+            except RuntimeError:
+                leg.dec = None
+            if leg.dec is None:
+                self.dropped["codec"] += 1
+                return None
         try:
-            _send_redundant_bytes(sock, (ip, port), payload.encode(), copies=2, delay=0.02)
-            cport = claimed.get(to_number, 0)
-            if isinstance(cport, int) and cport > 0 and cport != port:
-                _send_redundant_bytes(sock, (ip, cport), payload.encode(), copies=2, delay=0.02)
+            return leg.dec.decode(payload)
+        except Exception:
+            self.dropped["codec"] += 1
+            return None
+
+    def _flush(self, leg):
+        if not leg.buf:
+            return
+        out = b"".join(leg.buf)
+        leg.buf.clear()
+        if leg.wav is None or leg.bytes >= self.part_bytes:
+            self._close_part(leg)
+            self._open(leg)
+        leg.wav.writeframesraw(out)
+        leg.bytes += len(out)
+        self.bytes += len(out)
+
+    def _drain(self):
+        q = self._q
+        legs = self.legs
+        ended = set()
+        n = 0
+        while q:
+            t, sid, speaker, peer, data, off, pt = q.popleft()
+            if speaker is None:
+                ended.add(sid)
+                continue
+            leg = legs.get((sid, speaker)) or self._leg(t, sid, speaker, peer)
+            if off < 0:
+                # AUDIO_B64 lleva delante el número de trama del cliente (<n>:<b64>)
+                pcm = base64.b64decode(bytes(data).rsplit(b":", 1)[-1])
+            else:
+                pcm = memoryview(data)[off:]
+            if pt:
+                # comprimido: se decodifica aquí, fuera del relay
+                pcm = self._decode(leg, pt, pcm)
+                if pcm is None:
+                    continue
+            gap = int((t - leg.t0) / MIX_TICK) - leg.frames
+            if gap > RECORD_GAP:
+                gap = min(gap, int(RECORD_IDLE / MIX_TICK))
+                leg.buf.append(bytes(len(pcm) * gap))
+                leg.frames += gap
+                leg.silence += gap
+            leg.buf.append(pcm)
+            leg.frames += 1
+            leg.last = t
+            n += 1
+            if n % RECORD_YIELD == 0:
+                time.sleep(0)  # que el relay no espere al GIL mientras se vacía la cola
+        self.frames += n
+        now = time.monotonic()
+        for key, leg in list(self.legs.items()):
+            if key[0] in ended or now - leg.last > RECORD_IDLE:
+                self._close(key)
+                continue
+            try:
+                self._flush(leg)
+            except OSError as e:
+                # disco lleno o lento: se pierde este trozo de la grabación y se sigue
+                self.dropped["disk"] += 1
+                log.warn("SYS", "record_write", sid=key[0], err=e)
+
+    def _writer(self):
+        while not self._stop:
+            time.sleep(RECORD_FLUSH)
+            try:
+                self._drain()
+            except Exception as e:
+                log.error("ERR", "recorder", err=e)
+
+    def close(self):
+        self._stop = True
+        self._thread.join(RECORD_FLUSH * 5)
+        self._drain()
+        for key in list(self.legs):
+            self._close(key)
+        log.info("SYS", "record_closed", path=self.path, calls=self.calls, frames=self.frames,
+                 dropped=sum(self.dropped.values()))
+
+
+recorder = None
+
+
+def open_recorder():
+    global recorder
+    if RECORD_DIR:
+        recorder = Recorder(RECORD_DIR, RECORD_PART_MB)
+        signal.signal(signal.SIGTERM, _stop)  # que al parar se cierren los WAV
+        log.info("SYS", "record", path=RECORD_DIR)
+
+
+# --- Despacho de comandos ---
+#
+# Cada comando de texto se registra con cuántos campos de cabecera usa y si
+# lleva payload. El parser solo separa esos campos (acotados a 32 caracteres);
+# el payload queda como memoryview del datagrama original, sin split ni join.
+# Para añadir un comando sin tocar este fichero:
+#
+#   @svr.command("ECHO", fields=1, payload=True)
+#   def _echo(req):
+#       req.reply(b"ECHO:" + req.payload)
+
+MAX_FIELD = 32
+HEADER_MAX = 256  # bytes en los que se buscan los campos de cabecera
+
+
+class Request:
+    __slots__ = ("cmd", "args", "payload", "addr", "sock", "replies")
+
+    def __init__(self, cmd, args, payload, addr, sock, replies=None):
+        self.cmd = cmd
+        self.args = args        # [str], exactamente los campos declarados
+        self.payload = payload  # memoryview o None
+        self.addr = addr
+        self.sock = sock
+        self.replies = replies  # lista si la respuesta viaja dentro del ACK
+
+    def reply(self, data):
+        """Responde al emisor: dentro del ACK si pidió entrega fiable, si no con copias."""
+        if self.replies is not None:
+            self.replies.append(bytes(data))
             return True
+        return _send_redundant_bytes(self.sock, self.addr, data)
+
+
+class Command:
+    __slots__ = ("handler", "fields", "min_fields", "payload", "locked", "names")
+
+    def __init__(self, handler, fields, min_fields, payload, locked):
+        self.handler = handler
+        self.fields = fields
+        self.min_fields = min_fields
+        self.payload = payload
+        self.locked = locked
+        self.names = {}  # {token en bytes: nombre}
+
+
+COMMANDS = {}   # {nombre: Command}
+_BY_TOKEN = {}  # {nombre en bytes: Command}, para no decodificar el comando
+
+
+def register_command(names, handler, fields=0, payload=False, min_fields=0, locked=True):
+    """Registra (o reemplaza) el manejador de uno o varios comandos de texto.
+
+    fields: campos de cabecera tras el comando; payload: si el resto del
+    datagrama es un payload obligatorio; min_fields: mínimo para no responder
+    ERR; locked: ejecutar con el lock global tomado.
+    """
+    if isinstance(names, str):
+        names = (names,)
+    spec = Command(handler, fields, min_fields, payload, locked)
+    for name in names:
+        token = name.encode()
+        spec.names[token] = name
+        COMMANDS[name] = spec
+        _BY_TOKEN[token] = spec
+        KNOWN_COMMANDS.add(name)
+    return handler
+
+
+def command(*names, **opts):
+    def deco(fn):
+        return register_command(names, fn, **opts)
+    return deco
+
+
+def parse_request(data, addr, sock, replies=None):
+    """Devuelve (cmd, Command o None, Request o None si está malformado).
+
+    Solo se miran los primeros HEADER_MAX bytes y como mucho los campos que
+    declara el comando; el payload no se copia ni se decodifica.
+    """
+    if not data:
+        return "", None, None
+    if data[-1] < 33:
+        data = data.rstrip()
+    head = data[:HEADER_MAX]
+    i = head.find(b":")
+    key = head[:i] if i >= 0 else head
+    spec = _BY_TOKEN.get(key)
+    if spec is None:
+        key = key.strip()
+        spec = _BY_TOKEN.get(key)
+        if spec is None:
+            return key.decode(errors="ignore"), None, None
+    cmd = spec.names[key]
+    n = spec.fields
+    payload = None
+    if i < 0 or not n:
+        args = []
+    elif spec.payload:
+        parts = head.split(b":", n + 1)
+        if len(parts) < n + 2:
+            return cmd, spec, None
+        off = len(head) - len(parts[-1])
+        args = head[i + 1:off - 1].decode(errors="ignore").split(":")
+        payload = memoryview(data)[off:]
+    else:
+        args = head[i + 1:].decode(errors="ignore").split(":", n)
+        if len(args) > n:
+            del args[n]
+    if len(args) < n:
+        if len(args) < spec.min_fields or spec.payload:
+            return cmd, spec, None
+        args += [""] * (n - len(args))
+    args = [a[:MAX_FIELD] for a in args]
+    return cmd, spec, Request(cmd, args, payload, addr, sock, replies)
+
+
+def handle_text(data, addr, sock):
+    if not data or len(data) > 65535:
+        return
+    if data[:1] == b"~":
+        _handle_reliable(data, addr, sock)
+        return
+    if recent.seen(addr, data):
+        return
+    _dispatch(data, addr, sock)
+
+
+def _handle_reliable(data, addr, sock):
+    # ~tid:<comando>: las respuestas salen una vez dentro de ACK:tid; si el
+    # cliente no lo recibe reenvía el comando y repetimos el mismo ACK.
+    tid, body = reliable.unwrap(data)
+    if tid is None or not body:
+        if admission.allow_error(addr):
+            _send_redundant_bytes(sock, addr, b"ERR", copies=1)
+        return
+    cached = inbound.begin(addr, tid)
+    if cached is not None:
+        if cached:
+            _send_redundant_bytes(sock, addr, cached, copies=1, kind="ACK")
+        return
+    reliable_peers[addr] = True
+    replies = []
+    try:
+        _dispatch(body, addr, sock, replies)
+    finally:
+        out = reliable.ack(tid, replies)
+        inbound.finish(addr, tid, out)
+        _send_redundant_bytes(sock, addr, out, copies=1, kind="ACK")
+
+
+def _dispatch(data, addr, sock, replies=None):
+    cmd, spec, req = parse_request(data, addr, sock, replies)
+    metrics.command(cmd)
+    if cmd == "AUDIO_B64" or cmd == "CONF_AUDIO_B64":
+        log.debug("AUDIO", "rec", msg=data, addr=addr)
+    elif cmd in CLUSTER_COMMANDS:
+        log.debug("CLUSTER", "rec", msg=data, addr=addr)
+    elif cmd != "ACK":
+        log.info("REC", "rec", msg=data, addr=addr)
+
+    if spec is None or req is None:
+        if spec is not None:
+            log.warn("ICE" if spec.payload else "REC", "malformed", cmd=cmd, addr=addr)
+        if replies is not None:
+            replies.append(b"ERR")
+            return
+        if not admission.allow_error(addr):
+            return
+        try:
+            _send_redundant_bytes(sock, addr, b"ERR", copies=1)
         except Exception as e:
-            print(f"[ERR] forward to {to_number}: {e}")
+            log.error("ERR", "unknown_cmd", addr=addr, err=e)
+        return
+
+    if spec.locked:
+        with lock:
+            spec.handler(req)
+    else:
+        spec.handler(req)
+
+
+def _forward_or_offline(req, to, payload):
+    if forward(to, payload, req.sock):
+        req.reply(b"OK")
+        return True
+    req.reply(f"OFFLINE:{to}".encode())
+    log.info("CALL", "miss", to=to)
     return False
 
 
-def cleanup():
-    while True:
-        time.sleep(30)
-        now = time.time()
-        with lock:
-            expired = [n for n, (_, _, t, _) in clients.items() if now - t > 60]
-            for n in expired:
-                print(f"[OFFLINE] {n}")
-                del clients[n]
+@command("REGISTER", fields=3, min_fields=1)
+def _cmd_register(req):
+    number, port, name = req.args
+    name = _clean_name(name)
+    addr = req.addr
+    try:
+        claimed_port = int(port) if port else 0
+    except ValueError:
+        claimed_port = 0
+    now = time.time()
+    prev = clients.get(number)
+    clients[number] = (addr[0], addr[1], now, name)
+    presence.touch(number, now)
+    _dirty(number)
+    if prev is None or prev[3] != name:
+        _presence_on(number, name)
+    if prev is not None and prev[:2] != (addr[0], addr[1]):
+        _forget_peer((prev[0], prev[1]))
+        sid = session_of.get(number)
+        if sid is not None:
+            _unbind_routes(sid)  # se reconstruye con la dirección nueva
+    try:
+        claimed[number] = claimed_port
+    except Exception:
+        pass
+    log.info("ONLINE", "register", number=number, name=name, addr=addr, claimed=claimed_port)
+    req.reply(b"OK")
 
 
-def handle(data, addr, sock):
+@command("PING", fields=1)
+def _cmd_ping(req):
+    number = req.args[0]
+    addr = req.addr
+    now = time.time()
+    if number in clients:
+        ip, port, _, name = clients[number]
+        clients[number] = (ip, port, now, name)
+    else:
+        clients[number] = (addr[0], addr[1], now, "")
+        _presence_on(number, "")
+        log.info("ONLINE", "auto_register", number=number, addr=addr)
+    presence.touch(number, now)
+    _dirty(number)
     try:
-        if len(data) > 65535:
-            return
-        msg = data.decode(errors="ignore").strip()
-        print(f"[REC] {msg} from {addr}")
-    except:
+        req.reply(b"PONG")
+    except Exception as e:
+        log.error("ERR", "pong", addr=addr, err=e)
+
+
+@command("CALL", fields=3, min_fields=2)
+def _cmd_call(req):
+    # CALL:<llamado>:<llamante>[:<códecs ofrecidos>] (codec.py)
+    callee, caller, codecs = req.args
+    log.info("CALL", "call", caller=caller, callee=callee, codecs=codecs or None)
+    info = clients.get(caller)
+    caller_name = info[3] if info else ""
+    msg = f"CALL_FROM:{caller}:{caller_name}" + (f":{codecs}" if codecs else "")
+    if _forward_or_offline(req, callee, msg):
+        req.reply(f"RINGING_FROM:{callee}".encode())
+
+
+@command("ACCEPT", fields=3, min_fields=2)
+def _cmd_accept(req):
+    # ACCEPT:<llamante>:<llamado>[:<códec elegido>]
+    caller, callee, chosen = req.args
+    sid = open_session(caller, callee) if caller in clients else 0
+    if sid and chosen in codec.CODECS:
+        session_codecs[sid] = codec.CODECS[chosen].pt
+    log.info("CALL", "accept", caller=caller, callee=callee, sid=sid, codec=chosen or None)
+    msg = f"ACCEPT_FROM:{callee}:{sid}" + (f":{chosen}" if chosen else "")
+    if _forward_or_offline(req, caller, msg):
+        req.reply(f"SESSION:{sid}:{caller}".encode())
+
+
+@command("REJECT", fields=2)
+def _cmd_reject(req):
+    caller, callee = req.args
+    log.info("CALL", "reject", caller=caller, callee=callee)
+    _forward_or_offline(req, caller, f"REJECT_FROM:{callee}")
+
+
+@command("BUSY", fields=2)
+def _cmd_busy(req):
+    caller, callee = req.args
+    log.info("CALL", "busy", caller=caller, callee=callee)
+    _forward_or_offline(req, caller, f"BUSY_FROM:{callee}")
+
+
+@command("OFFER_B64", "WEBRTC_OFFER_B64", fields=2, payload=True)
+def _cmd_offer(req):
+    # OFFER_B64:callee:caller:<b64>
+    callee, caller = req.args
+    log.info("ICE", "offer", caller=caller, callee=callee)
+    _forward_or_offline(req, callee, b"OFFER_FROM_B64:" + caller.encode() + b":" + req.payload)
+
+
+@command("ANSWER_B64", "WEBRTC_ANSWER_B64", fields=2, payload=True)
+def _cmd_answer(req):
+    # ANSWER_B64:caller:callee:<b64>
+    caller, callee = req.args
+    log.info("ICE", "answer", caller=caller, callee=callee)
+    _forward_or_offline(req, caller, b"ANSWER_FROM_B64:" + callee.encode() + b":" + req.payload)
+
+
+@command("ICE_B64", "WEBRTC_ICE_B64", fields=2, payload=True)
+def _cmd_ice(req):
+    # ICE_B64:to:from:<b64>
+    to, frm = req.args
+    log.info("ICE", "candidate", frm=frm, to=to)
+    _forward_or_offline(req, to, b"ICE_FROM_B64:" + frm.encode() + b":" + req.payload)
+
+
+@command("STUN")
+def _cmd_stun(req):
+    # como un Binding de STUN: la dirección con la que el servidor ve al
+    # cliente, su candidato "reflexivo" para el camino directo
+    req.reply(f"MAPPED:{req.addr[0]}:{req.addr[1]}".encode())
+
+
+@command("P2P", fields=3)
+def _cmd_p2p(req):
+    # P2P:<sid>:<número>:direct|relay, por dónde manda ese extremo su audio.
+    # Mientras va directo lo repite cada pocos segundos: la sesión no recibe
+    # tramas y sin esto caducaría por inactividad
+    sid, number, path = req.args
+    try:
+        sid = int(sid)
+    except ValueError:
+        return
+    rec = sessions.get(sid)
+    if rec is None or number not in rec[:2]:
         return
+    legs = p2p_direct.setdefault(sid, set())
+    if path == "direct":
+        sessions[sid] = (rec[0], rec[1], time.time())
+        if number not in legs:
+            legs.add(number)
+            metrics.p2p_switches["direct"] += 1
+            log.info("P2P", "direct", sid=sid, number=number)
+    elif number in legs:
+        legs.discard(number)
+        metrics.p2p_switches["relay"] += 1
+        log.info("P2P", "relay", sid=sid, number=number)
+
+
+@command("AUDIO_B64", fields=2, payload=True)
+def _cmd_audio(req):
+    to, frm = req.args
+    # audio: sin ACK ni reenvíos, una trama tardía no sirve de nada. El
+    # payload (<n>:<b64>, o solo <b64>) pasa tal cual: con el número el
+    # receptor descarta las copias
+    if forward(to, b"AUDIO_FROM_B64:" + frm.encode() + b":" + req.payload, req.sock,
+               reliable=False):
+        if recorder is not None:
+            sid = session_of.get(frm)
+            if sid is not None:
+                recorder.tap(sid, frm, to, req.payload, -1, session_codecs.get(sid, 0))
+        req.reply(b"OK")
+    else:
+        req.reply(f"OFFLINE:{to}".encode())
+
+
+@command("LOSS", fields=4, min_fields=3)
+def _cmd_loss(req):
+    # LOSS:to:from:pct:n, informe n de pérdida del receptor; el emisor decide
+    # si añade redundancia y descarta los n repetidos (puerto declarado).
+    # Se repite cada pocos segundos: sin ACK ni respuesta
+    to, frm, pct, n = req.args
+    forward(to, f"LOSS_FROM:{frm}:{pct}:{n}" if n else f"LOSS_FROM:{frm}:{pct}",
+            req.sock, reliable=False)
 
+
+@command("BYE", "HANGUP", fields=2)
+def _cmd_bye(req):
+    to, frm = req.args
+    log.info("CALL", "bye", frm=frm, to=to)
+    close_session(frm)
+    forward(to, f"BYE_FROM:{frm}", req.sock)
     try:
-        h = hashlib.sha256((str(addr) + "|" + msg).encode()).hexdigest()
-        now = time.time()
-        last = recent.get((addr, h), 0)
-        if now - last < 0.3:
-            return
-        recent[(addr, h)] = now
-    except:
+        req.reply(b"OK")
+    except Exception as e:
+        log.error("ERR", "ack", cmd="BYE", addr=req.addr, err=e)
+
+
+@command("LIST")
+def _cmd_list(req):
+    online = ",".join(f"{n}|{_clean_name(nm)}" for n, (_, _, _, nm) in clients.items())
+    if cluster is not None and cluster.dir:
+        remote = ",".join(f"{n}|{e[2]}" for n, e in cluster.dir.items())
+        online = f"{online},{remote}" if online else remote
+    try:
+        req.reply(f"LIST:{online}".encode())
+    except Exception as e:
+        log.error("ERR", "list", addr=req.addr, err=e)
+
+
+@command("SUBSCRIBE", fields=3)
+def _cmd_subscribe(req):
+    number, epoch, known = req.args
+    try:
+        epoch = int(epoch) if epoch else 0
+        known = int(known) if known else 0
+    except ValueError:
+        epoch = known = 0
+    if number in clients:
+        subscribe(req, number, epoch, known)
+    else:
+        req.reply(f"OFFLINE:{number}".encode())
+
+
+@command("UNSUBSCRIBE", fields=1)
+def _cmd_unsubscribe(req):
+    subscribers.pop(req.args[0], None)
+    _dirty(req.args[0])
+    req.reply(b"OK")
+
+
+@command("LIST_PAGE", fields=1)
+def _cmd_list_page(req):
+    try:
+        page = list_page(req.args[0])
+        if req.replies is not None:
+            req.reply(page)
+        else:
+            req.sock.sendto(page, req.addr)
+            metrics.reply("LIST_PAGE", 1, len(page))
+    except Exception as e:
+        log.error("ERR", "list_page", addr=req.addr, err=e)
+
+
+@command("UNREGISTER", fields=1)
+def _cmd_unregister(req):
+    number = req.args[0]
+    info = clients.pop(number, None)
+    if info is not None:
+        _presence_off(number)
+        _forget_peer((info[0], info[1]))
+    claimed.pop(number, None)
+    presence.discard(number)
+    close_session(number)
+    conf_leave(number, req.sock)
+    _dirty(number)
+    try:
+        req.reply(b"OK")
+    except Exception as e:
+        log.error("ERR", "ack", cmd="UNREGISTER", addr=req.addr, err=e)
+
+
+@command("CONF_JOIN", fields=3, min_fields=2)
+def _cmd_conf_join(req):
+    name, number, mode = req.args
+    if not name or not number:
+        req.reply(b"ERR")
+        return
+    room = conf_join(name, number, req.addr, mode == "b64", req.sock)
+    if room is None:
+        req.reply(f"CONF_FULL:{name}".encode())
+        return
+    log.info("SESSION", "conf_join", room=name, number=number, members=len(room.members))
+    req.reply(f"CONF_JOINED:{name}:{room.sid}".encode())
+
+
+@command("CONF_LEAVE", fields=2)
+def _cmd_conf_leave(req):
+    name, number = req.args
+    if conf_of.get(number, (None,))[0] == name:
+        conf_leave(number, req.sock)
+    req.reply(b"OK")
+
+
+@command("CONF_AUDIO_B64", fields=2, payload=True, locked=False)
+def _cmd_conf_audio(req):
+    room = rooms.get(req.args[0])
+    if room is None:
+        return
+    try:
+        room.feed(req.addr, base64.b64decode(req.payload))
+    except ValueError:
+        metrics.media_dropped += 1
+
+
+@command("ACK", fields=1, locked=False)
+def _cmd_ack(req):
+    try:
+        outbound.ack(int(req.args[0]), req.addr)
+    except ValueError:
         pass
 
-    parts = msg.split(":")
-    cmd = parts[0]
 
-    with lock:
-        if cmd == "REGISTER":
-            number = parts[1]
-            claimed_port = int(parts[2]) if len(parts) >= 3 else 0
-            name = parts[3] if len(parts) >= 4 else ""
-            number = (number or "")[:32]
-            name = (name or "")[:32]
-            clients[number] = (addr[0], addr[1], time.time(), name)
-            try:
-                claimed[number] = claimed_port
-            except Exception:
-                pass
-            print(f"[ONLINE] {number} ({name}) -> {addr[0]}:{addr[1]} (claimed {claimed_port})")
-            _send_ok(sock, addr)
-
-        elif cmd == "PING":
-            number = parts[1] if len(parts) >= 2 else ""
-            number = (number or "")[:32]
-            if number in clients:
-                ip, port, _, name = clients[number]
-                clients[number] = (ip, port, time.time(), name)
-            else:
-                clients[number] = (addr[0], addr[1], time.time(), "")
-                print(f"[ONLINE_AUTO] {number} -> {addr[0]}:{addr[1]}")
-            try:
-                _send_redundant_bytes(sock, addr, b"PONG", copies=2, delay=0.02)
-            except Exception as e:
-                print(f"[ERR] PONG to {addr}: {e}")
-
-        elif cmd == "CALL":
-            callee = parts[1] if len(parts) >= 2 else ""
-            caller = parts[2] if len(parts) >= 3 else ""
-            callee = (callee or "")[:32]
-            caller = (caller or "")[:32]
-            print(f"[CALL] {caller} -> {callee}")
-            caller_name = ""
-            if caller in clients:
-                _, _, _, caller_name = clients.get(caller, ("", 0, 0, ""))
-            sent = forward(callee, f"CALL_FROM:{caller}:{caller_name}", sock)
-            try:
-                if sent:
-                    _send_ok(sock, addr)
-                    _send_redundant_bytes(sock, addr, f"RINGING_FROM:{callee}".encode(), copies=2, delay=0.02)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{callee}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] callee {callee} no registrado")
-            except Exception as e:
-                print(f"[ERR] ACK CALL to {addr}: {e}")
-
-        elif cmd == "ACCEPT":
-            caller = parts[1] if len(parts) >= 2 else ""
-            callee = parts[2] if len(parts) >= 3 else ""
-            caller = (caller or "")[:32]
-            callee = (callee or "")[:32]
-            print(f"[ACCEPT] {callee} -> {caller}")
-            sent = forward(caller, f"ACCEPT_FROM:{callee}", sock)
-            try:
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{caller}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] caller {caller} no registrado")
-            except Exception as e:
-                print(f"[ERR] ACK ACCEPT to {addr}: {e}")
-
-        elif cmd == "REJECT":
-            caller = parts[1] if len(parts) >= 2 else ""
-            callee = parts[2] if len(parts) >= 3 else ""
-            caller = (caller or "")[:32]
-            callee = (callee or "")[:32]
-            print(f"[REJECT] {callee} -> {caller}")
-            sent = forward(caller, f"REJECT_FROM:{callee}", sock)
-            try:
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{caller}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] caller {caller} no registrado")
-            except Exception as e:
-                print(f"[ERR] ACK REJECT to {addr}: {e}")
-
-        elif cmd == "BUSY":
-            caller = parts[1] if len(parts) >= 2 else ""
-            callee = parts[2] if len(parts) >= 3 else ""
-            caller = (caller or "")[:32]
-            callee = (callee or "")[:32]
-            print(f"[BUSY] {callee} -> {caller}")
-            sent = forward(caller, f"BUSY_FROM:{callee}", sock)
-            try:
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{caller}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] caller {caller} no registrado")
-            except Exception as e:
-                print(f"[ERR] ACK BUSY to {addr}: {e}")
-
-        elif cmd in ("OFFER_B64", "WEBRTC_OFFER_B64"):
-            # OFFER_B64:callee:caller:<b64>
-            if len(parts) >= 4:
-                callee = parts[1]
-                caller = parts[2]
-                b64 = ":".join(parts[3:])  # por si hay ':' en base64
-                callee = (callee or "")[:32]
-                caller = (caller or "")[:32]
-                print(f"[OFFER] {caller} -> {callee}")
-                sent = forward(callee, f"OFFER_FROM_B64:{caller}:{b64}", sock)
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{callee}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] callee {callee} no registrado")
-            else:
-                print("[OFFER] malformed")
-                _send_redundant_bytes(sock, addr, b"ERR", copies=2, delay=0.02)
-
-        elif cmd in ("ANSWER_B64", "WEBRTC_ANSWER_B64"):
-            # ANSWER_B64:caller:callee:<b64>
-            if len(parts) >= 4:
-                caller = parts[1]
-                callee = parts[2]
-                b64 = ":".join(parts[3:])
-                caller = (caller or "")[:32]
-                callee = (callee or "")[:32]
-                print(f"[ANSWER] {callee} -> {caller}")
-                sent = forward(caller, f"ANSWER_FROM_B64:{callee}:{b64}", sock)
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{caller}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] caller {caller} no registrado")
-            else:
-                print("[ANSWER] malformed")
-                _send_redundant_bytes(sock, addr, b"ERR", copies=2, delay=0.02)
-
-        elif cmd in ("ICE_B64", "WEBRTC_ICE_B64"):
-            # ICE_B64:to:from:<b64>
-            if len(parts) >= 4:
-                to = parts[1]
-                frm = parts[2]
-                b64 = ":".join(parts[3:])
-                to = (to or "")[:32]
-                frm = (frm or "")[:32]
-                print(f"[ICE] {frm} -> {to}")
-                sent = forward(to, f"ICE_FROM_B64:{frm}:{b64}", sock)
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{to}".encode(), copies=2, delay=0.02)
-                    print(f"[MISS] to {to} no registrado")
+# Entre nodos del clúster; se ignoran si no vienen de uno de la lista.
+CLUSTER_COMMANDS = {"GOSSIP", "GOSSIP_HELLO", "GOSSIP_SYNC", "GOSSIP_END", "XFWD"}
+
+
+def _peer_node(req):
+    return cluster.by_addr.get(req.addr) if cluster is not None else None
+
+
+@command("GOSSIP", fields=1, payload=True)
+def _cmd_gossip(req):
+    node = _peer_node(req)
+    if node is None:
+        return
+    try:
+        inc = int(req.args[0])
+    except ValueError:
+        return
+    cluster.current(node, inc, req.sock)
+    cluster.apply(node, bytes(req.payload).decode(errors="ignore"))
+
+
+@command("GOSSIP_HELLO", fields=4)
+def _cmd_gossip_hello(req):
+    node = _peer_node(req)
+    if node is None:
+        return
+    try:
+        inc, _, n, x = (int(v) for v in req.args)
+    except ValueError:
+        return
+    cluster.on_hello(node, inc, n, x, req.sock)
+
+
+@command("GOSSIP_SYNC")
+def _cmd_gossip_sync(req):
+    node = _peer_node(req)
+    if node is not None:
+        cluster.on_sync(node, req.sock)
+
+
+@command("GOSSIP_END", fields=1)
+def _cmd_gossip_end(req):
+    node = _peer_node(req)
+    if node is None:
+        return
+    try:
+        cluster.on_end(node, int(req.args[0]))
+    except ValueError:
+        pass
+
+
+@command("XFWD", fields=3, payload=True)
+def _cmd_xfwd(req):
+    # XFWD:<num>:<fiable>:<saltos>:<mensaje para el cliente>
+    node = _peer_node(req)
+    if node is None:
+        return
+    to, rel, hops = req.args
+    rel = rel == "1"
+    data = bytes(req.payload)
+    if to in clients:
+        cluster.delivered += 1
+        forward(to, data, req.sock, reliable=rel)
+    elif hops != "0" or not cluster.relay(to, data, req.sock, rel, hops=1, exclude=node):
+        log.info("CALL", "xfwd_miss", to=to, node=node)
+
+
+class _LoopSock:
+    """Adaptador para que handle() envíe por un DatagramTransport sin bloquear.
+
+    Las copias redundantes se programan con loop.call_later en vez de time.sleep.
+    """
+
+    def __init__(self, transport, loop, queue=None):
+        self.transport = transport
+        self.loop = loop
+        self.queue = sendq if queue is None else queue
+        self._draining = False
+
+    def _raw(self, data, addr):
+        # Si el transporte ya guarda algo es que el kernel no admite más: que
+        # espere en sendq, donde aún se puede priorizar y tirar el audio viejo.
+        if self.transport.get_write_buffer_size():
+            raise BlockingIOError
+        self.transport.sendto(data, addr)
+
+    def sendto(self, data, addr):
+        if self.queue.send(self._raw, addr, data):
+            self._arm()
+
+    def send_media(self, data, addr, born=None):
+        if self.queue.send(self._raw, addr, data, True, born):
+            self._arm()
+
+    def _arm(self):
+        if not self._draining:
+            self._draining = True
+            self.loop.call_later(EGRESS_POLL, self._drain)
+
+    def _drain(self):
+        self._draining = False
+        if self.queue.drain(self._raw):
+            self._arm()
+
+    def send_redundant(self, addr, data, copies=2, delay=0.01, media=False):
+        try:
+            if media:
+                self.send_media(data, addr)
             else:
-                print("[ICE] malformed")
-                _send_redundant_bytes(sock, addr, b"ERR", copies=2, delay=0.02)
-
-        elif cmd in ("AUDIO_B64",):
-            if len(parts) >= 4:
-                to = parts[1]
-                frm = parts[2]
-                b64 = ":".join(parts[3:])
-                to = (to or "")[:32]
-                frm = (frm or "")[:32]
-                sent = forward(to, f"AUDIO_FROM_B64:{frm}:{b64}", sock)
-                if sent:
-                    _send_ok(sock, addr)
-                else:
-                    _send_redundant_bytes(sock, addr, f"OFFLINE:{to}".encode(), copies=2, delay=0.02)
+                self.sendto(data, addr)
+        except Exception as e:
+            log.error("ERR", "send", addr=addr, err=e)
+            return False
+        born = time.monotonic() if media else None
+        for i in range(1, max(1, copies)):
+            self.loop.call_later(delay * i, self._send_quiet, data, addr, born)
+        return True
+
+    def _send_quiet(self, data, addr, born=None):
+        try:
+            if born is None:
+                self.sendto(data, addr)
             else:
-                _send_redundant_bytes(sock, addr, b"ERR", copies=2, delay=0.02)
-
-        elif cmd in ("BYE", "HANGUP"):
-            to = parts[1] if len(parts) >= 2 else ""
-            frm = parts[2] if len(parts) >= 3 else ""
-            to = (to or "")[:32]
-            frm = (frm or "")[:32]
-            print(f"[BYE] {frm} -> {to}")
-            forward(to, f"BYE_FROM:{frm}", sock)
-            try:
-                _send_ok(sock, addr)
-            except Exception as e:
-                print(f"[ERR] ACK BYE to {addr}: {e}")
-
-        elif cmd == "LIST":
-            entries = []
-            for n, (_, _, _, nm) in clients.items():
-                nm = nm or ""
-                entries.append(f"{n}|{nm}")
-            online = ",".join(entries)
-            try:
-                _send_redundant_bytes(sock, addr, f"LIST:{online}".encode(), copies=2, delay=0.02)
-            except Exception as e:
-                print(f"[ERR] LIST to {addr}: {e}")
+                self.send_media(data, addr, born)
+        except Exception as e:
+            log.error("ERR", "send", addr=addr, err=e)
 
-        elif cmd == "UNREGISTER":
-            number = parts[1] if len(parts) >= 2 else ""
-            number = (number or "")[:32]
-            if number in clients:
-                del clients[number]
-            try:
-                _send_ok(sock, addr)
-            except Exception as e:
-                print(f"[ERR] ACK UNREGISTER to {addr}: {e}")
-        else:
-            try:
-                _send_redundant_bytes(sock, addr, b"ERR", copies=2, delay=0.02)
-            except Exception as e:
-                print(f"[ERR] Unknown cmd to {addr}: {e}")
 
+class _ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.sock = None
+
+    def connection_made(self, transport):
+        self.sock = _LoopSock(transport, asyncio.get_running_loop())
+
+    def datagram_received(self, data, addr):
+        if capture is not None:
+            capture.record(data, addr)
+        if admission.admit(data, addr):
+            handle(data, addr, self.sock)
+
+    def error_received(self, exc):
+        log.error("ERR", "recv", err=exc)
 
-def start():
+
+def _make_socket(reuseport=False):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((HOST, PORT))
     try:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
     except Exception as e:
-        print(f"[WARN] set sock buffers: {e}")
-    print(f"Servidor VoIP (reenviando señales) en {HOST}:{PORT}")
+        log.warn("SYS", "sock_buffers", err=e)
+    return sock
+
+
+async def _serve_async(sock, run_cleanup=True):
+    loop = asyncio.get_running_loop()
+    transport, proto = await loop.create_datagram_endpoint(_ServerProtocol, sock=sock)
+    mixer = loop.create_task(_conf_mixer_async(proto.sock))
+    try:
+        last_flush = 0.0
+        last_expiry = last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(RTX_TICK)
+            now = time.monotonic()
+            retransmit(now)
+            if cluster is not None:
+                cluster.tick(proto.sock, now)
+            if now - last_flush >= PRESENCE_FLUSH:
+                last_flush = now
+                presence_flush(proto.sock)
+            # la caducidad envía (BYE, SESSION_CLOSED...) por el _LoopSock,
+            # que no se puede usar desde otro hilo: va aquí y no en cleanup()
+            if run_cleanup and now - last_expiry >= EXPIRY_TICK:
+                last_expiry = now
+                expire(time.time(), proto.sock)
+                if now - last_report >= 30:
+                    last_report = now
+                    _dedup_report()
+    finally:
+        mixer.cancel()
+        transport.close()
 
-    threading.Thread(target=cleanup, daemon=True).start()
 
+def start(use_asyncio=False, workers=1):
+    if workers > 1:
+        return start_workers(workers, use_asyncio)
+    sock = _make_socket()
+    log.info("SYS", "start", host=HOST, port=PORT, mode="asyncio" if use_asyncio else "threads")
+    open_registry()
+    open_cluster()
+    open_capture()
+    open_recorder()
+    try:
+        serve(sock, use_asyncio)
+    finally:
+        if capture is not None:
+            capture.close()
+        if recorder is not None:
+            recorder.close()
+        if registry_store is not None:
+            registry_store.close()
+
+
+def open_registry(every=SNAPSHOT_EVERY):
+    """Carga el registro guardado en STATE_DIR y arranca su escritor."""
+    global registry_store
+    if not STATE_DIR:
+        return
+    registry_store = RegistryStore(STATE_DIR)
+    registry_store.load()
+    registry_store.start(every=every)
+    signal.signal(signal.SIGTERM, _stop)  # parar con SIGTERM guarda un snapshot
+
+
+def start_workers(n, use_asyncio=False, capacity=65536):
+    """N procesos con SO_REUSEPORT en el mismo puerto y registro compartido.
+
+    El kernel reparte los datagramas por 4-tupla, así que cada cliente cae
+    siempre en el mismo worker; el registro y las sesiones viven en tablas
+    SharedTable para que cualquier worker pueda reenviar a cualquier número.
+    """
+    share_tables(capacity)
+    # Sin journal: el padre, que ve las tablas compartidas, guarda snapshots
+    # cada WORKER_SNAPSHOT s. Suscripciones y clientes fiables son de cada
+    # worker y no se guardan.
+    open_registry(every=WORKER_SNAPSHOT)
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_worker_main, args=(i, n, use_asyncio), daemon=True)
+             for i in range(n)]
+    for p in procs:
+        p.start()
+    # SIGTERM (systemd, Popen.terminate) solo llega al padre: sin esto los
+    # workers seguirían vivos, huérfanos y con el puerto cogido
+    signal.signal(signal.SIGTERM, _stop)
+    log.start()
+    log.info("SYS", "start", host=HOST, port=PORT, workers=n,
+             mode="asyncio" if use_asyncio else "threads")
+    try:
+        for p in procs:
+            p.join()
+    except (KeyboardInterrupt, SystemExit):
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()
+    finally:
+        if registry_store is not None:
+            registry_store.close()
+
+
+def _worker_main(idx, n, use_asyncio):
+    global WORKER_ID, WORKERS, registry_store
+    WORKER_ID = idx & 0xFF
+    WORKERS = n
+    registry_store = None  # lo escribe el padre
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sock = _make_socket(reuseport=True)
+    open_capture(f".{idx}")
+    open_recorder()
+    # Cada worker caduca los clientes que ha visto; antes de borrar relee el
+    # last_seen compartido por si otro worker lo refrescó.
+    try:
+        serve(sock, use_asyncio)
+    finally:
+        if capture is not None:
+            capture.close()
+        if recorder is not None:
+            recorder.close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics(port=0, path=None, interval=10.0):
+    """Servidor HTTP local de métricas y/o volcado periódico a fichero."""
+    if port:
+        srv = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        log.info("SYS", "metrics", url=f"http://127.0.0.1:{port}/metrics")
+    if path:
+        def dump():
+            while True:
+                time.sleep(interval)
+                try:
+                    tmp = path + ".tmp"
+                    with open(tmp, "w") as f:
+                        f.write(metrics.render())
+                    os.replace(tmp, path)
+                except Exception as e:
+                    log.error("ERR", "metrics_dump", err=e)
+        threading.Thread(target=dump, daemon=True).start()
+
+
+METRICS_PORT = 0
+METRICS_FILE = None
+METRICS_INTERVAL = 10.0
+
+
+def serve(sock, use_asyncio=False, run_cleanup=True):
+    log.start()
+    # En modo --workers cada proceso expone las suyas en METRICS_PORT + índice.
+    start_metrics(METRICS_PORT + WORKER_ID if METRICS_PORT else 0,
+                  f"{METRICS_FILE}.{WORKER_ID}" if METRICS_FILE and WORKERS else METRICS_FILE,
+                  METRICS_INTERVAL)
+    if use_asyncio:
+        # Un solo hilo/loop atiende todos los datagramas: sin hilo por paquete.
+        # La cola de salida va en _LoopSock, y con ella la caducidad.
+        sock.setblocking(False)
+        asyncio.run(_serve_async(sock, run_cleanup))
+        return
+
+    raw = sock
+    sock = _QueuedSock(raw)
+    if run_cleanup:
+        threading.Thread(target=cleanup, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=_presence_pusher, args=(sock,), daemon=True).start()
+    threading.Thread(target=_retransmitter, daemon=True).start()
+    threading.Thread(target=_conf_mixer, args=(sock,), daemon=True).start()
+    if cluster is not None:
+        threading.Thread(target=_cluster_ticker, args=(sock,), daemon=True).start()
     while True:
-        data, addr = sock.recvfrom(65535)
-        threading.Thread(target=handle, args=(data, addr, sock), daemon=True).start()
+        data, addr = raw.recvfrom(65535)
+        if capture is not None:
+            capture.record(data, addr)
+        if not data or not admission.admit(data, addr):
+            continue
+        if data[0] >= 0x80:
+            handle(data, addr, sock)
+            continue
+        if not inflight.acquire(blocking=False):
+            admission.dropped["INFLIGHT"] += 1
+            continue
+        threading.Thread(target=_handle_inflight, args=(data, addr, sock), daemon=True).start()
+
+
+def _handle_inflight(data, addr, sock):
+    try:
+        handle(data, addr, sock)
+    finally:
+        inflight.release()
+
+
+def main(argv=None):
+    global HOST, PORT, PRESENCE_TIMEOUT, MEDIA_IDLE, MEDIA_DEADLINE
+    global METRICS_PORT, METRICS_FILE, METRICS_INTERVAL, STATE_DIR, CLUSTER_NODES, NODE_ID
+    global CAPTURE_PATH, RECORD_DIR, RECORD_PART_MB
+    ap = argparse.ArgumentParser(description="Servidor de señalización VoIP")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--asyncio", action="store_true",
+                    help="atender todos los datagramas en un único event loop")
+    ap.add_argument("--dup", action="append", default=[], metavar="TIPO=N[@SEG]",
+                    help="copias por tipo de mensaje, p.ej. AUDIO_FROM_B64=1 u OK=3@0.03")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="procesos con SO_REUSEPORT y registro en memoria compartida")
+    ap.add_argument("--presence-timeout", type=float, default=PRESENCE_TIMEOUT,
+                    help="segundos sin PING/REGISTER antes de marcar OFFLINE")
+    ap.add_argument("--media-idle", type=float, default=MEDIA_IDLE,
+                    help="segundos sin tramas antes de cerrar una sesión de media")
+    ap.add_argument("--media-deadline", type=float, default=MEDIA_DEADLINE * 1000,
+                    help="ms que una trama de audio puede esperar en la cola de salida")
+    ap.add_argument("--metrics-port", type=int, default=0,
+                    help="puerto HTTP local para /metrics (Prometheus)")
+    ap.add_argument("--metrics-file", help="volcar métricas a este fichero")
+    ap.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL)
+    ap.add_argument("--log-level", choices=list(LOG_LEVELS), default="INFO")
+    ap.add_argument("--log", action="append", default=[], metavar="CAT=NIVEL[@N]",
+                    help="nivel y límite por categoría, p.ej. AUDIO=DEBUG@5, REC=OFF")
+    ap.add_argument("--log-file", help="escribir los logs (JSON lines) aquí en vez de stdout")
+    ap.add_argument("--log-payload", type=int, default=80, help="truncar campos a N caracteres")
+    ap.add_argument("--capture", metavar="FICHERO",
+                    help="guardar todos los datagramas recibidos para replay.py "
+                         "(con --workers, FICHERO.<índice>)")
+    ap.add_argument("--record", metavar="DIR", help="grabar el audio de las llamadas en DIR (WAV)")
+    ap.add_argument("--record-max-mb", type=float, default=RECORD_PART_MB,
+                    help="tamaño de cada parte de una grabación antes de rotar")
+    ap.add_argument("--state-dir", help="guardar el registro aquí para sobrevivir a reinicios")
+    ap.add_argument("--admit", action="append", default=[], metavar="CLASE=N[@RÁFAGA]",
+                    help="cupos de admisión, p.ej. SIG_SRC=10@20, MEDIA_IP=0 (sin límite) u off")
+    ap.add_argument("--cluster", metavar="HOST:PUERTO,...",
+                    help="todos los nodos del clúster (este incluido), igual en todos")
+    ap.add_argument("--node", metavar="HOST:PUERTO",
+                    help="cuál de la lista --cluster es este nodo (por defecto, el de --port)")
+    args = ap.parse_args(argv)
+    log.default = LOG_LEVELS[args.log_level]
+    log.payload = args.log_payload
+    for spec in args.log:
+        log.configure(spec)
+    if args.log_file:
+        log.stream = open(args.log_file, "a", buffering=1 << 16)
+    for spec in args.admit:
+        try:
+            admission.configure(spec)
+        except ValueError as e:
+            ap.error(f"--admit {spec}: {e}")
+    for spec in args.dup:
+        try:
+            configure_redundancy(spec)
+        except ValueError as e:
+            ap.error(f"--dup {spec}: {e}")
+    HOST, PORT = args.host, args.port
+    PRESENCE_TIMEOUT = args.presence_timeout
+    MEDIA_IDLE = args.media_idle
+    MEDIA_DEADLINE = args.media_deadline / 1000.0
+    METRICS_PORT, METRICS_FILE = args.metrics_port, args.metrics_file
+    METRICS_INTERVAL = args.metrics_interval
+    STATE_DIR = args.state_dir
+    CAPTURE_PATH = args.capture
+    RECORD_DIR = args.record
+    RECORD_PART_MB = args.record_max_mb
+    if args.cluster:
+        if args.workers > 1:
+            ap.error("--cluster no admite --workers")
+        CLUSTER_NODES = [n.strip() for n in args.cluster.split(",") if n.strip()]
+        NODE_ID = args.node
+        if NODE_ID is None:
+            mine = [n for n in CLUSTER_NODES if n.rpartition(":")[2] == str(PORT)]
+            if len(mine) != 1:
+                ap.error("--node: no se puede deducir cuál de --cluster es este nodo")
+            NODE_ID = mine[0]
+        if NODE_ID not in CLUSTER_NODES:
+            ap.error(f"--node {NODE_ID} no está en --cluster")
+    start(use_asyncio=args.asyncio, workers=args.workers)
 
 
 if __name__ == "__main__":
-    start()
+    main()
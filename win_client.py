@@ -8,7 +8,14 @@ from tkinter import ttk, messagebox
 import sys
 import random
 import array
+import math
+import operator
+import struct
 from queue import Queue
+from collections import deque
+
+import codec
+import reliable
 
 # Configuración de Logs
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,6 +35,419 @@ try:
 except ImportError:
     WINSOUND_AVAILABLE = False
 
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop  # desaparece en Python 3.13
+    AUDIOOP_AVAILABLE = True
+except ImportError:
+    AUDIOOP_AVAILABLE = False
+
+# Trama binaria de audio (misma cabecera que svr.py):
+# | 0x80|ver | tipo | seq u16 | ts u32 | sesión u32 | payload
+# "tipo" es el códec del payload (codec.py: 0 PCM, 1 Opus).
+MEDIA_HDR = struct.Struct("!BBHII")
+MEDIA_VERSION = 1
+
+# --- Procesado de entrada (DSP) ---
+# Corre en el hilo de audio de PortAudio cada 20 ms, así que nada de bucles
+# por muestra en Python: NumPy si está, si no audioop (en C), y Python puro
+# solo como último recurso. Los tres dan exactamente los mismos bytes.
+#
+#   puerta de ruido: nivel medio (|x| medio o RMS) de la trama SIN ganancia;
+#                    por debajo del umbral la trama no se envía (None)
+#   ganancia:        x * gain redondeado hacia abajo, saturado a int16
+#   limitador suave: por encima de LIMIT_KNEE comprime con tanh en vez de
+#                    recortar en seco; nunca pasa de 32767
+
+LIMIT_KNEE = 24576  # 75 % de fondo de escala
+_LIMIT_RANGE = 32767 - LIMIT_KNEE
+
+
+def _dsp_numpy(pcm, gain, gate, gate_rms, limit):
+    x = np.frombuffer(pcm, dtype=np.int16).astype(np.float64)
+    if gate:
+        level = np.sqrt(np.dot(x, x) / len(x)) if gate_rms else np.abs(x).mean()
+        if level < gate:
+            return None
+    if gain == 1.0 and not limit:
+        return pcm
+    x *= gain
+    if limit:
+        over = np.abs(x) > LIMIT_KNEE
+        if over.any():
+            y = x[over]
+            x[over] = np.sign(y) * (LIMIT_KNEE + _LIMIT_RANGE * np.tanh((np.abs(y) - LIMIT_KNEE) / _LIMIT_RANGE))
+    return np.clip(np.floor(x), -32768, 32767).astype(np.int16).tobytes()
+
+
+def _soft_limit(v):
+    a = abs(v)
+    if a <= LIMIT_KNEE:
+        return v
+    a = LIMIT_KNEE + _LIMIT_RANGE * math.tanh((a - LIMIT_KNEE) / _LIMIT_RANGE)
+    return a if v > 0 else -a
+
+
+def _dsp_python(pcm, gain, gate, gate_rms, limit):
+    samples = array.array('h', pcm)
+    if gate:
+        if gate_rms:
+            level = math.sqrt(sum(map(operator.mul, samples, samples)) / len(samples))
+        else:
+            level = sum(map(abs, samples)) / len(samples)
+        if level < gate:
+            return None
+    if gain == 1.0 and not limit:
+        return pcm
+    floor = math.floor
+    if limit:
+        out = [floor(_soft_limit(v * gain)) for v in samples]  # ya dentro de int16
+    else:
+        out = [floor(v * gain) for v in samples]
+        if max(out) > 32767 or min(out) < -32768:
+            out = [-32768 if v < -32768 else 32767 if v > 32767 else v for v in out]
+    return array.array('h', out).tobytes()
+
+
+def _dsp_audioop(pcm, gain, gate, gate_rms, limit):
+    if gate:
+        if gate_rms:
+            level = audioop.rms(pcm, 2)
+            # audioop.rms trunca a entero: solo es exacto lejos del umbral
+            if abs(level - gate) <= 1:
+                return _dsp_python(pcm, gain, gate, gate_rms, limit)
+        else:
+            level = sum(map(abs, array.array('h', pcm))) / (len(pcm) // 2)
+        if level < gate:
+            return None
+    if limit and audioop.max(pcm, 2) * gain > LIMIT_KNEE:
+        # solo las tramas que llegan al codo pagan el bucle por muestra
+        return _dsp_python(pcm, gain, 0, gate_rms, limit)
+    if gain == 1.0:
+        return pcm
+    return audioop.mul(pcm, 2, gain)
+
+
+DSP_BACKENDS = {"numpy": _dsp_numpy, "audioop": _dsp_audioop, "python": _dsp_python}
+DSP_BACKEND = "numpy" if NUMPY_AVAILABLE else "audioop" if AUDIOOP_AVAILABLE else "python"
+process_input = DSP_BACKENDS[DSP_BACKEND]
+
+# --- Buffer anti-jitter ---
+# Las tramas se guardan por número de secuencia (u16 extendido), así que se
+# reordenan solas y un hueco se ve como hueco. De cada trama se mide su
+# tránsito (llegada - timestamp); la profundidad objetivo es el percentil 95
+# del retardo relativo (tránsito - el mínimo) de los últimos JITTER_WINDOW
+# paquetes, entre JITTER_MIN y JITTER_MAX tramas. La reproducción arranca al
+# llegar al objetivo, y vuelve a llenarse tras una pausa del emisor (hueco en
+# el timestamp). Un retraso puntual solo para la reproducción hasta que llega
+# la trama. La que llega cuando su turno ya pasó se tira. Si sobra profundidad
+# JITTER_SHRINK tramas seguidas se salta una: el retardo baja poco a poco
+# cuando la red se calma, sin saltos audibles. También se lleva el jitter de
+# RFC 3550, para los logs.
+#
+# Se guardan los payloads sin decodificar (se decodifican al reproducir) para
+# poder rellenar huecos: con la paridad XOR que manda el emisor
+# (codec.PARITY_PT) o con el FEC en banda de la trama siguiente (peek()).
+# Mientras llega paridad, la profundidad no baja del tamaño de su grupo, o no
+# daría tiempo a juntarlo: si falta profundidad, ante un hueco se oculta una
+# trama sin avanzar y el retardo sube solo cuando hace falta. get() devuelve
+# LOST para un hueco, o si se vacía en plena reproducción: quien reproduce lo
+# oculta (codec.Concealer).
+
+JITTER_MIN = 1        # tramas (20 ms)
+JITTER_MAX = 10
+JITTER_WINDOW = 100   # paquetes (2 s) para el percentil
+JITTER_SHRINK = 25    # 0,5 s con profundidad de sobra -> una trama menos
+JITTER_RECENT = 16    # reproducidas que se guardan para la paridad
+
+LOST = object()       # get(): toca ocultar
+
+
+class JitterBuffer:
+    def __init__(self, frame_samples=320, rate=16000, min_frames=JITTER_MIN,
+                 max_frames=JITTER_MAX):
+        self.frame_samples = frame_samples
+        self.frame_s = frame_samples / rate
+        self.rate = rate
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.frames = {}       # {seq extendido: (ts, tipo, payload)}
+            self.parity = {}       # {primer seq del grupo: (tramas, paridad)}
+            self._recent = {}      # reproducidas, para la paridad
+            self.next_seq = None   # la siguiente que toca reproducir
+            self.high = None       # la mayor recibida
+            self.playing = False
+            self.jitter = 0.0      # segundos, RFC 3550
+            self.target = self.min_frames
+            self._transits = deque(maxlen=JITTER_WINDOW)
+            self._last_ts = None   # timestamp de la última reproducida
+            self._starved = False
+            self._stalled = 0      # LOST dados durante el último vacío
+            self._surplus = 0
+            self.fec_frames = 0    # profundidad mínima para el FEC en banda
+            self._parity_span = 0
+            self._parity_at = 0    # stats["received"] de la última paridad
+            self.stats = dict.fromkeys(("received", "played", "late", "duplicate", "lost",
+                                        "recovered", "stretched", "underruns", "shrunk",
+                                        "overflow"), 0)
+
+    def _extend(self, seq):
+        if self.high is None:
+            return seq
+        ext = (self.high & ~0xFFFF) | seq
+        if ext - self.high > 0x8000:
+            ext -= 0x10000
+        elif self.high - ext > 0x8000:
+            ext += 0x10000
+        return ext
+
+    def _adapt(self, transit):
+        if self._transits:
+            self.jitter += (abs(transit - self._transits[-1]) - self.jitter) / 16
+        self._transits.append(transit)
+        if self.stats["received"] % 10 == 0:
+            rel = sorted(self._transits)
+            p95 = rel[int(len(rel) * 0.95)] - rel[0]
+            if self._parity_span and self.stats["received"] - self._parity_at > JITTER_WINDOW:
+                self._parity_span = 0  # el emisor ya no manda paridad
+            floor = max(self.min_frames, self.fec_frames, self._parity_span)
+            # hasta ~5 ms de variación caben en la trama que ya se espera
+            self.target = max(floor, min(self.max_frames, 1 + math.ceil(p95 / self.frame_s - 0.25)))
+
+    def put(self, seq, ts, pt, data, now=None):
+        """Guarda una trama; False si llegó tarde o repetida."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            st = self.stats
+            st["received"] += 1
+            seq = self._extend(seq)
+            self._adapt(now - ts / self.rate)
+            if self.next_seq is None or (not self.playing and seq < self.next_seq
+                                         and self.next_seq - seq < self.max_frames):
+                self.next_seq = seq  # antes de empezar, una reordenada puede ir delante
+            elif seq < self.next_seq:
+                st["late"] += 1
+                return False
+            if seq in self.frames:
+                st["duplicate"] += 1
+                return False
+            self.frames[seq] = (ts, pt, data)
+            if self.high is None or seq > self.high:
+                self.high = seq
+            while self.high - self.next_seq >= self.max_frames:
+                if self.frames.pop(self.next_seq, None) is not None:
+                    st["overflow"] += 1
+                self.next_seq += 1
+            return True
+
+    def put_parity(self, seq, ts, data):
+        """Guarda la paridad de un grupo que empieza en seq."""
+        with self.lock:
+            if self.high is None:
+                return False
+            seq = self._extend(seq)
+            n = codec.parity_count(data)
+            if n < 2 or seq + n <= self.next_seq or seq in self.parity:
+                return False
+            self.parity[seq] = (n, data)
+            self._parity_at = self.stats["received"]
+            if n > self._parity_span:
+                self._parity_span = min(n, self.max_frames)
+                self.target = max(self.target, self._parity_span)
+            if len(self.parity) > JITTER_RECENT:
+                for first in [f for f, (k, _) in self.parity.items()
+                              if f + k <= self.next_seq]:
+                    del self.parity[first]
+            return True
+
+    def _from_parity(self, seq):
+        for first in range(seq, seq - JITTER_RECENT, -1):
+            par = self.parity.get(first)
+            if par is None or first + par[0] <= seq:
+                continue
+            others = []
+            for i in range(first, first + par[0]):
+                if i != seq:
+                    frame = self.frames.get(i) or self._recent.get(i)
+                    if frame is None:
+                        return None  # falta más de una
+                    others.append(frame)
+            data = codec.from_parity(par[1], [f[2] for f in others])
+            if data is None:
+                return None
+            ts = others[0][0] if self._last_ts is None else self._last_ts + self.frame_samples
+            return (ts & 0xFFFFFFFF, others[0][1], data)
+        return None
+
+    def peek(self):
+        """(tipo, payload) de la siguiente trama, si ya está (para FEC en banda)."""
+        with self.lock:
+            frame = self.frames.get(self.next_seq) if self.next_seq is not None else None
+            return frame[1:] if frame is not None else None
+
+    def get(self):
+        """(tipo, payload) que toca cada 20 ms; None = silencio, LOST = ocultar."""
+        with self.lock:
+            if self.next_seq is None:
+                return None
+            depth = self.high - self.next_seq + 1
+            if depth <= 0:
+                if not self.playing:
+                    return None
+                if not self._starved:
+                    self._starved = True
+                    self._stalled = 0
+                    self.stats["underruns"] += 1
+                self._stalled += 1
+                return LOST
+            if self._starved:
+                self._starved = False
+                # un hueco al final ya se ocultó mientras se esperaba: no se
+                # repite. Con paridad sí se intenta: mejor la trama de verdad
+                # con una de retardo más, que es lo que pide su grupo
+                while (self._stalled and not self._parity_span
+                       and self.next_seq not in self.frames):
+                    self._stalled -= 1
+                    self.next_seq += 1
+                    self.stats["lost"] += 1
+                depth = self.high - self.next_seq + 1
+                nxt = self.frames.get(self.next_seq)
+                if (nxt is not None and self._last_ts is not None
+                        and (nxt[0] - self._last_ts) & 0xFFFFFFFF > 2 * self.frame_samples):
+                    self.playing = False  # el emisor estuvo callado: ráfaga nueva
+            if not self.playing:
+                if depth < self.target:
+                    return None
+                self.playing = True
+                self._surplus = 0
+            self._surplus = self._surplus + 1 if depth > self.target else 0
+            if self._surplus >= JITTER_SHRINK:
+                self._surplus = 0
+                if self.frames.pop(self.next_seq, None) is not None:
+                    self.stats["shrunk"] += 1
+                self.next_seq += 1
+            seq = self.next_seq
+            self.next_seq += 1
+            frame = self.frames.pop(seq, None)
+            if frame is None and self.parity:
+                frame = self._from_parity(seq)
+                if frame is not None:
+                    self.stats["recovered"] += 1
+            if frame is None:
+                if self._parity_span and depth < self.target:
+                    # con paridad, esperar una trama más puede bastar para
+                    # recuperarla: se oculta esta vez y el retardo sube uno
+                    self.next_seq = seq
+                    self.stats["stretched"] += 1
+                    return LOST
+                self.stats["lost"] += 1
+                return LOST
+            self.stats["played"] += 1
+            self._last_ts = frame[0]
+            self._recent[seq] = frame
+            if len(self._recent) > 2 * JITTER_RECENT:
+                self._recent = {k: v for k, v in self._recent.items()
+                                if k > seq - JITTER_RECENT}
+            return frame[1:]
+
+    def depth_ms(self):
+        with self.lock:
+            if self.next_seq is None:
+                return 0.0
+            return max(0, self.high - self.next_seq + 1) * self.frame_s * 1000
+
+
+def playout(jitter, decoder, plc, pt):
+    """PCM de la trama que toca, con los huecos tapados; None = silencio.
+
+    decoder(pt) da el decodificador de un tipo; pt es el códec de la llamada.
+    Un hueco se rellena, por orden, con el FEC en banda de la trama siguiente,
+    con el PLC del códec o con la síntesis de plc (codec.Concealer).
+    """
+    item = jitter.get()
+    if item is None:
+        return None
+    try:
+        if item is not LOST:
+            dec = decoder(item[0])
+            if dec is not None:
+                return plc.good(dec.decode(item[1]))
+        else:
+            nxt = jitter.peek()
+            dec = decoder(nxt[0] if nxt else pt)
+            if dec is not None:
+                pcm = dec.recover(nxt[1]) if nxt else None
+                if pcm is not None:
+                    return plc.good(pcm)
+                pcm = dec.conceal()
+                if pcm is not None:
+                    return plc.conceal(pcm)
+    except Exception:
+        pass
+    return plc.conceal()
+
+
+# --- Redundancia según la pérdida del otro extremo ---
+# El receptor manda cada LOSS_REPORT_FRAMES tramas reproducidas
+# LOSS:<peer>:<yo>:<pct>:<n>: el % de huecos en la red (antes de recuperar con
+# paridad) y el número de informe, para que las copias no cuenten dos veces
+# hacia FEC_OFF_REPORTS. El emisor activa la redundancia a partir de FEC_ON_PCT y la quita
+# tras FEC_OFF_REPORTS informes seguidos por debajo de FEC_OFF_PCT. Con Opus
+# es el FEC en banda del códec; si no, una trama de paridad cada N, con N
+# según la pérdida (FEC_GROUPS). Sin sesión binaria (AUDIO_B64) ni informes
+# ni paridad.
+
+LOSS_REPORT_FRAMES = 100   # 2 s
+FEC_ON_PCT = 1.0
+FEC_OFF_PCT = 0.3
+FEC_OFF_REPORTS = 3
+FEC_GROUPS = ((10.0, 2), (4.0, 3), (0.0, 4))   # (pérdida desde %, tramas por paridad)
+
+
+def fec_group(pct):
+    return next(n for floor, n in FEC_GROUPS if pct >= floor)
+
+
+# --- Camino directo (P2P) ---
+# Al empezar la llamada cada extremo pide al servidor su dirección vista desde
+# fuera (STUN -> MAPPED:<ip>:<puerto>) y manda al otro, por ICE_B64, sus
+# candidatos: la IP local de la interfaz que sale hacia el servidor y la
+# reflexiva, con un token aleatorio:
+#
+#     ICE_B64:<peer>:<yo>:base64("p2p1 <token> ip:puerto ip:puerto")
+#
+# Los dos mandan a la vez P2P_PING:<token del otro>:<el mío>:<t> a todos los
+# candidatos del otro: así cada NAT abre el agujero hacia el otro (hole
+# punching). Quien recibe un PING con su token contesta P2P_PONG:<token del
+# que pregunta>:<t> a la dirección de origen, y la apunta como candidato si
+# no la tenía (NAT que cambia de puerto). El primer PONG fija el camino: el
+# audio va desde entonces directo a esa dirección, con la misma cabecera y
+# sesión, y al servidor solo llega P2P:<sid>:<yo>:direct cada
+# P2P_SERVER_REFRESH para que no dé la sesión por muerta. Si deja de haber
+# PONG durante P2P_CONSENT, el audio vuelve al relay sin cortar la llamada
+# (el anti-jitter absorbe el cambio de retardo) y se siguen probando los
+# candidatos por si el camino vuelve. Si los dos extremos están tras NAT
+# simétrico no hay agujero que valga y todo va por el relay, como antes.
+
+P2P_CHECK_INTERVAL = 0.05   # s entre rondas de PING al principio
+P2P_CHECK_TIME = 5.0        # s de rondas rápidas
+P2P_KEEPALIVE = 0.2         # s entre PING después (consentimiento y NAT abierto)
+P2P_CONSENT = 0.6           # s sin PONG: de vuelta al relay
+P2P_SERVER_REFRESH = 10.0   # s entre avisos P2P:...:direct al servidor
+
 class VoIPClient:
     def __init__(self, server_host, server_port, number, name, ui_callback):
         self.server_host = server_host
@@ -49,6 +469,17 @@ class VoIPClient:
         self.call_pending = False
         self.last_pong = time.time()
         
+        # Señalización fiable: ACK y reenvíos con backoff (reliable.py)
+        self.rtx = reliable.Sender()
+        self.rx = reliable.Receiver()
+        
+        # Directorio de presencia (suscripción con deltas)
+        self.directory = {}
+        self.presence_epoch = 0
+        self.presence_ver = 0
+        self._presence_touch = {}
+        self._subscribed_at = 0
+        
         # Configuración de Audio Dispositivos
         self.input_device_index = -1
         self.output_device_index = -1
@@ -57,6 +488,8 @@ class VoIPClient:
         self.input_gain = 1.0 
         self.isolation_enabled = False 
         self.noise_gate_threshold = 500 
+        self.noise_gate_rms = False  # nivel por RMS en vez de |x| medio
+        self.input_limiter = False   # limitador suave en vez de recorte a int16
         
         # Configuración Física
         self.audio_rate = 16000
@@ -65,7 +498,43 @@ class VoIPClient:
         self.audio_channels = 1
         
         # Buffer de reproducción (Jitter Buffer)
-        self.audio_queue = Queue(maxsize=40) 
+        self.jitter = JitterBuffer()
+        self._b64_seq = 0   # tramas AUDIO_B64 (32 bits): recibidas sin número / enviadas
+        self._b64_sent = 0
+        
+        # Códec de la llamada (codec.py). El callback de captura solo deja el
+        # PCM en encode_queue; codifica y envía _audio_encode_worker.
+        self.codec = codec.PCM16()
+        self.offered_codecs = ""
+        self._decoders = {}
+        self.encode_queue = Queue(maxsize=5)
+        
+        # Pérdidas: ocultación al reproducir, y redundancia al enviar si el
+        # otro extremo informa de pérdida (LOSS_FROM)
+        self.plc = codec.Concealer()
+        self._loss_mark = (0, 0)
+        self._loss_sent = 0   # informes mandados en esta llamada
+        self._loss_seen = 0   # último informe recibido del otro
+        self.fec_on = False
+        self.fec_group = 0
+        self._fec_calm = 0
+        self._fec_pending = []
+        self._fec_first = (0, 0)
+        
+        # Camino directo con el otro extremo (hole punching); sin él, relay
+        self.p2p_token = ""
+        self.p2p_peer_token = ""
+        self.p2p_cands = []      # [(ip, puerto)] del otro
+        self.p2p_addr = None     # por dónde va el audio directo; None = servidor
+        self.p2p_rtt = None
+        self.mapped_addr = None  # cómo nos ve el servidor (MAPPED)
+        self._p2p_pong = 0.0
+        self._p2p_gen = 0
+        
+        # Sesión de media binaria asignada por el servidor en ACCEPT
+        self.media_session = 0
+        self.media_seq = 0
+        self.media_ts = 0
         
         if PYAUDIO_AVAILABLE:
             self.audio_format = pyaudio.paInt16
@@ -74,24 +543,77 @@ class VoIPClient:
         self.stream_in = None
         self.stream_out = None
         self.playback_thread = None 
+        self.encode_thread = None
         
         self._start_threads()
 
     def _start_threads(self):
         threading.Thread(target=self._listen_loop, daemon=True).start()
         threading.Thread(target=self._heartbeat_loop, daemon=True).start()
-        threading.Thread(target=self._list_loop, daemon=True).start()
-
-    def send(self, payload):
+        threading.Thread(target=self._presence_loop, daemon=True).start()
+        threading.Thread(target=self._retransmit_loop, daemon=True).start()
+
+    def send(self, payload, confirm=False):
+        # confirm: el servidor confirma con ACK (y las respuestas van dentro);
+        # si no llega, _retransmit_loop lo reenvía con backoff.
+        server = (self.server_host, self.server_port)
+        data = payload.encode()
+        if confirm:
+            data = self.rtx.send(server, data, on_fail=self._on_signal_lost)
         try:
-            self.sock.sendto(payload.encode(), (self.server_host, self.server_port))
+            self.sock.sendto(data, server)
         except Exception as e:
             logger.error(f"Error enviando paquete: {e}")
 
+    def _retransmit_loop(self):
+        n = 0
+        while self.running:
+            time.sleep(0.05)
+            for addr, data, _ in self.rtx.due():
+                try:
+                    self.sock.sendto(data, addr)
+                except Exception as e:
+                    logger.error(f"Error reenviando paquete: {e}")
+            n += 1
+            if n % 20 == 0:
+                self.rx.expire()
+
+    def _on_signal_lost(self, addr, data):
+        msg = data.decode(errors="ignore")
+        logger.warning(f"Sin ACK del servidor para {msg[:40]}")
+        if msg.startswith("REGISTER:"):
+            self.ui.update_status("Sin respuesta del servidor")
+        elif msg.startswith("CALL:") and self.call_pending and not self.in_call:
+            self._end_call("Sin respuesta")
+
     def _listen_loop(self):
         while self.running:
             try:
-                data, _ = self.sock.recvfrom(4096)
+                data, addr = self.sock.recvfrom(4096)
+                if data and data[0] >= 0x80:
+                    self._on_media(data)
+                    continue
+                if data[:4] == b"P2P_":
+                    self._on_p2p(data, addr)
+                    continue
+                if data[:1] == b"~":
+                    # Mensaje del servidor que espera ACK; los reenvíos se ignoran
+                    tid, body = reliable.unwrap(data)
+                    if tid is None:
+                        continue
+                    self.sock.sendto(reliable.ack(tid), addr)
+                    if self.rx.begin(addr, tid) is not None:
+                        continue
+                    data = body
+                elif data[:4] == b"ACK:":
+                    tid, replies = reliable.parse_ack(data)
+                    if tid is None or not self.rtx.ack(tid):
+                        continue  # ACK repetido: sus respuestas ya se procesaron
+                    for r in replies:
+                        msg = r.decode(errors="ignore").strip()
+                        if msg:
+                            self._process_message(msg)
+                    continue
                 msg = data.decode(errors="ignore").strip()
                 if msg:
                     self._process_message(msg)
@@ -109,12 +631,31 @@ class VoIPClient:
                 self.connected = True
                 self.ui.update_status("Conectado")
                 self.ui.log("[SYSTEM] Conectado al servidor")
+                self._subscribe()
 
         elif msg == "PONG":
             self.last_pong = now
             if not self.connected:
                 self.connected = True
                 self.ui.update_status("Conectado")
+                self._subscribe()
+
+        elif msg.startswith("SUBSCRIBED:") or msg.startswith("PRESENCE_RESYNC:"):
+            parts = msg.split(":")
+            if len(parts) >= 3:
+                self._subscribed_at = now
+                resync = msg.startswith("PRESENCE_RESYNC:")
+                self._on_presence_base(parts[1], parts[2], resync)
+
+        elif msg.startswith("PRESENCE:"):
+            parts = msg.split(":", 3)
+            if len(parts) == 4:
+                self._on_presence_delta(parts[1], parts[2], parts[3])
+
+        elif msg.startswith("LIST_PAGE:"):
+            parts = msg.split(":", 4)
+            if len(parts) == 5:
+                self._on_list_page(parts[1], parts[2], parts[3], parts[4])
 
         elif msg.startswith("LIST:"):
             users = msg[5:].split(",") if len(msg) > 5 else []
@@ -123,16 +664,28 @@ class VoIPClient:
             self.ui.log(f"[LIST] {count} usuarios online")
 
         elif msg.startswith("CALL_FROM:"):
-            parts = msg.split(":", 2)
+            parts = msg.split(":", 3)
             if len(parts) >= 3:
                 caller = parts[1]
                 caller_name = parts[2]
-                self._handle_incoming_call(caller, caller_name)
+                self._handle_incoming_call(caller, caller_name,
+                                           parts[3] if len(parts) == 4 else "")
 
         elif msg.startswith("ACCEPT_FROM:"):
-            callee = msg.split(":")[1]
+            parts = msg.split(":")
+            callee = parts[1]
+            self._set_media_session(parts[2] if len(parts) >= 3 else "")
+            self._set_codec(parts[3] if len(parts) >= 4 else codec.PCM16.name)
             self._start_call_session(callee)
-            self.ui.log(f"[CALL] Aceptada por {callee}")
+            self.ui.log(f"[CALL] Aceptada por {callee} ({self.codec.name})")
+
+        elif msg.startswith("SESSION:"):
+            self._set_media_session(msg.split(":")[1])
+
+        elif msg.startswith("SESSION_CLOSED:"):
+            # El servidor cerró la sesión por inactividad: volvemos a AUDIO_B64
+            if msg.split(":")[1] == str(self.media_session):
+                self.media_session = 0
 
         elif msg.startswith("RINGING_FROM:"):
             callee = msg.split(":")[1]
@@ -155,11 +708,37 @@ class VoIPClient:
         elif msg.startswith("OFFER_FROM_B64:"):
             pass 
 
-        elif msg.startswith("AUDIO_FROM_B64:"):
+        elif msg.startswith("ICE_FROM_B64:"):
             parts = msg.split(":", 2)
             if len(parts) == 3:
-                b64_data = parts[2]
-                self._enqueue_audio(b64_data)
+                self._on_candidates(parts[1], parts[2])
+
+        elif msg.startswith("MAPPED:"):
+            parts = msg.split(":")
+            try:
+                self.mapped_addr = (parts[1], int(parts[2]))
+            except (IndexError, ValueError):
+                pass
+
+        elif msg.startswith("AUDIO_FROM_B64:"):
+            # AUDIO_FROM_B64:<num>:<n>:<b64>, o sin <n> de clientes antiguos
+            parts = msg.split(":", 3)
+            if len(parts) == 4:
+                try:
+                    self._enqueue_audio(parts[3], int(parts[2]))
+                except ValueError:
+                    pass
+            elif len(parts) == 3:
+                self._enqueue_audio(parts[2])
+
+        elif msg.startswith("LOSS_FROM:"):
+            parts = msg.split(":")
+            if len(parts) >= 3:
+                try:
+                    n = int(parts[3]) if len(parts) > 3 else 0
+                    self._on_loss_report(parts[1], float(parts[2]), n)
+                except ValueError:
+                    pass
 
         elif msg.startswith("BYE_FROM:"):
             frm = msg.split(":")[1]
@@ -178,17 +757,74 @@ class VoIPClient:
             except Exception:
                 pass
 
-    def _list_loop(self):
+    def _presence_loop(self):
+        # Renovación barata de la suscripción: si el servidor se reinició o se
+        # perdió un delta, SUBSCRIBED/PRESENCE_RESYNC nos vuelve a poner al día.
         while self.running:
-            if self.connected:
-                self.send("LIST")
             time.sleep(20)
+            if self.connected and time.time() - self._subscribed_at > 60:
+                self._subscribe()
+
+    def _subscribe(self):
+        self.send(f"SUBSCRIBE:{self.number}:{self.presence_epoch}:{self.presence_ver}")
+
+    def _on_presence_base(self, epoch, ver, resync):
+        try:
+            epoch, ver = int(epoch), int(ver)
+        except ValueError:
+            return
+        if epoch == self.presence_epoch and not resync and self.presence_ver:
+            return  # los deltas pendientes llegan detrás
+        self.presence_epoch = epoch
+        self.presence_ver = ver
+        self.directory = {}
+        self._presence_touch = {}
+        self.send("LIST_PAGE:")
+
+    def _on_presence_delta(self, frm, to, items):
+        try:
+            frm, to = int(frm), int(to)
+        except ValueError:
+            return
+        if to <= self.presence_ver:
+            return
+        if frm > self.presence_ver:
+            self._subscribe()  # hueco: pedimos que nos reenvíe desde nuestra versión
+            return
+        for item in items.split(","):
+            if item.startswith("+"):
+                num, _, nm = item[1:].partition("|")
+                self.directory[num] = nm
+                self._presence_touch[num] = to
+            elif item.startswith("-"):
+                self.directory.pop(item[1:], None)
+                self._presence_touch[item[1:]] = to
+        self.presence_ver = to
+        self._update_directory()
+
+    def _on_list_page(self, epoch, ver, nxt, items):
+        try:
+            epoch, ver = int(epoch), int(ver)
+        except ValueError:
+            return
+        if epoch != self.presence_epoch:
+            return
+        for item in items.split(","):
+            num, _, nm = item.partition("|")
+            if num and self._presence_touch.get(num, 0) <= ver:
+                self.directory[num] = nm
+        if nxt:
+            self.send(f"LIST_PAGE:{nxt}")
+        self._update_directory()
+
+    def _update_directory(self):
+        count = len(self.directory)
+        self.ui.update_online_count(count)
+        self.ui.log(f"[LIST] {count} usuarios online")
 
     def _register(self):
         self.ui.update_status("Conectando...")
-        for _ in range(5):
-            self.send(f"REGISTER:{self.number}:{self.local_port}:{self.name}")
-            time.sleep(0.5)
+        self.send(f"REGISTER:{self.number}:{self.local_port}:{self.name}", confirm=True)
 
     # --- Lógica de Llamada ---
 
@@ -199,33 +835,43 @@ class VoIPClient:
         self.call_pending = True
         self.ui.update_status(f"Llamando a {number}...")
         self.ui.start_ringback()
-        self.send(f"CALL:{number}:{self.number}")
+        offer = codec.available()
+        if offer == [codec.PCM16.name]:
+            self.send(f"CALL:{number}:{self.number}", confirm=True)
+        else:
+            self.send(f"CALL:{number}:{self.number}:{','.join(offer)}", confirm=True)
         def timeout_check():
             time.sleep(30)
             if self.call_pending and not self.in_call:
-                self.send(f"BYE:{self.peer}:{self.number}")
+                self.send(f"BYE:{self.peer}:{self.number}", confirm=True)
                 self._end_call("Sin respuesta")
         threading.Thread(target=timeout_check, daemon=True).start()
 
     def accept(self, caller):
-        self.send(f"ACCEPT:{caller}:{self.number}")
+        name = codec.negotiate(self.offered_codecs)
+        if name == codec.PCM16.name:
+            self.send(f"ACCEPT:{caller}:{self.number}", confirm=True)
+        else:
+            self.send(f"ACCEPT:{caller}:{self.number}:{name}", confirm=True)
+        self._set_codec(name)
         self._start_call_session(caller)
 
     def reject(self, caller):
-        self.send(f"REJECT:{caller}:{self.number}")
+        self.send(f"REJECT:{caller}:{self.number}", confirm=True)
         self.ui.stop_ringtone()
         self.peer = None
 
     def hangup(self):
         if self.peer:
-            self.send(f"BYE:{self.peer}:{self.number}")
+            self.send(f"BYE:{self.peer}:{self.number}", confirm=True)
         self._end_call("Colgada")
 
-    def _handle_incoming_call(self, caller, name):
+    def _handle_incoming_call(self, caller, name, codecs=""):
         if self.in_call or self.call_pending:
-            self.send(f"BUSY:{caller}:{self.number}")
+            self.send(f"BUSY:{caller}:{self.number}", confirm=True)
             return
         self.peer = caller
+        self.offered_codecs = codecs
         self.ui.on_incoming_call(caller, name)
 
     def _start_call_session(self, peer_name):
@@ -238,8 +884,209 @@ class VoIPClient:
         self.ui.start_call_timer()
         self.ui.set_in_call_ui(True)
         self._init_audio()
+        self._start_p2p()
+
+    def _set_media_session(self, sid):
+        try:
+            self.media_session = int(sid) & 0xFFFFFFFF
+        except ValueError:
+            self.media_session = 0
+        self.media_seq = 0
+        self.media_ts = 0
+
+    def _set_codec(self, name):
+        try:
+            self.codec = codec.create(name)
+        except RuntimeError as e:
+            logger.warning(f"Códec {name} no disponible, se usa PCM: {e}")
+            self.codec = codec.PCM16()
+        self._decoders = {self.codec.pt: self.codec}
+        logger.info(f"Códec {self.codec.name}: {self.codec.bitrate // 1000} kbps, "
+                    f"{self.codec.frame_samples} muestras por trama")
+
+    def _decoder(self, pt):
+        dec = self._decoders.get(pt)
+        if dec is None:
+            cls = codec.for_pt(pt)
+            if cls is None:
+                return None
+            try:
+                dec = self._decoders[pt] = cls()
+            except RuntimeError:
+                return None
+        return dec
+
+    def _report_loss(self):
+        st = self.jitter.stats
+        lost = st["lost"] + st["recovered"]
+        total = st["played"] + st["lost"]
+        d_lost, d_total = lost - self._loss_mark[0], total - self._loss_mark[1]
+        self._loss_mark = (lost, total)
+        if not self.media_session or not self.peer or d_total < LOSS_REPORT_FRAMES // 4:
+            return  # el otro calla: no hay nada que medir
+        pct = 100.0 * d_lost / d_total
+        self.jitter.fec_frames = 2 if pct >= FEC_ON_PCT and self.codec.pt != codec.PCM16.pt else 0
+        self._loss_sent += 1
+        self.send(f"LOSS:{self.peer}:{self.number}:{pct:.1f}:{self._loss_sent}")
+
+    def _on_loss_report(self, frm, pct, n=0):
+        if frm != self.peer:
+            return
+        if n:
+            if n <= self._loss_seen:
+                return  # copia (o atrasado) de uno ya contado
+            self._loss_seen = n
+        if pct >= FEC_ON_PCT:
+            self._fec_calm = 0
+            on = True
+        else:
+            self._fec_calm = self._fec_calm + 1 if pct < FEC_OFF_PCT else 0
+            on = self.fec_on and self._fec_calm < FEC_OFF_REPORTS
+        in_band = self.codec.set_loss(pct if on else 0)
+        group = fec_group(pct) if on and not in_band else 0
+        if on != self.fec_on or group != self.fec_group:
+            mode = f"paridad cada {group}" if group else f"FEC de {self.codec.name}" if on else "no"
+            logger.info(f"Pérdida en {frm}: {pct:.1f} %, redundancia: {mode}")
+        self.fec_on = on
+        if group != self.fec_group:
+            self.fec_group = group
+            self._fec_pending = []
+
+    # --- Camino directo (P2P) ---
+
+    def _start_p2p(self):
+        self._p2p_gen += 1
+        self.p2p_token = "%012x" % random.getrandbits(48)
+        self.mapped_addr = None
+        self.send("STUN")
+        threading.Thread(target=self._p2p_loop, args=(self._p2p_gen,), daemon=True).start()
+
+    def _stop_p2p(self):
+        self._p2p_gen += 1
+        self.p2p_token = ""
+        self.p2p_peer_token = ""
+        self.p2p_cands = []
+        self.p2p_addr = None
+        self.p2p_rtt = None
+
+    def _local_ip(self):
+        # IP de la interfaz por la que se sale hacia el servidor (sin enviar nada)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((self.server_host, self.server_port))
+            return s.getsockname()[0]
+        except OSError:
+            return None
+        finally:
+            s.close()
+
+    def _send_candidates(self):
+        cands = []
+        ip = self._local_ip()
+        if ip:
+            cands.append(f"{ip}:{self.local_port}")
+        if self.mapped_addr and f"{self.mapped_addr[0]}:{self.mapped_addr[1]}" not in cands:
+            cands.append(f"{self.mapped_addr[0]}:{self.mapped_addr[1]}")
+        if not cands or not self.peer:
+            return
+        body = base64.b64encode(f"p2p1 {self.p2p_token} {' '.join(cands)}".encode()).decode()
+        self.send(f"ICE_B64:{self.peer}:{self.number}:{body}", confirm=True)
+
+    def _on_candidates(self, frm, b64):
+        if frm != self.peer:
+            return
+        try:
+            parts = base64.b64decode(b64).decode().split()
+        except Exception:
+            return
+        if len(parts) < 2 or parts[0] != "p2p1":
+            return  # otro tipo de ICE (WebRTC): no es cosa nuestra
+        self.p2p_peer_token = parts[1]
+        for c in parts[2:]:
+            ip, _, port = c.rpartition(":")
+            try:
+                addr = (ip, int(port))
+            except ValueError:
+                continue
+            if addr not in self.p2p_cands:
+                self.p2p_cands.append(addr)
+        logger.info(f"Candidatos P2P de {frm}: {self.p2p_cands}")
+
+    def _p2p_ping(self, addr):
+        msg = f"P2P_PING:{self.p2p_peer_token}:{self.p2p_token}:{time.monotonic():.6f}"
+        try:
+            self.sock.sendto(msg.encode(), addr)
+        except OSError:
+            pass  # sin ruta: ese candidato no sirve
+
+    def _p2p_loop(self, gen):
+        t0 = time.monotonic()
+        while self.mapped_addr is None and time.monotonic() - t0 < 1.0 and gen == self._p2p_gen:
+            time.sleep(0.05)
+        if gen != self._p2p_gen:
+            return
+        self._send_candidates()
+        last_check = last_refresh = 0.0
+        while self.running and self.in_call and gen == self._p2p_gen:
+            now = time.monotonic()
+            if self.p2p_addr is not None:
+                if now - self._p2p_pong > P2P_CONSENT:
+                    self._p2p_switch(None)
+                elif now - last_refresh >= P2P_SERVER_REFRESH:
+                    last_refresh = now
+                    self._p2p_notify("direct", confirm=False)
+            if self.p2p_peer_token and (now - t0 < P2P_CHECK_TIME
+                                        or now - last_check >= P2P_KEEPALIVE):
+                last_check = now
+                for addr in ([self.p2p_addr] if self.p2p_addr else list(self.p2p_cands)):
+                    self._p2p_ping(addr)
+            time.sleep(P2P_CHECK_INTERVAL)
+
+    def _on_p2p(self, data, addr):
+        parts = data.decode(errors="ignore").split(":")
+        if not self.in_call or not self.p2p_token or len(parts) < 3 or parts[1] != self.p2p_token:
+            return
+        if parts[0] == "P2P_PING" and len(parts) >= 4:
+            try:
+                self.sock.sendto(f"P2P_PONG:{parts[2]}:{parts[3]}".encode(), addr)
+            except OSError:
+                return
+            if parts[2] == self.p2p_peer_token and addr not in self.p2p_cands:
+                self.p2p_cands.append(addr)  # reflexivo del otro que no conocíamos
+                if self.p2p_addr is None:
+                    self._p2p_ping(addr)
+        elif parts[0] == "P2P_PONG":
+            now = time.monotonic()
+            try:
+                rtt = now - float(parts[2])
+            except ValueError:
+                return
+            self._p2p_pong = now
+            self.p2p_rtt = rtt if self.p2p_rtt is None else self.p2p_rtt + (rtt - self.p2p_rtt) / 8
+            if self.p2p_addr is None:
+                self._p2p_switch(addr)
+
+    def _p2p_switch(self, addr):
+        self.p2p_addr = addr
+        if addr is not None:
+            logger.info(f"Audio directo con {self.peer} por {addr[0]}:{addr[1]}, "
+                        f"RTT {self.p2p_rtt * 1000:.1f} ms")
+            self.ui.log(f"[P2P] Directo ({self.p2p_rtt * 1000:.0f} ms)")
+            self._p2p_notify("direct")
+        else:
+            logger.info("Sin respuesta por el camino directo: audio por el servidor")
+            self.ui.log("[P2P] Por el servidor")
+            self._p2p_notify("relay")
+
+    def _p2p_notify(self, path, confirm=True):
+        if self.media_session:
+            self.send(f"P2P:{self.media_session}:{self.number}:{path}", confirm=confirm)
 
     def _end_call(self, reason):
+        self._stop_p2p()
+        self.media_session = 0
+        self.codec = codec.PCM16()
+        self.offered_codecs = ""
         self.peer = None
         self.in_call = False
         self.call_pending = False
@@ -294,6 +1141,8 @@ class VoIPClient:
             
             self.playback_thread = threading.Thread(target=self._audio_playback_worker, daemon=True)
             self.playback_thread.start()
+            self.encode_thread = threading.Thread(target=self._audio_encode_worker, daemon=True)
+            self.encode_thread.start()
             
             logger.info(f"Audio streams iniciados. In: {self.input_device_index}, Out: {self.output_device_index}")
             
@@ -301,66 +1150,120 @@ class VoIPClient:
             logger.error(f"Error iniciando audio: {e}")
             self.ui.update_status("Error Audio")
 
-    def _enqueue_audio(self, b64_data):
+    def _on_media(self, data):
+        if len(data) <= MEDIA_HDR.size or data[0] != 0x80 | MEDIA_VERSION:
+            return
+        _, pt, seq, ts, _ = MEDIA_HDR.unpack_from(data)
         if not self.in_call or not self.ui.speaker_on:
             return
+        if pt == codec.PARITY_PT:
+            self.jitter.put_parity(seq, ts, data[MEDIA_HDR.size:])
+        elif self._decoder(pt) is not None:
+            self.jitter.put(seq, ts, pt, data[MEDIA_HDR.size:])
+
+    def _enqueue_audio(self, b64_data, n=None):
+        # n: número de trama del emisor; el servidor manda copias y así el
+        # anti-jitter las descarta. Sin él se numera por orden de llegada
+        if not self.in_call or not self.ui.speaker_on:
+            return
+        if n is None:
+            self._b64_seq = n = (self._b64_seq + 1) & 0xFFFFFFFF
         try:
-            data = base64.b64decode(b64_data)
-            if self.audio_queue.full():
-                try:
-                    self.audio_queue.get_nowait()
-                except:
-                    pass
-            self.audio_queue.put_nowait(data)
+            payload = base64.b64decode(b64_data)
         except Exception:
-            pass
+            return
+        self.jitter.put(n & 0xFFFF, (n * self.audio_chunk) & 0xFFFFFFFF, self.codec.pt, payload)
 
     def _audio_playback_worker(self):
         silence = b'\x00' * (self.audio_chunk * 2) 
+        self.plc.reset()
+        n = 0
         
+        # stream_out.write bloquea hasta que cabe la trama: marca el ritmo de 20 ms
         while self.in_call and self.running:
-            try:
-                chunk = self.audio_queue.get(timeout=0.02)
-                if self.stream_out:
-                    try:
-                        self.stream_out.write(chunk)
-                    except OSError:
-                        pass
-                    
-            except Exception:
-                if self.stream_out:
-                    try:
-                        self.stream_out.write(silence)
-                    except OSError:
-                        pass
+            chunk = playout(self.jitter, self._decoder, self.plc, self.codec.pt)
+            n += 1
+            if n % LOSS_REPORT_FRAMES == 0:
+                self._report_loss()
+            if self.stream_out:
+                try:
+                    self.stream_out.write(chunk or silence)
+                except OSError:
+                    pass
+            else:
+                time.sleep(self.audio_chunk / self.audio_rate)
 
     def _audio_input_callback(self, in_data, frame_count, time_info, status):
-        if self.in_call and not self.ui.muted:
+        if self.in_call:
             try:
-                data_array = array.array('h', in_data)
-                
-                if self.isolation_enabled:
-                    volume = sum(abs(x) for x in data_array) / len(data_array)
-                    if volume < self.noise_gate_threshold:
-                        return (None, pyaudio.paContinue)
-
-                if self.input_gain != 1.0:
-                    for i in range(len(data_array)):
-                        val = int(data_array[i] * self.input_gain)
-                        if val >32767: val = 32767
-                        if val < -32768: val = -32768
-                        data_array[i] = val
-                
-                processed_data = data_array.tobytes()
-                
-                b64 = base64.b64encode(processed_data).decode()
-                self.send(f"AUDIO_B64:{self.peer}:{self.number}:{b64}")
+                if self.ui.muted:
+                    processed_data = None
+                else:
+                    gate = self.noise_gate_threshold if self.isolation_enabled else 0
+                    processed_data = process_input(in_data, self.input_gain, gate,
+                                                   self.noise_gate_rms, self.input_limiter)
+                # None = en silencio o cortada por la puerta: no se envía, pero el
+                # codificador avanza igual el timestamp (lo usa el anti-jitter)
+                if self.encode_queue.full():
+                    # el codificador va atrasado: mejor perder la trama más vieja
+                    try:
+                        self.encode_queue.get_nowait()
+                    except:
+                        pass
+                self.encode_queue.put_nowait((processed_data, frame_count))
                 
             except Exception as e:
                 logger.error(f"Error procesando audio input: {e}")
                 
         return (None, pyaudio.paContinue)
 
+    def _audio_encode_worker(self):
+        while self.in_call and self.running:
+            try:
+                pcm, frame_count = self.encode_queue.get(timeout=0.1)
+            except Exception:
+                continue
+            if pcm is None:
+                self.media_ts = (self.media_ts + frame_count) & 0xFFFFFFFF
+                continue
+            try:
+                self._send_audio(pcm, frame_count)
+            except Exception as e:
+                logger.error(f"Error codificando audio: {e}")
+
+    def _send_audio(self, pcm, frame_count):
+        payload = self.codec.encode(pcm)
+        if self.media_session:
+            hdr = MEDIA_HDR.pack(0x80 | MEDIA_VERSION, self.codec.pt,
+                                 self.media_seq, self.media_ts, self.media_session)
+            self.media_seq = (self.media_seq + 1) & 0xFFFF
+            self.media_ts = (self.media_ts + frame_count) & 0xFFFFFFFF
+            try:
+                self.sock.sendto(hdr + payload, self.p2p_addr or (self.server_host, self.server_port))
+            except Exception as e:
+                logger.error(f"Error enviando audio: {e}")
+            if self.fec_group:
+                self._send_parity(hdr, payload)
+        else:
+            b64 = base64.b64encode(payload).decode()
+            self._b64_sent = (self._b64_sent + 1) & 0xFFFFFFFF
+            self.send(f"AUDIO_B64:{self.peer}:{self.number}:{self._b64_sent}:{b64}")
+
+    def _send_parity(self, hdr, payload):
+        if not self._fec_pending:
+            self._fec_first = MEDIA_HDR.unpack(hdr)[2:4]
+        self._fec_pending.append(payload)
+        if len(self._fec_pending) < self.fec_group:
+            return
+        seq, ts = self._fec_first
+        hdr = MEDIA_HDR.pack(0x80 | MEDIA_VERSION, codec.PARITY_PT, seq, ts, self.media_session)
+        group, self._fec_pending = self._fec_pending, []
+        try:
+            self.sock.sendto(hdr + codec.parity(group),
+                             self.p2p_addr or (self.server_host, self.server_port))
+        except Exception as e:
+            logger.error(f"Error enviando paridad: {e}")
+
     def _stop_audio(self):
         self.in_call = False 
         
@@ -378,11 +1281,26 @@ class VoIPClient:
             except: pass
             self.stream_out = None
             
-        while not self.audio_queue.empty():
+        while not self.encode_queue.empty():
             try:
-                self.audio_queue.get_nowait()
+                self.encode_queue.get_nowait()
             except:
                 pass
+        st = self.jitter.stats
+        if st["received"]:
+            logger.info(f"Jitter buffer: {st}, jitter {self.jitter.jitter * 1000:.1f} ms, "
+                        f"{self.plc.concealed} tramas ocultadas")
+        self.jitter.reset()
+        self.plc.reset()
+        self._b64_seq = 0
+        self._b64_sent = 0
+        self._loss_mark = (0, 0)
+        self._loss_sent = 0
+        self._loss_seen = 0
+        self.fec_on = False
+        self.fec_group = 0
+        self._fec_calm = 0
+        self._fec_pending = []
 
         if self.p:
             try:
@@ -393,7 +1311,8 @@ class VoIPClient:
     def close(self):
         self.running = False
         self.hangup()
-        self.send(f"UNREGISTER:{self.number}")
+        self.send(f"UNSUBSCRIBE:{self.number}")
+        self.send(f"UNREGISTER:{self.number}", confirm=True)
         try:
             self.sock.close()
         except: pass